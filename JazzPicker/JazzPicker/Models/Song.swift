@@ -49,6 +49,11 @@ struct GenerateResponse: Codable, Sendable {
     let cached: Bool
     let generationTimeMs: Int?
     let crop: CropBounds?
+    /// Per-page bounds as [top, bottom, left, right] (nil for blank pages)
+    let cropPages: [[Double]?]?
+    let pageCount: Int?
+    /// Per-page [width, height] in points
+    let pageSizes: [[Double]]?
     let octaveOffset: Int?
     let includeVersion: String?
 
@@ -57,6 +62,9 @@ struct GenerateResponse: Codable, Sendable {
         case cached
         case generationTimeMs = "generation_time_ms"
         case crop
+        case cropPages = "crop_pages"
+        case pageCount = "page_count"
+        case pageSizes = "page_sizes"
         case octaveOffset = "octave_offset"
         case includeVersion
     }
@@ -0,0 +1,283 @@
+"""
+Admission control for LilyPond compiles, shared by every gunicorn worker.
+
+A handful of simultaneous lilypond processes can exhaust a small machine's
+memory or push requests past the gunicorn timeout. CompileGate keeps a
+SQLite table of tickets next to the job queue:
+
+- chart tickets: one per chart waiting for or running a compile. Once
+  slots + queue_max are outstanding, new requests are refused with a
+  Retry-After estimate instead of piling up (background callers wait).
+- process tickets: one per running lilypond invocation, never more than
+  slots at a time across all processes.
+
+A request that needs several charts at once (a band) is admitted as one
+unit: it gets in whenever a single chart would, then holds a ticket per
+chart, so it is never refused for one of its own members.
+
+Work comes in priority lanes: interactive (someone opening a chart),
+prefetch (warming a setlist before a gig) and maintenance (background
+recompiles). Free process slots always go to the best waiting lane, and
+only interactive charts are refused when busy: background lanes wait,
+and their tickets never count against interactive admission.
+
+Only the compile path takes tickets; cache hits and catalog reads never
+touch the gate.
+"""
+import math
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+GATE_DB_PATH = Path(os.getenv('COMPILE_GATE_DB', 'cache/compile_gate.db'))
+COMPILE_SLOTS = int(os.getenv('COMPILE_SLOTS', str(os.cpu_count() or 1)))  # Concurrent lilypond processes
+COMPILE_QUEUE_MAX = int(os.getenv('COMPILE_QUEUE_MAX', '2'))  # Charts allowed to wait for a slot
+DEFAULT_COMPILE_SECONDS = 5.0  # Retry-After basis before any compile has been timed
+TICKET_MAX_AGE = 600           # Tickets older than this are assumed orphaned
+POLL_INTERVAL = 0.05           # Seconds between slot checks
+
+CHART = 'chart'
+PROCESS = 'process'
+WAITING = 'waiting'
+RUNNING = 'running'
+
+# Priority lanes (lower number runs first)
+INTERACTIVE = 'interactive'
+PREFETCH = 'prefetch'
+MAINTENANCE = 'maintenance'
+PRIORITIES = {INTERACTIVE: 0, PREFETCH: 1, MAINTENANCE: 2}
+
+
+class CompileBusy(Exception):
+    """The compile queue is full. retry_after is a suggested wait in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Compile queue full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CompileGate:
+    """
+    Cross-process compile semaphore with a bounded wait queue.
+
+    admit() guards a chart from cache miss to compiled PDF; slot() guards
+    one lilypond invocation (which may carry several batched charts).
+    Priorities are the PRIORITIES values (0 = interactive).
+    """
+
+    def __init__(self, db_path=GATE_DB_PATH, slots=COMPILE_SLOTS, queue_max=COMPILE_QUEUE_MAX):
+        self.db_path = Path(db_path)
+        self.slots = max(1, slots)
+        self.queue_max = max(0, queue_max)
+        self._init_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_schema(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tickets (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    priority INTEGER NOT NULL DEFAULT 0,
+                    state TEXT NOT NULL DEFAULT 'running'
+                );
+                CREATE INDEX IF NOT EXISTS idx_tickets_lane ON tickets(kind, state, priority, created_at);
+                CREATE TABLE IF NOT EXISTS stats (
+                    name TEXT PRIMARY KEY,
+                    value REAL NOT NULL
+                );
+            """)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+
+    def _reap(self, conn):
+        """Drop tickets left behind by crashed workers (call inside a transaction)."""
+        conn.execute("DELETE FROM tickets WHERE created_at < ?", (time.time() - TICKET_MAX_AGE,))
+        for row in conn.execute("SELECT DISTINCT pid FROM tickets").fetchall():
+            if not self._pid_alive(row['pid']):
+                conn.execute("DELETE FROM tickets WHERE pid = ?", (row['pid'],))
+
+    def _try_admit(self, priority, charts=1):
+        """
+        Insert chart tickets if the lane has room for one more request.
+        Returns (ticket ids or None, count).
+
+        Interactive charts only count interactive tickets; background lanes
+        count everything, so they back off whenever the gate is busy.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._reap(conn)
+            if priority == PRIORITIES[INTERACTIVE]:
+                count = conn.execute(
+                    "SELECT COUNT(*) FROM tickets WHERE kind = ? AND priority = ?", (CHART, priority)
+                ).fetchone()[0]
+            else:
+                count = conn.execute("SELECT COUNT(*) FROM tickets WHERE kind = ?", (CHART,)).fetchone()[0]
+            ticket_ids = None
+            if count < self.slots + self.queue_max:
+                ticket_ids = [uuid.uuid4().hex for _ in range(charts)]
+                conn.executemany(
+                    "INSERT INTO tickets (id, kind, pid, created_at, priority) VALUES (?, ?, ?, ?, ?)",
+                    [(ticket_id, CHART, os.getpid(), time.time(), priority) for ticket_id in ticket_ids]
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return ticket_ids, count
+
+    def _try_run(self, ticket_id, priority):
+        """
+        Promote a waiting process ticket to running if a slot is free and no
+        better-placed ticket is waiting. Returns True once running.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._reap(conn)
+            if not conn.execute("SELECT 1 FROM tickets WHERE id = ?", (ticket_id,)).fetchone():
+                # Reaped while waiting (very long wait): rejoin the line
+                conn.execute(
+                    "INSERT INTO tickets (id, kind, pid, created_at, priority, state) VALUES (?, ?, ?, ?, ?, ?)",
+                    (ticket_id, PROCESS, os.getpid(), time.time(), priority, WAITING)
+                )
+            running = conn.execute(
+                "SELECT COUNT(*) FROM tickets WHERE kind = ? AND state = ?", (PROCESS, RUNNING)
+            ).fetchone()[0]
+            first = conn.execute(
+                "SELECT id FROM tickets WHERE kind = ? AND state = ? ORDER BY priority, created_at LIMIT 1",
+                (PROCESS, WAITING)
+            ).fetchone()
+            granted = running < self.slots and first is not None and first['id'] == ticket_id
+            if granted:
+                conn.execute(
+                    "UPDATE tickets SET state = ?, created_at = ? WHERE id = ?", (RUNNING, time.time(), ticket_id)
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return granted
+
+    def _release(self, *ticket_ids):
+        conn = self._connect()
+        try:
+            conn.executemany("DELETE FROM tickets WHERE id = ?", [(ticket_id,) for ticket_id in ticket_ids])
+        finally:
+            conn.close()
+
+    @contextmanager
+    def admit(self, priority=0, block=False, charts=1):
+        """
+        Hold chart tickets for the duration of a compile (or of a unit of
+        `charts` compiles, admitted together).
+
+        Raises CompileBusy when the lane is full, unless block is set
+        (background work), in which case it waits for room.
+        """
+        while True:
+            ticket_ids, count = self._try_admit(priority, max(1, charts))
+            if ticket_ids:
+                break
+            if not block:
+                raise CompileBusy(self.retry_after(count))
+            time.sleep(POLL_INTERVAL)
+        try:
+            yield
+        finally:
+            self._release(*ticket_ids)
+
+    @contextmanager
+    def slot(self, priority=0):
+        """
+        Hold one of the global lilypond process slots.
+
+        Waits in line: interactive invocations get the next free slot
+        before any prefetch or maintenance work, oldest first within a lane.
+        """
+        ticket_id = uuid.uuid4().hex
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO tickets (id, kind, pid, created_at, priority, state) VALUES (?, ?, ?, ?, ?, ?)",
+                (ticket_id, PROCESS, os.getpid(), time.time(), priority, WAITING)
+            )
+        finally:
+            conn.close()
+
+        try:
+            while not self._try_run(ticket_id, priority):
+                time.sleep(POLL_INTERVAL)
+            start = time.time()
+            yield
+            self.record_compile(time.time() - start)
+        finally:
+            self._release(ticket_id)
+
+    def record_compile(self, seconds):
+        """Fold a compile duration into the moving average used for Retry-After."""
+        conn = self._connect()
+        try:
+            conn.execute(
+                """INSERT INTO stats (name, value) VALUES ('compile_seconds', ?)
+                   ON CONFLICT(name) DO UPDATE SET value = value * 0.8 + excluded.value * 0.2""",
+                (seconds,)
+            )
+        finally:
+            conn.close()
+
+    def average_compile_seconds(self):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM stats WHERE name = 'compile_seconds'").fetchone()
+        finally:
+            conn.close()
+        return row['value'] if row else DEFAULT_COMPILE_SECONDS
+
+    def retry_after(self, pending):
+        """Seconds until a slot is likely free, given pending charts ahead."""
+        waves = math.ceil((pending + 1) / self.slots)
+        return max(1, min(300, math.ceil(waves * self.average_compile_seconds())))
+
+    def stats(self):
+        """Outstanding tickets, for metrics. charts is per lane name."""
+        conn = self._connect()
+        try:
+            charts = dict(conn.execute(
+                "SELECT priority, COUNT(*) FROM tickets WHERE kind = ? GROUP BY priority", (CHART,)
+            ).fetchall())
+            running = conn.execute(
+                "SELECT COUNT(*) FROM tickets WHERE kind = ? AND state = ?", (PROCESS, RUNNING)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        return {'slots': self.slots, 'queue_max': self.queue_max, 'running': running,
+                'charts': {lane: charts.get(value, 0) for lane, value in PRIORITIES.items()}}
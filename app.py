@@ -3,21 +3,40 @@
 Jazz Picker - A web interface for browsing Eric's lilypond lead sheets.
 """
 
-from flask import Flask, jsonify, request, send_from_directory, make_response, g
+from flask import (Flask, Response, jsonify, request, send_from_directory, make_response, g, stream_with_context,
+                   redirect, has_request_context)
 from flask_cors import CORS
 import subprocess
 import os
 import sys
+import re
 import socket
+import threading
+import fcntl
 from pathlib import Path
 from functools import wraps
+from contextlib import ExitStack, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import boto3
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 import hashlib
+import hmac
+import shutil
+import secrets
 import time
 
 import db  # SQLite database module
 import json
+from compile_queue import JobQueue, QUEUE_DB_PATH
+from singleflight import SingleFlight, LOCK_DIR
+from compiler import (LilyPondBatcher, generate_wrapper_content, content_hash, include_set_hash, lilypond_version,
+                      compile_sandbox, sweep_sandboxes)
+from pdf_cache import LocalPDFCache, CACHE_DIR, CACHE_MAX_BYTES
+from asset_registry import AssetRegistry, REGISTRY_DB_PATH
+from admission import CompileGate, CompileBusy, GATE_DB_PATH, PRIORITIES, INTERACTIVE, PREFETCH, MAINTENANCE
+from uploader import WriteBehindUploader, chart_metadata
+from s3_health import CircuitBreaker
+import metrics
 
 # Firebase Admin SDK (optional - for token verification)
 try:
@@ -34,10 +53,12 @@ except ImportError:
 # Note: This try/except may be cruft now that Dockerfile includes crop_detector.py
 # Kept for defensive coding in case of future deployment issues
 try:
-    from crop_detector import detect_bounds
+    from crop_detector import detect_page_layout, get_page_count, optimize_pdf
     CROP_DETECTION_AVAILABLE = True
 except ImportError:
-    detect_bounds = None
+    detect_page_layout = None
+    optimize_pdf = None
+    get_page_count = None
     CROP_DETECTION_AVAILABLE = False
     print("⚠️  crop_detector not available - crop detection disabled")
 
@@ -46,39 +67,147 @@ app = Flask(__name__)
 # Enable CORS for frontend domains
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Per-process metrics, exported (summed across workers) at /metrics
+metrics.start_flusher()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Count requests and record latency per route (streamed bodies: time to first byte)."""
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('http_requests_total', route=route, method=request.method, status=response.status_code)
+    if 'request_start' in g:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_start, route=route)
+    if 'stage_timer' in g:
+        response.headers['Server-Timing'] = g.stage_timer.server_timing()
+    return response
+
+
+def timed_stages(f):
+    """
+    Decorator for the generate endpoints: collect the view's stage timings.
+
+    record_request_metrics sends them as the Server-Timing header, whatever
+    the view returns (a streamed body only covers time to first byte).
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        g.stage_timer = metrics.StageTimer()
+        with g.stage_timer:
+            return f(*args, **kwargs)
+    return decorated
+
+
 # Constants for validation
 MAX_LIMIT = 200
+MAX_JOB_WAIT = 30  # Seconds a job status request may long-poll
+MAX_BATCH_ITEMS = 50  # Charts per /api/v2/generate/batch request
+MAX_BAND_INSTRUMENTS = 20  # Instruments per /api/v2/generate/band request
 
 # Database
 DB_FILE = 'catalog.db'
 S3_DB_KEY = 'catalog.db'
 db_etag = None  # ETag for catalog version
+catalog_song_count = 0  # Set when the catalog is loaded (keeps /health off the database)
+catalog_version = None  # built_at of the loaded catalog (shown on /health)
+catalog_file_stat = None  # (mtime_ns, size, inode) of the loaded catalog.db
+CATALOG_META_FILE = f'{DB_FILE}.meta'  # Sidecar: content hash and S3 ETag of catalog.db
+CATALOG_RELOAD_INTERVAL = int(os.getenv('CATALOG_RELOAD_INTERVAL', '60'))  # Seconds between checks (0 = off)
 
 WRAPPERS_DIR = 'lilypond-data/Wrappers'
-CACHE_DIR = Path('cache/pdfs')
 
 # S3 Configuration
 S3_BUCKET = os.getenv('S3_BUCKET_NAME', 'jazz-picker-pdfs')
 S3_CUSTOM_BUCKET = os.getenv('S3_CUSTOM_BUCKET_NAME', 'jazz-picker-custom-pdfs')
 S3_REGION = os.getenv('S3_REGION', 'us-east-1')
 USE_S3 = os.getenv('USE_S3', 'true').lower() == 'true'
+S3_WRITE_BEHIND = os.getenv('S3_WRITE_BEHIND', 'true').lower() == 'true'  # Answer before the upload finishes
+PRESIGNED_URL_TTL = 900  # Seconds a presigned S3 link stays valid
+LOCAL_URL_TTL = int(os.getenv('LOCAL_URL_TTL', str(PRESIGNED_URL_TTL)))  # Seconds a /pdfs/ link stays valid
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')  # Origin for /pdfs/ links (default: request host)
+MACHINE_ID = os.getenv('FLY_MACHINE_ID', '')  # /pdfs/ links are replayed to the machine holding the file
+PDF_OPTIMIZE = os.getenv('PDF_OPTIMIZE', 'false').lower() == 'true'  # Rewrite compiled PDFs compactly
 
 # Custom charts directory
 CUSTOM_CHARTS_DIR = Path('custom-charts')
 
+# Opens after repeated S3 failures; cached charts are then served from this machine
+s3_breaker = CircuitBreaker()
+
+
+def record_s3_call_start(model, context, **kwargs):
+    context['metrics_operation'] = model.name
+    context['metrics_start'] = time.perf_counter()
+
+
+def record_s3_call(http_response, parsed, model, context, **kwargs):
+    """Latency and result code for every S3 API call (error code, or HTTP status on success)."""
+    code = parsed.get('Error', {}).get('Code') or str(http_response.status_code)
+    metrics.inc('s3_requests_total', operation=model.name, code=code)
+    if http_response.status_code >= 500:
+        s3_breaker.record_failure()
+    else:
+        s3_breaker.record_success()
+    if 'metrics_start' in context:
+        metrics.observe('s3_request_duration_seconds', time.perf_counter() - context['metrics_start'],
+                        operation=model.name)
+
+
+def record_s3_call_error(exception, context, **kwargs):
+    """Connection-level S3 failures (no HTTP response)."""
+    metrics.inc('s3_requests_total', operation=context.get('metrics_operation', 'unknown'),
+                code=type(exception).__name__)
+    s3_breaker.record_failure()
+
+
 # Initialize S3 client if enabled
 s3_client = None
 if USE_S3:
     try:
         s3_client = boto3.client('s3', region_name=S3_REGION)
+        s3_client.meta.events.register('before-call.s3', record_s3_call_start)
+        s3_client.meta.events.register('after-call.s3', record_s3_call)
+        s3_client.meta.events.register('after-call-error.s3', record_s3_call_error)
         print(f"✅ S3 client initialized (bucket: {S3_BUCKET}, region: {S3_REGION})")
     except Exception as e:
         print(f"⚠️  Warning: Could not initialize S3 client: {e}")
         print("   PDFs will be served from local cache/Dropbox only")
         s3_client = None
 
-# Create cache directory on startup
-CACHE_DIR.mkdir(parents=True, exist_ok=True)
+# Local PDF cache in front of S3 (creates cache directory on startup)
+pdf_cache = LocalPDFCache(CACHE_DIR, CACHE_MAX_BYTES)
+
+# Registry of generated assets in S3 (replaces head_object and bucket listings)
+asset_registry = AssetRegistry(REGISTRY_DB_PATH)
+
+
+def load_url_secret():
+    """
+    Key for signing /pdfs/ links: LOCAL_URL_SECRET if set, else a random
+    key kept in the cache directory so every gunicorn worker shares it.
+    """
+    secret = os.getenv('LOCAL_URL_SECRET')
+    if secret:
+        return secret.encode()
+    path = CACHE_DIR / 'url_secret'
+    if not path.exists():
+        tmp_path = CACHE_DIR / f"url_secret.{os.getpid()}.tmp"
+        tmp_path.write_bytes(secrets.token_bytes(32))
+        try:
+            os.link(tmp_path, path)  # Atomic: the first worker's key wins
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return path.read_bytes()
+
+
+url_secret = load_url_secret()
 
 # Firebase Admin initialization (optional - for token verification)
 # Note: Token verification requires GOOGLE_APPLICATION_CREDENTIALS env var to be set
@@ -205,48 +334,161 @@ def bad_request(error):
 
 def init_catalog_db():
     """Initialize the catalog database, downloading from S3 if needed."""
-    global db_etag
-
     db_path = Path(DB_FILE)
 
-    # Try to download from S3 if enabled and file doesn't exist or is old
+    # Download only if S3 has a different catalog than the one on disk
     if USE_S3 and s3_client:
         try:
-            # Check if S3 has a newer version
-            response = s3_client.head_object(Bucket=S3_BUCKET, Key=S3_DB_KEY)
-            s3_etag = response.get('ETag', '').strip('"')
-
-            # Download if local doesn't exist or ETags differ
-            should_download = not db_path.exists()
-            if db_path.exists() and s3_etag:
-                local_mtime = db_path.stat().st_mtime
-                local_etag = hashlib.md5(str(local_mtime).encode()).hexdigest()
-                should_download = local_etag != s3_etag
-
-            if should_download:
-                print(f"⬇️  Downloading catalog.db from S3...")
-                s3_client.download_file(S3_BUCKET, S3_DB_KEY, DB_FILE)
-                print(f"✅ Downloaded catalog.db from S3")
+            if download_catalog(local_catalog_etag(db_path)):
+                print("⬇️  Downloaded catalog.db from S3")
+            else:
+                print("✅ catalog.db is current with S3")
 
         except ClientError as e:
-            if e.response['Error']['Code'] == '404':
-                print(f"⚠️  catalog.db not found in S3, using local file")
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                print("⚠️  catalog.db not found in S3, using local file")
             else:
                 print(f"⚠️  Could not check S3 for catalog.db: {e}")
+        except ValueError as e:
+            print(f"⚠️  Downloaded catalog.db is invalid, using local file: {e}")
 
     # Initialize the database
     try:
-        song_count = db.init_db(db_path)
+        song_count = load_catalog(db_path)
         print(f"✅ Loaded catalog database ({song_count} songs)")
 
-        # Generate ETag from file modification time
-        db_etag = hashlib.md5(str(db_path.stat().st_mtime).encode()).hexdigest()
-
     except FileNotFoundError:
         print("❌ catalog.db not found locally or on S3.")
         raise
 
 
+def file_sha256(path):
+    """Hex SHA-256 of a file's contents."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def read_catalog_meta():
+    """The catalog.db sidecar ({'sha256', 's3_etag'}), or {} if missing or unreadable."""
+    try:
+        with open(CATALOG_META_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_catalog_meta(sha256, s3_etag):
+    tmp_path = Path(f"{CATALOG_META_FILE}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps({'sha256': sha256, 's3_etag': s3_etag}))
+    os.replace(tmp_path, CATALOG_META_FILE)
+
+
+def local_catalog_etag(db_path):
+    """
+    S3 ETag that catalog.db on disk was downloaded with, or None if the
+    file is missing or no longer matches the hash recorded in the sidecar.
+    """
+    meta = read_catalog_meta()
+    if not meta.get('s3_etag') or not db_path.exists():
+        return None
+    return meta['s3_etag'] if meta.get('sha256') == file_sha256(db_path) else None
+
+
+def download_catalog(etag=None):
+    """
+    Fetch catalog.db from S3 unless its ETag is still etag (If-None-Match).
+
+    A new catalog goes to a temporary file, is validated, then renamed
+    over DB_FILE and recorded in the sidecar. Processes that still have
+    the old file open keep reading it until they reload. Returns the new
+    S3 ETag, or None if the catalog on disk is current.
+    """
+    try:
+        conditional = {'IfNoneMatch': f'"{etag}"'} if etag else {}
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=S3_DB_KEY, **conditional)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('304', 'NotModified'):
+            return None
+        raise
+
+    s3_etag = response.get('ETag', '').strip('"')
+    tmp_path = Path(f"{DB_FILE}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f)
+        db.validate_catalog(tmp_path)
+        sha256 = file_sha256(tmp_path)
+        os.replace(tmp_path, DB_FILE)
+        write_catalog_meta(sha256, s3_etag)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+    return s3_etag
+
+
+def catalog_stat(db_path):
+    """Identity of the catalog file on disk; changes when it is replaced or rewritten."""
+    st = db_path.stat()
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def load_catalog(db_path):
+    """Load db_path as the active catalog and refresh the values derived from it."""
+    global db_etag, catalog_song_count, catalog_version, catalog_file_stat
+
+    # Taken before loading, so a file replaced mid-load is picked up next check
+    file_stat = catalog_stat(db_path)
+    sha256 = file_sha256(db_path)
+    song_count = db.init_db(db_path)
+
+    catalog_version = db.get_metadata().get('built_at')
+    catalog_song_count = song_count
+    catalog_file_stat = file_stat
+
+    # ETag from the catalog's content: the same across restarts, downloads and machines
+    db_etag = sha256[:32]
+    return song_count
+
+
+def check_catalog_update():
+    """
+    Pick up a new catalog without a restart: download it if S3 has a
+    different one than the file on disk, then reload if catalog.db differs
+    from the loaded one (also covers another worker's download, and local
+    edits in dev). Returns True if the catalog was reloaded.
+    """
+    db_path = Path(DB_FILE)
+
+    if USE_S3 and s3_client:
+        try:
+            download_catalog(local_catalog_etag(db_path))
+        except ClientError as e:
+            print(f"⚠️  Could not check S3 for catalog.db: {e}")
+
+    if catalog_stat(db_path) == catalog_file_stat:
+        return False
+
+    # In dev the file may be mid-rewrite; it is retried on the next check
+    db.validate_catalog(db_path)
+    song_count = load_catalog(db_path)
+    metrics.inc('catalog_reloads_total', result='ok')
+    print(f"🔄 Reloaded catalog database ({song_count} songs, built {catalog_version})")
+    return True
+
+
+def watch_catalog():
+    """Check for a new catalog every CATALOG_RELOAD_INTERVAL seconds (runs in each worker)."""
+    while True:
+        time.sleep(CATALOG_RELOAD_INTERVAL)
+        try:
+            check_catalog_update()
+        except Exception as e:
+            metrics.inc('catalog_reloads_total', result='failed')
+            print(f"⚠️  Catalog reload failed: {e}")
+
+
 def add_cache_headers(response, max_age=300, etag=None):
     """Add caching headers to a response."""
     # Add Cache-Control header
@@ -299,6 +541,9 @@ def index():
             'songs_v2': '/api/v2/songs?limit=20&offset=0&q=',
             'cached_keys': '/api/v2/songs/{title}/cached',
             'generate': '/api/v2/generate',
+            'generate_batch': '/api/v2/generate/batch',
+            'generate_band': '/api/v2/generate/band',
+            'job_status': '/api/v2/jobs/{job_id}?wait=25',
         },
         'frontend': 'https://jazzpicker.pianohouseproject.org'
     })
@@ -307,16 +552,55 @@ def index():
 @app.route('/health')
 def health():
     """Health check endpoint for deployment platforms."""
-    total_songs = db.get_total_songs()
-
     return jsonify({
         'status': 'healthy',
-        'total_songs': total_songs,
+        'total_songs': catalog_song_count,
+        'catalog_version': catalog_version,
+        'catalog_etag': db_etag,
         's3_enabled': USE_S3,
-        's3_configured': s3_client is not None
+        's3_configured': s3_client is not None,
+        's3_available': s3_client is not None and not s3_breaker.is_open(),
+        'counters': metrics.counters(),
+        'timings': {
+            h['series']: {
+                'count': h['count'],
+                'p50_ms': round(h['p50'] * 1000, 1),
+                'p95_ms': round(h['p95'] * 1000, 1),
+            }
+            for h in metrics.histograms()
+        }
     }), 200
 
 
+@app.route('/metrics')
+@requires_auth
+def prometheus_metrics():
+    """
+    Prometheus metrics, summed across all gunicorn workers.
+
+    Counters and histograms: HTTP requests per route, generate cache
+    results, per-stage and LilyPond timings, compile failures, S3 calls
+    and catalog queries. Gauges (queue depth, cache size) are read at
+    scrape time.
+    """
+    counter_values, histogram_values = metrics.aggregate()
+    cache_stats = pdf_cache.stats()
+    gate_stats = compile_gate.stats()
+    gauges = {
+        'job_queue_depth': job_queue.depth(),
+        'compile_slots': gate_stats['slots'],
+        'compile_slots_busy': gate_stats['running'],
+        'compile_charts_pending': {(('priority', lane),): n for lane, n in gate_stats['charts'].items()},
+        'local_cache_entries': cache_stats['entries'],
+        'local_cache_bytes': cache_stats['bytes'],
+        's3_uploads_pending': cache_stats['pending_uploads'],
+        'registered_assets': asset_registry.count(),
+        'catalog_songs': catalog_song_count,
+    }
+    return Response(metrics.render_prometheus(counter_values, histogram_values, gauges),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/v2/catalog')
 @requires_auth
 @verify_firebase_token
@@ -386,7 +670,6 @@ def get_songs_v2():
 
 # LilyPond generation constants
 LILYPOND_DATA_DIR = Path('lilypond-data')
-GENERATED_DIR = LILYPOND_DATA_DIR / 'Generated'  # Inside lilypond-data for correct relative paths
 VALID_KEYS = {'c', 'cs', 'df', 'd', 'ds', 'ef', 'e', 'f', 'fs', 'gf', 'g', 'gs', 'af', 'a', 'as', 'bf', 'b'}
 VALID_CLEFS = {'treble', 'bass'}
 VALID_TRANSPOSITIONS = {'C', 'Bb', 'Eb'}
@@ -441,24 +724,29 @@ def get_key_offset(from_key, to_key):
     return (to_index - from_index) % 12
 
 
-def calculate_optimal_octave(song_title, concert_key, instrument_label):
+def calculate_optimal_octave(song, concert_key, instrument_label):
     """
     Calculate the optimal octave offset for a song/key/instrument combination.
 
-    Returns an integer from -2 to +2, or 0 if calculation isn't possible.
+    song is a db.ResolvedSong. Returns an integer from -2 to +2, or 0 if
+    calculation isn't possible.
+    """
+    return optimal_octave_for_range(song.low_note_midi, song.high_note_midi, song.default_key,
+                                    concert_key, instrument_label)
+
+
+def optimal_octave_for_range(song_low, song_high, default_key, concert_key, instrument_label):
+    """
+    Octave offset calculation for a song's MIDI note range, written in
+    default_key, played in concert_key by the given instrument.
     """
-    # Check if instrument needs octave optimization
     instrument = INSTRUMENTS.get(instrument_label)
     if not instrument or instrument['range'] is None:
         return 0
 
-    # Get song's note range and default key
-    song_low, song_high = db.get_song_note_range(song_title)
     if song_low is None or song_high is None:
         return 0
 
-    default_key, _ = db.get_song_default_key(song_title)
-
     # Calculate key offset (semitones from default to target concert key)
     key_offset = get_key_offset(default_key, concert_key)
 
@@ -522,54 +810,12 @@ def concert_to_written(concert_key, transposition):
 
 def slugify(text):
     """Convert text to a safe filename slug."""
-    import re
     text = text.lower()
     text = re.sub(r'[^\w\s-]', '', text)
     text = re.sub(r'[\s_-]+', '-', text)
     return text.strip('-')
 
 
-def generate_wrapper_content(core_file, target_key, clef, instrument="", octave_offset=0, source='standard'):
-    """Generate LilyPond wrapper file content.
-
-    Args:
-        octave_offset: Integer from -2 to +2. Positive = up, negative = down.
-                       LilyPond syntax: ' = up one octave, , = down one octave
-        source: 'standard' or 'custom' - determines Core file path
-    """
-    # bassKey is always the key without octave modifier
-    bass_key = target_key.rstrip(',')
-
-    # For bass clef, whatKey starts one octave down
-    what_key = f"{target_key}," if clef == "bass" else target_key
-
-    # Apply octave offset: ' = up, , = down
-    if octave_offset > 0:
-        what_key += "'" * octave_offset
-    elif octave_offset < 0:
-        what_key += "," * abs(octave_offset)
-
-    # Core file path depends on source
-    if source == 'custom':
-        core_include = f'../../custom-charts/Core/{core_file}'
-    else:
-        core_include = f'../Core/{core_file}'
-
-    return f'''%% -*- Mode: LilyPond -*-
-
-\\version "2.24.0"
-
-\\include "english.ly"
-
-instrument = "{instrument}"
-whatKey = {what_key}
-bassKey = {bass_key}
-whatClef = "{clef}"
-
-\\include "{core_include}"
-'''
-
-
 @app.route('/api/v2/cached-keys')
 @requires_auth
 @verify_firebase_token
@@ -601,38 +847,23 @@ def get_all_cached_keys():
 
     cached_keys = {}
 
-    if s3_client:
-        try:
-            # List all generated PDFs
-            paginator = s3_client.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=S3_BUCKET, Prefix='generated/')
-
-            for page in pages:
-                for obj in page.get('Contents', []):
-                    # Parse: generated/{slug}-{concert_key}-{transposition}-{clef}.pdf
-                    key = obj['Key']
-                    if not key.endswith('.pdf'):
-                        continue
-
-                    # Remove prefix and extension
-                    filename = key.replace('generated/', '').replace('.pdf', '')
-
-                    # Split from the end to handle song slugs with hyphens
-                    parts = filename.rsplit('-', 3)
-                    if len(parts) != 4:
-                        continue
-
-                    song_slug, concert_key, file_trans, file_clef = parts
-
-                    # Filter by transposition and clef
-                    if file_trans == transposition and file_clef == clef:
-                        if song_slug not in cached_keys:
-                            cached_keys[song_slug] = []
-                        if concert_key not in cached_keys[song_slug]:
-                            cached_keys[song_slug].append(concert_key)
-
-        except ClientError as e:
-            print(f"⚠️  Error listing cached keys: {e}")
+    # Stored builds from the asset registry (with stale-while-revalidate,
+    # earlier builds count: they are served instantly while the current
+    # one recompiles)
+    if s3_client and STALE_WHILE_REVALIDATE:
+        for song_slug, concert_key in asset_registry.variants(transposition, clef, S3_BUCKET):
+            cached_keys.setdefault(song_slug, []).append(concert_key)
+    elif s3_client:
+        # Only builds from the current Core/Include files count
+        include_hash = include_set_hash(LILYPOND_DATA_DIR / 'Include')
+        titles = {slugify(song['title']): song['title'] for song in db.get_all_songs()}
+        for asset in asset_registry.assets_for_variant(transposition, clef, S3_BUCKET):
+            song = asset['slug'] in titles and db.resolve_song_for_generation(titles[asset['slug']])
+            if not song or not is_current_build(asset, song, transposition, clef, include_hash):
+                continue
+            song_keys = cached_keys.setdefault(asset['slug'], [])
+            if asset['concert_key'] not in song_keys:
+                song_keys.append(asset['concert_key'])
 
     response = make_response(jsonify({
         'cached_keys': cached_keys,
@@ -670,42 +901,31 @@ def get_cached_keys(song_title):
     if clef not in VALID_CLEFS:
         clef = 'treble'
 
-    # Get default key from database
-    default_key, _ = db.get_song_default_key(song_title)
-
-    # Verify song exists
-    if not db.song_exists(song_title):
+    # Verify song exists; default key, source and core files come from the same lookup
+    song = db.resolve_song_for_generation(song_title)
+    if not song:
         return jsonify({'error': f'Song not found: {song_title}'}), 404
+    default_key = song.default_key
 
     cached_concert_keys = []
 
     # Check S3 for cached versions matching this transposition
     if s3_client:
         slug = slugify(song_title)
-        prefix = f"generated/{slug}-"
-
-        try:
-            response = s3_client.list_objects_v2(
-                Bucket=S3_BUCKET,
-                Prefix=prefix
-            )
+        source = song.source
+        s3_bucket = S3_CUSTOM_BUCKET if source == 'custom' else S3_BUCKET
 
-            for obj in response.get('Contents', []):
-                # Parse from filename: {slug}-{concert_key}-{transposition}-{clef}.pdf
-                filename = obj['Key'].replace(prefix, '').replace('.pdf', '')
-                parts = filename.split('-')
-                # Expected: [concert_key, transposition, clef]
-                if len(parts) >= 3:
-                    file_concert_key = parts[0]
-                    file_transposition = parts[1]
-                    file_clef = parts[2]
+        for asset in asset_registry.assets_for_slug(slug, s3_bucket):
+            # Filter by transposition and clef
+            if asset['transposition'] != transposition or asset['clef'] != clef:
+                continue
 
-                    # Filter by transposition and clef
-                    if file_transposition == transposition and file_clef == clef:
-                        cached_concert_keys.append(file_concert_key)
+            # Without stale-while-revalidate, only builds from the current Core/Include files count
+            if not STALE_WHILE_REVALIDATE and not is_current_build(asset, song, transposition, clef):
+                continue
 
-        except ClientError as e:
-            print(f"⚠️  Error listing cached keys: {e}")
+            if asset['concert_key'] not in cached_concert_keys:
+                cached_concert_keys.append(asset['concert_key'])
 
     return jsonify({
         'default_key': default_key,
@@ -713,37 +933,23 @@ def get_cached_keys(song_title):
     })
 
 
-@app.route('/api/v2/generate', methods=['POST'])
-@requires_auth
-@verify_firebase_token
-def generate_pdf():
-    """
-    Generate a PDF for any song in any concert key.
+def is_current_build(asset, song, transposition, clef, include_hash=None):
+    """Whether a registry asset was built from the song's current Core/Include files."""
+    if not song.core_files:
+        return False
+    return asset['key'] == chart_key(asset['slug'], song.core_files[0], song.source, asset['concert_key'],
+                                     transposition, clef, asset['octave_offset'], include_hash)
 
-    Request body:
-    {
-        "song": "502 Blues",           // Song title
-        "concert_key": "eb",           // Concert key (what the audience hears)
-        "transposition": "Bb",         // Instrument transposition: C, Bb, or Eb
-        "clef": "treble",              // "treble" or "bass"
-        "instrument_label": "Trumpet", // Optional label for PDF subtitle + auto-octave
-        "octave_offset": 0             // Optional: -2 to +2 (auto-calculated if omitted)
-    }
 
-    Returns:
-    {
-        "url": "https://s3.../502-blues-eb-Bb-treble-0.pdf",
-        "cached": true/false,
-        "generation_time_ms": 2340,
-        "octave_offset": 0             // The octave offset used (auto or provided)
-    }
+def parse_generate_request(data, default_priority=INTERACTIVE):
     """
-    start_time = time.time()
+    Validate a generate request body.
 
-    # Parse request
-    data = request.get_json()
+    Returns (params, None) on success or (None, (error_message, status)) on failure.
+    params is a plain dict so it can be queued and replayed outside the request.
+    """
     if not data:
-        return jsonify({'error': 'Request body must be JSON'}), 400
+        return None, ('Request body must be JSON', 400)
 
     song_title = data.get('song')
     concert_key = data.get('concert_key', '').lower()
@@ -752,232 +958,1050 @@ def generate_pdf():
     instrument_label = data.get('instrument_label', '').strip()
     octave_offset_provided = 'octave_offset' in data
     octave_offset = data.get('octave_offset', 0)
+    allow_stale = data.get('allow_stale', True) is not False
+    priority = data.get('priority', default_priority)
 
     # Validate inputs
     if not song_title:
-        return jsonify({'error': 'Missing required field: song'}), 400
+        return None, ('Missing required field: song', 400)
 
     if not concert_key:
-        return jsonify({'error': 'Missing required field: concert_key'}), 400
+        return None, ('Missing required field: concert_key', 400)
 
     if concert_key not in VALID_KEYS:
-        return jsonify({'error': f'Invalid concert_key. Must be one of: {", ".join(sorted(VALID_KEYS))}'}), 400
+        return None, (f'Invalid concert_key. Must be one of: {", ".join(sorted(VALID_KEYS))}', 400)
 
     if transposition not in VALID_TRANSPOSITIONS:
-        return jsonify({'error': f'Invalid transposition. Must be one of: {", ".join(VALID_TRANSPOSITIONS)}'}), 400
+        return None, (f'Invalid transposition. Must be one of: {", ".join(VALID_TRANSPOSITIONS)}', 400)
 
     if clef not in VALID_CLEFS:
-        return jsonify({'error': f'Invalid clef. Must be one of: {", ".join(VALID_CLEFS)}'}), 400
+        return None, (f'Invalid clef. Must be one of: {", ".join(VALID_CLEFS)}', 400)
 
     # Validate octave_offset
     try:
         octave_offset = int(octave_offset)
     except (ValueError, TypeError):
-        return jsonify({'error': 'octave_offset must be an integer'}), 400
+        return None, ('octave_offset must be an integer', 400)
 
     if octave_offset < -2 or octave_offset > 2:
-        return jsonify({'error': 'octave_offset must be between -2 and 2'}), 400
+        return None, ('octave_offset must be between -2 and 2', 400)
 
-    # Look up song in database
-    core_files = db.get_core_files(song_title)
-    if not core_files:
-        return jsonify({'error': f'Song not found: {song_title}'}), 404
+    if priority not in PRIORITIES:
+        return None, (f'Invalid priority. Must be one of: {", ".join(PRIORITIES)}', 400)
+
+    return {
+        'song': song_title,
+        'concert_key': concert_key,
+        'transposition': transposition,
+        'clef': clef,
+        'instrument_label': instrument_label,
+        'octave_offset': octave_offset,
+        'octave_offset_provided': octave_offset_provided,
+        'allow_stale': allow_stale,
+        'priority': priority,
+    }, None
 
-    # Use the first core file (most songs have exactly one)
-    core_file = core_files[0]
 
-    # Get song source (standard or custom)
-    source = db.get_song_source(song_title)
-    s3_bucket = S3_CUSTOM_BUCKET if source == 'custom' else S3_BUCKET
+# Generated asset keys: generated/{slug}-{concert_key}-{transposition}-{clef}-{octave}.{content_hash}.pdf
+# (keys from before content hashing have no hash part)
+GENERATED_KEY_RE = re.compile(
+    r'^generated/(?P<slug>.+)-(?P<concert_key>[a-z]+)-(?P<transposition>C|Bb|Eb)'
+    r'-(?P<clef>treble|bass)-(?P<octave_offset>-?\d)(?:\.(?P<hash>[0-9a-f]{16}))?\.pdf$'
+)
 
-    # Get current includeVersion for cache invalidation
-    include_version = db.get_include_version(source)
 
-    # Auto-calculate octave offset if not explicitly provided
-    if not octave_offset_provided and instrument_label:
-        octave_offset = calculate_optimal_octave(song_title, concert_key, instrument_label)
+def core_dir_for(source):
+    """Directory holding a song's Core files."""
+    return CUSTOM_CHARTS_DIR / 'Core' if source == 'custom' else LILYPOND_DATA_DIR / 'Core'
+
+
+def chart_key(slug, core_file, source, concert_key, transposition, clef, octave_offset, include_hash=None):
+    """
+    Content-addressed S3 key for a chart variant.
+
+    The hash covers the Core file contents, the Include set, the variant
+    parameters and the LilyPond version, so an existing object is always
+    current - no metadata check needed. The instrument label only changes
+    the subtitle and is left out, so instruments on the same variant share
+    a chart.
+    """
+    variant = (core_file, source, concert_key, transposition, clef, octave_offset)
+    digest = content_hash(core_dir_for(source) / core_file, LILYPOND_DATA_DIR / 'Include', variant, include_hash)
+    return f"generated/{slug}-{concert_key}-{transposition}-{clef}-{octave_offset}.{digest}.pdf"
+
+
+def parse_generated_key(key):
+    """Split a generated asset key into its parts (hash is None for pre-hash keys), or None."""
+    match = GENERATED_KEY_RE.match(key)
+    if not match:
+        return None
+    parsed = match.groupdict()
+    parsed['octave_offset'] = int(parsed['octave_offset'])
+    return parsed
+
+
+def find_cached_chart(s3_bucket, s3_key):
+    """
+    Look up a generated chart: asset registry first, then S3.
+
+    Keys are content-addressed, so existence is all that matters. A
+    registry hit needs no S3 call; head_object is only used for charts
+    this machine hasn't seen (uploaded elsewhere, or listed by a rebuild
+    without metadata). Returns (url, layout) on a hit, where layout is
+    chart_layout() of the stored metadata, or None on a miss.
+
+    While S3 is failing (breaker open, or this call can't reach it) every
+    chart is a miss: it compiles and is served from the local cache.
+    """
+    if not s3_client or s3_breaker.is_open():
+        return None
+
+    with metrics.stage('registry'):
+        asset = asset_registry.get(s3_key, s3_bucket)
+    if asset and asset['metadata_loaded']:
+        return presigned_url(s3_bucket, s3_key), chart_layout(asset['crop'], asset['crop_pages'],
+                                                              asset['page_sizes'], asset['page_count'])
+
+    try:
+        with metrics.stage('head_object'):
+            head_response = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+        metadata = head_response.get('Metadata', {})
+
+        # Retrieve crop and page metadata if available (S3 lowercases metadata keys)
+        def json_field(name):
+            try:
+                return json.loads(metadata[name]) if name in metadata else None
+            except ValueError:
+                return None
+
+        layout = chart_layout(json_field('crop'), json_field('croppages'), json_field('pagesizes'),
+                              json_field('pagecount'))
+
+        include_version = metadata.get('includeversion')
+        if asset:
+            asset_registry.update_metadata(s3_key, s3_bucket, include_version, layout['crop'], layout['crop_pages'],
+                                           layout['page_sizes'], layout['page_count'])
+        else:
+            asset_registry.register(s3_key, s3_bucket, parse_generated_key(s3_key), include_version, layout['crop'],
+                                    page_count=layout['page_count'], byte_size=head_response.get('ContentLength'),
+                                    crop_pages=layout['crop_pages'], page_sizes=layout['page_sizes'])
+
+        # Already exists - return presigned URL with crop and page metadata
+        return presigned_url(s3_bucket, s3_key), layout
+    except ClientError as e:
+        if e.response['Error']['Code'] != '404':
+            print(f"⚠️  S3 error checking cache: {e}")
+        elif asset:
+            asset_registry.remove(s3_key, s3_bucket)
+        # Not cached, continue to generate
+        return None
+    except BotoCoreError as e:
+        # Connection errors and timeouts: compile locally rather than fail the request
+        print(f"⚠️  S3 unreachable checking cache: {e}")
+        s3_breaker.record_failure()
+        return None
+
+
+def presigned_url(s3_bucket, s3_key):
+    """Short-lived download URL for a generated chart."""
+    with metrics.stage('presign'):
+        return s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': s3_bucket, 'Key': s3_key},
+            ExpiresIn=PRESIGNED_URL_TTL
+        )
+
+
+def generate_chart(params, wait_for_slot=False):
+    """
+    Resolve, compile and upload one chart.
+
+    Takes params from parse_generate_request(). Safe to call outside a request
+    (job queue workers use it). Returns (response_data, http_status).
+    Stage timings go to the caller's active metrics.StageTimer, if any.
+
+    A miss is refused with 429 when the compile queue is full, unless
+    wait_for_slot is set or the request is in a background lane
+    (prefetch, maintenance), which queue instead.
+    """
+    result, compile_miss = lookup_chart(params)
+    if compile_miss is None:
+        return result
+    return compile_miss(wait_for_slot)
+
+
+def lookup_chart(params):
+    """
+    Everything generate_chart does short of compiling: catalog lookup,
+    local cache, asset registry / S3, and a stale build to serve while
+    recompiling.
+
+    Returns ((response_data, http_status), None) when the request is
+    answered, or (None, compile_miss) on a miss, where
+    compile_miss(wait_for_slot=False, admitted=False) compiles the chart
+    and returns (response_data, http_status); admitted means the caller
+    already holds its compile gate ticket. Batch callers run lookups on the request
+    thread and only hand compiles to a pool, so hits never wait behind them.
+    """
+    start_time = time.time()
+
+    song_title = params['song']
+    concert_key = params['concert_key']
+    transposition = params['transposition']
+    clef = params['clef']
+    instrument_label = params['instrument_label']
+    octave_offset = params['octave_offset']
+
+    with metrics.stage('catalog'):
+        # Look up song in database (one memoized lookup per catalog version)
+        song = db.resolve_song_for_generation(song_title)
+        if not song or not song.core_files:
+            return ({'error': f'Song not found: {song_title}'}, 404), None
+
+        # Use the first core file (most songs have exactly one)
+        core_file = song.core_files[0]
+
+        # Get song source (standard or custom)
+        source = song.source
+        s3_bucket = S3_CUSTOM_BUCKET if source == 'custom' else S3_BUCKET
+
+        # includeVersion is reported to clients; cache identity comes from chart_key()
+        include_version = song.include_version
+
+        # Auto-calculate octave offset if not explicitly provided
+        if not params['octave_offset_provided'] and instrument_label:
+            octave_offset = calculate_optimal_octave(song, concert_key, instrument_label)
 
     # Calculate written key for LilyPond
     written_key = concert_to_written(concert_key, transposition)
 
-    # Generate S3 key: {slug}-{concert_key}-{transposition}-{clef}-{octave}.pdf
+    # Generate S3 key: {slug}-{concert_key}-{transposition}-{clef}-{octave}.{content_hash}.pdf
     slug = slugify(song_title)
-    s3_key = f"generated/{slug}-{concert_key}-{transposition}-{clef}-{octave_offset}.pdf"
+    file_base = f"{slug}-{concert_key}-{transposition}-{clef}-{octave_offset}"
+    with metrics.stage('cache_key'):
+        s3_key = chart_key(slug, core_file, source, concert_key, transposition, clef, octave_offset)
 
-    # Check if already cached in S3
-    if s3_client:
+    response_data = {
+        'octave_offset': octave_offset,
+        'includeVersion': include_version
+    }
+
+    def answer(result):
+        response_data.update(result)
+        drop_empty_layout(response_data)
+        response_data['generation_time_ms'] = int((time.time() - start_time) * 1000)
+        return response_data, 200
+
+    def lookup():
+        """Check the local cache, then S3. Returns {'url', 'cached', **chart_layout()} or None."""
+        with metrics.stage('local_cache'):
+            local = pdf_cache.get(s3_key)
+        if local:
+            return {'url': local_pdf_url(local, s3_bucket, s3_key), 'cached': True,
+                    **chart_layout(local['crop'], local['crop_pages'], local['page_sizes'])}
+
+        cached = find_cached_chart(s3_bucket, s3_key)
+        if cached:
+            url, layout = cached
+            # Keep a local copy so the next hit skips head_object
+            cache_fill_executor.submit(fill_local_cache, s3_bucket, s3_key, include_version, layout)
+            return {'url': url, 'cached': True, **layout}
+        return None
+
+    hit = lookup()
+    if hit:
+        metrics.inc('generate_cache_total', result='hit')
+        return answer(hit), None
+
+    # Miss: compile once even if identical requests (in the same lane) arrive concurrently
+    priority = params.get('priority', INTERACTIVE)
+
+    def compile_once(wait_for_slot=False, priority=priority, admitted=False):
+        # Another worker may have finished this chart while we waited for the lock
+        hit = lookup()
+        if hit:
+            return hit, 200
+
+        wrapper_content = generate_wrapper_content(core_file, written_key, clef, instrument_label, octave_offset,
+                                                   source, core_dir_for(source))
+        return compile_chart(wrapper_content, s3_bucket, s3_key, include_version,
+                             wait_for_slot or priority != INTERACTIVE, priority, admitted)
+
+    # An earlier build of this variant (before a Core/Include change) can be
+    # served right away while the current one compiles in the background
+    if STALE_WHILE_REVALIDATE and params.get('allow_stale', True):
+        with metrics.stage('stale_lookup'):
+            stale = find_stale_chart(s3_bucket, file_base, s3_key)
+        if stale:
+            metrics.inc('generate_cache_total', result='stale')
+            revalidate_in_background(s3_key, compile_once)
+            return answer(stale), None
+
+    metrics.inc('generate_cache_total', result='miss')
+
+    def compile_miss(wait_for_slot=False, admitted=False):
+        result, status = compile_flight.do(flight_key(s3_key, priority, wait_for_slot),
+                                           lambda: compile_once(wait_for_slot, admitted=admitted))
+        if status != 200:
+            return result, status
+        return answer(result)
+
+    return None, compile_miss
+
+
+def compile_chart(wrapper_content, s3_bucket, s3_key, include_version,
+                  wait_for_slot=False, priority=INTERACTIVE, admitted=False):
+    """
+    Run LilyPond on a wrapper, detect crop bounds and publish the PDF.
+
+    Everything happens in a private scratch directory (tmpfs when
+    available) that is removed on the way out, whatever the outcome.
+    With S3_WRITE_BEHIND the response carries a signed local URL and the
+    S3 upload happens in the background. admitted skips the compile gate
+    (the caller admitted a whole unit of charts, see generate_many).
+
+    Returns ({'url', 'cached', **chart_layout()}, 200), ({'error', 'retry_after'}, 429)
+    when the compile queue is full, or ({'error', ...}, 500).
+    """
+    with compile_sandbox() as sandbox:
         try:
-            head_response = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)
+            # Compile via the batching daemon into this request's sandbox,
+            # holding a ticket in the cross-process compile queue
+            lane = PRIORITIES[priority]
+            admission = nullcontext() if admitted else compile_gate.admit(lane, block=wait_for_slot)
+            with admission, metrics.stage('lilypond'):
+                result = lilypond_batcher.compile(wrapper_content, sandbox, lane)
+
+            # Check if PDF was created (LilyPond may return non-zero with warnings but still produce output)
+            if not result.ok:
+                # Actual failure - extract error lines
+                stderr_lines = result.stderr.split('\n')
+                error_summary = [line.strip() for line in stderr_lines if 'error:' in line.lower()][:5]
+                error_text = '\n'.join(error_summary) if error_summary else result.stderr[:500]
+                metrics.inc('compile_failures_total', reason='lilypond')
+
+                return {
+                    'error': 'LilyPond compilation failed',
+                    'details': error_text
+                }, 500
+
+            # Read the PDF once; crop detection, the local cache and the S3
+            # upload all work from this buffer
+            with metrics.stage('read_pdf'):
+                pdf_bytes = result.pdf_path.read_bytes()
+
+            # Page sizes and crop bounds for every page, captured before uploading
+            # (if available) so clients can lay out before the PDF arrives;
+            # page 1's bounds stay in 'crop' for older clients
+            layout = chart_layout()
+            if CROP_DETECTION_AVAILABLE:
+                try:
+                    with metrics.stage('crop'):
+                        page_layout = detect_page_layout(pdf_bytes)
+                    if page_layout:
+                        first = page_layout.bounds[0]
+                        layout = chart_layout(first.to_dict() if first else None, page_layout.crop_pages(),
+                                              page_layout.sizes)
+                except Exception as e:
+                    print(f"⚠️  Crop detection failed: {e}")
+
+            if PDF_OPTIMIZE and CROP_DETECTION_AVAILABLE:
+                with metrics.stage('optimize'):
+                    pdf_bytes = optimize_pdf(pdf_bytes)
+
+            write_behind = s3_client is not None and S3_WRITE_BEHIND
+            if write_behind:
+                # Answer from this machine now; the uploader pushes the PDF to S3
+                with metrics.stage('cache_put'):
+                    pdf_cache.put(s3_key, pdf_bytes, layout['crop'], include_version, pending_bucket=s3_bucket,
+                                  crop_pages=layout['crop_pages'], page_sizes=layout['page_sizes'])
+                s3_uploader.notify()
+                uploaded = False
+            else:
+                uploaded = (s3_client is not None and not s3_breaker.is_open()
+                            and upload_chart(pdf_bytes, s3_bucket, s3_key, include_version, layout))
+
+                # Keep a local copy; it is also what we serve when S3 is unavailable
+                with metrics.stage('cache_put'):
+                    pdf_cache.put(s3_key, pdf_bytes, layout['crop'], include_version, uploaded=uploaded,
+                                  crop_pages=layout['crop_pages'], page_sizes=layout['page_sizes'])
+
+            local = {'uploaded': uploaded, 'filename': pdf_cache.filename_for(s3_key)}
+            response_data = {'url': local_pdf_url(local, s3_bucket, s3_key), 'cached': False, **layout}
+            if not uploaded and not write_behind:
+                response_data['note'] = 'Local file (S3 not available)'
+            return response_data, 200
+
+        except CompileBusy as e:
+            metrics.inc('compile_rejections_total', priority=priority)
+            return {'error': 'Compile queue full, try again shortly', 'retry_after': e.retry_after}, 429
+        except subprocess.TimeoutExpired:
+            metrics.inc('compile_failures_total', reason='timeout')
+            return {'error': 'LilyPond compilation timed out (60s limit)'}, 500
+        except Exception as e:
+            metrics.inc('compile_failures_total', reason='error')
+            return {'error': f'Generation failed: {str(e)}'}, 500
+
 
-            # Check includeVersion for cache invalidation
-            metadata = head_response.get('Metadata', {})
-            cached_include_version = metadata.get('includeversion')  # S3 lowercases metadata keys
-
-            # If includeVersion doesn't match, regenerate
-            if include_version and cached_include_version != include_version:
-                print(f"🔄 Cache stale for {song_title}: includeVersion {cached_include_version} != {include_version}")
-                # Delete stale cache and continue to regenerate
-                s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
-                raise ClientError({'Error': {'Code': 'CacheStale'}}, 'head_object')
-
-            # Already exists and valid - return presigned URL with crop metadata
-            url = s3_client.generate_presigned_url(
-                'get_object',
-                Params={'Bucket': s3_bucket, 'Key': s3_key},
-                ExpiresIn=900
+def upload_chart(pdf_bytes, s3_bucket, s3_key, include_version, layout):
+    """Upload a compiled chart from memory (S3_WRITE_BEHIND=false). Returns True on success."""
+    try:
+        # Metadata with crop bounds, page sizes and includeVersion
+        s3_metadata = chart_metadata(layout['crop'], include_version, layout['crop_pages'], layout['page_sizes'])
+
+        with metrics.stage('upload'):
+            s3_client.put_object(
+                Bucket=s3_bucket,
+                Key=s3_key,
+                Body=pdf_bytes,
+                ContentType='application/pdf',
+                Metadata=s3_metadata
             )
-            generation_time = int((time.time() - start_time) * 1000)
+    except Exception as e:
+        print(f"⚠️  Failed to upload to S3: {e}")
+        # Fall through to local file serving
+        return False
 
-            # Retrieve crop metadata if available
-            crop = None
-            if 'crop' in metadata:
-                try:
-                    crop = json.loads(metadata['crop'])
-                except:
-                    pass
-
-            response_data = {
-                'url': url,
-                'cached': True,
-                'generation_time_ms': generation_time,
-                'octave_offset': octave_offset,
-                'includeVersion': include_version
-            }
-            if crop:
-                response_data['crop'] = crop
+    with metrics.stage('registry'):
+        register_uploaded_chart(pdf_bytes, len(pdf_bytes), s3_bucket, s3_key, include_version, layout)
+    return True
 
-            return jsonify(response_data)
-        except ClientError as e:
-            if e.response['Error']['Code'] not in ('404', 'CacheStale'):
-                print(f"⚠️  S3 error checking cache: {e}")
-            # Not cached or stale, continue to generate
 
-    # Create generated directory if needed
-    GENERATED_DIR.mkdir(parents=True, exist_ok=True)
+def register_uploaded_chart(pdf, byte_size, s3_bucket, s3_key, include_version, layout):
+    """
+    Record a chart that just landed in S3 in the asset registry.
 
-    # Generate wrapper file (use written_key for LilyPond, instrument_label for subtitle)
-    wrapper_content = generate_wrapper_content(core_file, written_key, clef, instrument_label, octave_offset, source)
+    pdf (bytes or path) is only opened when the layout has no page count.
+    """
+    page_count = layout['page_count']
+    if page_count is None and CROP_DETECTION_AVAILABLE:
+        page_count = get_page_count(pdf if isinstance(pdf, bytes) else str(pdf))
+    asset_registry.register(s3_key, s3_bucket, parse_generated_key(s3_key), include_version, layout['crop'],
+                            page_count=page_count, byte_size=byte_size, crop_pages=layout['crop_pages'],
+                            page_sizes=layout['page_sizes'])
 
-    # Local filename matches S3 key format
-    file_base = f"{slug}-{concert_key}-{transposition}-{clef}-{octave_offset}"
 
-    wrapper_filename = f"{file_base}.ly"
-    wrapper_path = GENERATED_DIR / wrapper_filename
-    pdf_path = GENERATED_DIR / f"{file_base}.pdf"
+def on_chart_uploaded(item):
+    """Write-behind uploader hook: register the chart once S3 has confirmed it."""
+    register_uploaded_chart(item['path'], item['size'], item['bucket'], item['key'], item['include_version'],
+                            chart_layout(item['crop'], item['crop_pages'], item['page_sizes']))
+
+
+def chart_layout(crop=None, crop_pages=None, page_sizes=None, page_count=None):
+    """
+    Page geometry returned with every generate response: page 1 crop,
+    per-page crops ([top, bottom, left, right]), page count and page
+    sizes ([width, height] in points). Lets clients lay out and sync
+    pages before the PDF bytes arrive.
+    """
+    if page_count is None and (page_sizes or crop_pages):
+        page_count = len(page_sizes or crop_pages)
+    return {'crop': crop, 'crop_pages': crop_pages, 'page_count': page_count, 'page_sizes': page_sizes}
+
+
+def drop_empty_layout(response_data):
+    """Leave layout fields out of a generate response when they are unknown."""
+    for field in ('crop', 'crop_pages', 'page_count', 'page_sizes'):
+        if not response_data.get(field):
+            response_data.pop(field, None)
+
 
+def local_pdf_url(entry, s3_bucket, s3_key):
+    """
+    URL for a local cache entry: presigned S3 if it was uploaded and S3 is
+    healthy, else a signed absolute link to this machine that expires like
+    a presigned URL would.
+    """
+    if entry['uploaded'] and s3_client and not s3_breaker.is_open():
+        return presigned_url(s3_bucket, s3_key)
+    expires = int(time.time()) + LOCAL_URL_TTL
+    path = f"/pdfs/{entry['filename']}?expires={expires}&sig={local_url_signature(entry['filename'], expires)}"
+    if MACHINE_ID:
+        path += f"&instance={MACHINE_ID}"
+    return absolute_url(path)
+
+
+def absolute_url(path):
+    """
+    Absolute URL for a path on this service: PUBLIC_BASE_URL, else the
+    current request's host. Outside a request without PUBLIC_BASE_URL the
+    path stays relative (get_job resolves it when the result is fetched).
+    """
+    if not path.startswith('/'):
+        return path
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL + path
+    if has_request_context():
+        return request.host_url.rstrip('/') + path
+    return path
+
+
+def local_url_signature(filename, expires):
+    return hmac.new(url_secret, f"{filename}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def fill_local_cache(s3_bucket, s3_key, include_version, layout):
+    """Copy an S3 hit into the local cache (runs in the background)."""
+    tmp_path = CACHE_DIR / f"fill-{os.getpid()}-{threading.get_ident()}.pdf.tmp"
     try:
-        # Write wrapper file
-        with open(wrapper_path, 'w') as f:
-            f.write(wrapper_content)
-
-        # Run LilyPond from lilypond-data directory so includes resolve correctly
-        result = subprocess.run(
-            ['lilypond', '-o', f'Generated/{file_base}', f'Generated/{wrapper_filename}'],
-            cwd=str(LILYPOND_DATA_DIR),
-            capture_output=True,
-            text=True,
-            timeout=60
-        )
+        s3_client.download_file(s3_bucket, s3_key, str(tmp_path))
+        pdf_cache.put(s3_key, tmp_path, layout['crop'], include_version, uploaded=True,
+                      crop_pages=layout['crop_pages'], page_sizes=layout['page_sizes'])
+    except Exception as e:
+        print(f"⚠️  Could not fill local cache for {s3_key}: {e}")
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
-        # Check if PDF was created (LilyPond may return non-zero with warnings but still produce output)
-        if not pdf_path.exists():
-            # Actual failure - extract error lines
-            stderr_lines = result.stderr.split('\n')
-            error_summary = [line.strip() for line in stderr_lines if 'error:' in line.lower()][:5]
-            error_text = '\n'.join(error_summary) if error_summary else result.stderr[:500]
-
-            return jsonify({
-                'error': 'LilyPond compilation failed',
-                'details': error_text
-            }), 500
-
-        # Detect crop bounds before uploading (if available)
-        crop = None
-        if CROP_DETECTION_AVAILABLE:
-            try:
-                crop_bounds = detect_bounds(str(pdf_path))
-                if crop_bounds:
-                    crop = crop_bounds.to_dict()
-            except Exception as e:
-                print(f"⚠️  Crop detection failed: {e}")
 
-        # Upload to S3 if available
-        if s3_client:
+def find_stale_chart(s3_bucket, file_base, s3_key):
+    """
+    Find the newest earlier build of a chart variant (any other content hash).
+
+    Checks the local cache, then the asset registry. Returns
+    {'url', 'cached', 'stale', **chart_layout()} or None.
+    """
+    prefix = f"generated/{file_base}."
+
+    latest = pdf_cache.find_latest(prefix, exclude=s3_key)
+    if latest:
+        old_key, entry = latest
+        return {'url': local_pdf_url(entry, s3_bucket, old_key), 'cached': True, 'stale': True,
+                **chart_layout(entry['crop'], entry['crop_pages'], entry['page_sizes'])}
+
+    if not s3_client:
+        return None
+
+    asset = asset_registry.find_latest(prefix, s3_bucket, exclude=s3_key)
+    if not asset:
+        return None
+
+    cached = find_cached_chart(s3_bucket, asset['key'])
+    if not cached:
+        return None
+    url, layout = cached
+    return {'url': url, 'cached': True, 'stale': True, **layout}
+
+
+def revalidate_in_background(s3_key, compile_once):
+    """Queue a background recompile for a chart that was just served stale."""
+    with revalidating_lock:
+        if s3_key in revalidating:
+            return
+        revalidating.add(s3_key)
+
+    def revalidate():
+        try:
+            result, status = compile_flight.do(flight_key(s3_key, MAINTENANCE),
+                                               lambda: compile_once(True, MAINTENANCE))
+            if status == 200:
+                metrics.inc('revalidations_total', result='ok')
+                print(f"♻️  Revalidated {s3_key}")
+            else:
+                metrics.inc('revalidations_total', result='failed')
+                print(f"⚠️  Revalidation failed for {s3_key}: {result.get('error')}")
+        finally:
+            with revalidating_lock:
+                revalidating.discard(s3_key)
+
+    revalidate_executor.submit(revalidate)
+
+
+# Stale-while-revalidate: serve the previous build while recompiling (bounded per process)
+STALE_WHILE_REVALIDATE = os.getenv('STALE_WHILE_REVALIDATE', 'true').lower() == 'true'
+SWR_MAX_RECOMPILES = int(os.getenv('SWR_MAX_RECOMPILES', '1'))
+revalidate_executor = ThreadPoolExecutor(max_workers=SWR_MAX_RECOMPILES, thread_name_prefix='revalidate')
+revalidating = set()  # Keys with a background recompile queued or running
+revalidating_lock = threading.Lock()
+
+# Background downloads of S3 hits into the local cache
+cache_fill_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-fill')
+
+# Write-behind uploads of fresh compiles (threads start on first use in each worker)
+s3_uploader = WriteBehindUploader(pdf_cache, s3_client, on_uploaded=on_chart_uploaded)
+
+# Identical concurrent compiles are coalesced on the S3 key (see flight_key)
+compile_flight = SingleFlight(LOCK_DIR)
+
+
+def flight_key(s3_key, priority, wait_for_slot=False):
+    """
+    Single-flight key for a compile: only callers admitted the same way share
+    one. An interactive request never waits behind a prefetch or maintenance
+    compile it could not hurry (nor loses its 429), and background work never
+    inherits an interactive 429; either may compile the chart a second time.
+    """
+    blocking = wait_for_slot or priority != INTERACTIVE
+    return f"{s3_key}#{priority}{'-wait' if blocking else ''}"
+
+# Global compile slots and bounded wait queue, shared by all gunicorn workers
+compile_gate = CompileGate(GATE_DB_PATH)
+
+# Long-lived compile daemon: concurrent misses share one LilyPond process
+lilypond_batcher = LilyPondBatcher(
+    [LILYPOND_DATA_DIR / 'Include', LILYPOND_DATA_DIR / 'Core', CUSTOM_CHARTS_DIR / 'Core'],
+    gate=compile_gate
+)
+
+
+def generate_chart_in_background(params):
+    """Job queue handler: background jobs wait for a compile slot instead of getting 429."""
+    return generate_chart(params, wait_for_slot=True)
+
+
+# Background generation queue (drained by worker threads in each gunicorn process).
+# Finished jobs are dropped a minute before the URLs in their results expire,
+# but kept at least a minute so a short LOCAL_URL_TTL can't beat the first poll.
+job_queue = JobQueue(QUEUE_DB_PATH, generate_chart_in_background,
+                     retention=max(60, min(PRESIGNED_URL_TTL, LOCAL_URL_TTL) - 60))
+
+# Pools for batch requests: misses compile here (lookups stay on the request thread).
+# Background lanes get their own smaller pool, so a large prefetch never holds
+# the threads an interactive batch or band needs.
+BATCH_WORKERS = int(os.getenv('GENERATE_BATCH_WORKERS', str(max(4, 2 * (os.cpu_count() or 1)))))
+PREFETCH_WORKERS = int(os.getenv('GENERATE_PREFETCH_WORKERS', str(os.cpu_count() or 1)))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='generate-batch')
+prefetch_executor = ThreadPoolExecutor(max_workers=max(1, PREFETCH_WORKERS), thread_name_prefix='generate-prefetch')
+lane_executors = {INTERACTIVE: batch_executor, PREFETCH: prefetch_executor, MAINTENANCE: prefetch_executor}
+
+
+def generate_many(param_list, as_unit=False):
+    """
+    Generate several charts concurrently.
+
+    Cache lookups run here on the request thread, and hits are yielded
+    first; only misses go to their lane's pool to compile. Yields (index,
+    response_data, http_status) in completion order, so callers can stream
+    each chart as soon as it is ready.
+
+    With as_unit, the misses are admitted to the compile gate together
+    (one request, however many charts): either all of them compile or all
+    get the same 429, so a band never loses one instrument to its own load.
+    """
+    misses = []
+    for i, params in enumerate(param_list):
+        try:
+            result, compile_miss = lookup_chart(params)
+        except Exception as e:
+            result, compile_miss = ({'error': f'Generation failed: {str(e)}'}, 500), None
+        if compile_miss is None:
+            yield (i, *result)
+        else:
+            misses.append((i, compile_miss))
+    if not misses:
+        return
+
+    with ExitStack() as admission:
+        if as_unit:
+            priority = param_list[misses[0][0]].get('priority', INTERACTIVE)
             try:
-                # Prepare metadata with crop bounds and includeVersion
-                s3_metadata = {}
-                if crop:
-                    s3_metadata['crop'] = json.dumps(crop)
-                if include_version:
-                    s3_metadata['includeVersion'] = include_version
-
-                extra_args = {'ContentType': 'application/pdf'}
-                if s3_metadata:
-                    extra_args['Metadata'] = s3_metadata
-
-                s3_client.upload_file(
-                    str(pdf_path),
-                    s3_bucket,
-                    s3_key,
-                    ExtraArgs=extra_args
-                )
-
-                # Generate presigned URL
-                url = s3_client.generate_presigned_url(
-                    'get_object',
-                    Params={'Bucket': s3_bucket, 'Key': s3_key},
-                    ExpiresIn=900
-                )
-
-                # Clean up local files
-                wrapper_path.unlink(missing_ok=True)
-                pdf_path.unlink(missing_ok=True)
-
-                generation_time = int((time.time() - start_time) * 1000)
-                response_data = {
-                    'url': url,
-                    'cached': False,
-                    'generation_time_ms': generation_time,
-                    'octave_offset': octave_offset,
-                    'includeVersion': include_version
-                }
-                if crop:
-                    response_data['crop'] = crop
-
-                return jsonify(response_data)
-            except Exception as e:
-                print(f"⚠️  Failed to upload to S3: {e}")
-                # Fall through to local file serving
-
-        # No S3 - serve from local file (development mode)
-        generation_time = int((time.time() - start_time) * 1000)
-        response_data = {
-            'url': f'/generated/{pdf_path.name}',
-            'cached': False,
-            'generation_time_ms': generation_time,
-            'octave_offset': octave_offset,
-            'includeVersion': include_version,
-            'note': 'Local file (S3 not available)'
+                admission.enter_context(compile_gate.admit(
+                    PRIORITIES[priority], block=priority != INTERACTIVE, charts=len(misses)
+                ))
+            except CompileBusy as e:
+                metrics.inc('compile_rejections_total', priority=priority)
+                for i, _ in misses:
+                    yield i, {'error': 'Compile queue full, try again shortly', 'retry_after': e.retry_after}, 429
+                return
+
+        futures = {
+            lane_executors[param_list[i].get('priority', INTERACTIVE)].submit(
+                metrics.bind_timer(compile_miss), admitted=as_unit
+            ): i
+            for i, compile_miss in misses
         }
-        if crop:
-            response_data['crop'] = crop
+        for future in as_completed(futures):
+            try:
+                response_data, status = future.result()
+            except Exception as e:
+                response_data, status = {'error': f'Generation failed: {str(e)}'}, 500
+            if 'url' in response_data:
+                response_data['url'] = absolute_url(response_data['url'])  # Compiled off the request thread
+            yield futures[future], response_data, status
 
-        return jsonify(response_data)
 
-    except subprocess.TimeoutExpired:
-        return jsonify({'error': 'LilyPond compilation timed out (60s limit)'}), 500
-    except Exception as e:
-        return jsonify({'error': f'Generation failed: {str(e)}'}), 500
-    finally:
-        # Clean up wrapper file
-        if wrapper_path.exists():
-            wrapper_path.unlink(missing_ok=True)
+@app.route('/api/v2/generate', methods=['POST'])
+@requires_auth
+@verify_firebase_token
+@timed_stages
+def generate_pdf():
+    """
+    Generate a PDF for any song in any concert key.
 
+    Request body:
+    {
+        "song": "502 Blues",           // Song title
+        "concert_key": "eb",           // Concert key (what the audience hears)
+        "transposition": "Bb",         // Instrument transposition: C, Bb, or Eb
+        "clef": "treble",              // "treble" or "bass"
+        "instrument_label": "Trumpet", // Optional label for PDF subtitle + auto-octave
+        "octave_offset": 0,            // Optional: -2 to +2 (auto-calculated if omitted)
+        "allow_stale": true,           // Optional: accept an earlier build while this one recompiles
+        "priority": "interactive",     // Optional: interactive, prefetch or maintenance
+        "async": false                 // Optional: queue the job and return a job id
+    }
+
+    Returns:
+    {
+        "url": "https://s3.../502-blues-eb-Bb-treble-0.pdf",
+        "cached": true/false,
+        "stale": true,                 // Only present when an earlier build was served
+        "generation_time_ms": 2340,
+        "octave_offset": 0             // The octave offset used (auto or provided)
+    }
+
+    The Server-Timing header breaks the request into stages (catalog,
+    local_cache, registry, head_object, lilypond, crop, upload, presign, ...).
+
+    A cache miss while the compile queue is full returns 429 with a
+    Retry-After header (and "retry_after" in the body). Hits never wait.
+    Prefetch and maintenance requests wait behind interactive ones instead.
+
+    With "async": true, returns 202 immediately:
+    {
+        "job_id": "9f1c...",
+        "status": "queued",
+        "status_url": "/api/v2/jobs/9f1c..."
+    }
+    """
+    data = request.get_json(silent=True)
+    params, error = parse_generate_request(data)
+    if error:
+        message, status = error
+        return jsonify({'error': message}), status
+
+    if data.get('async'):
+        job_id = job_queue.enqueue(params, PRIORITIES[params['priority']])
+        return jsonify({
+            'job_id': job_id,
+            'status': 'queued',
+            'status_url': f'/api/v2/jobs/{job_id}'
+        }), 202
+
+    response_data, status = generate_chart(params)
+    metrics.observe('generate_seconds', g.stage_timer.total())
+
+    response = jsonify(response_data)
+    if status == 429:
+        response.headers['Retry-After'] = str(response_data['retry_after'])
+    return response, status
+
+
+@app.route('/api/v2/generate/batch', methods=['POST'])
+@requires_auth
+@verify_firebase_token
+@timed_stages
+def generate_batch():
+    """
+    Generate many charts in one request (setlists, multi-key prefetch).
 
-@app.route('/generated/<path:filename>')
+    Request body:
+    {
+        "items": [                     // Same fields as /api/v2/generate
+            {"song": "502 Blues", "concert_key": "eb", "transposition": "Bb", "clef": "treble", "octave_offset": 0},
+            ...
+        ],
+        "stream": false,               // Optional: emit NDJSON lines as charts are ready
+        "priority": "prefetch"         // Optional: default lane for items (items may override)
+    }
+
+    Batches default to the prefetch lane: their compiles queue behind
+    interactive requests instead of being refused with 429.
+
+    Returns:
+    {
+        "items": [
+            {"index": 0, "status": 200, "url": "...", "cached": true, "octave_offset": 0, ...},
+            {"index": 1, "status": 404, "error": "Song not found: ..."},
+            ...
+        ],
+        "total": 2,
+        "generation_time_ms": 4120
+    }
+
+    Streaming mode (also selected by Accept: application/x-ndjson) writes one
+    item object per line in completion order instead.
+    """
+    start_time = time.time()
+
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Request body must include a non-empty items list'}), 400
+
+    if len(items) > MAX_BATCH_ITEMS:
+        return jsonify({'error': f'Too many items. Maximum is {MAX_BATCH_ITEMS}'}), 400
+
+    default_priority = data.get('priority', PREFETCH)
+    if default_priority not in PRIORITIES:
+        return jsonify({'error': f'Invalid priority. Must be one of: {", ".join(PRIORITIES)}'}), 400
+
+    # Validate every item up front; invalid ones are reported, not generated
+    results = []
+    valid = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({'index': i, 'status': 400, 'error': 'Item must be a JSON object'})
+            continue
+        params, error = parse_generate_request(item, default_priority)
+        if error:
+            message, status = error
+            results.append({'index': i, 'status': status, 'error': message})
+        else:
+            valid.append((i, params))
+
+    def items_as_ready():
+        yield from results
+        indices = [i for i, _ in valid]
+        for n, response_data, status in generate_many([params for _, params in valid]):
+            yield {'index': indices[n], 'status': status, **response_data}
+
+    stream = data.get('stream') or 'application/x-ndjson' in request.headers.get('Accept', '')
+    if stream:
+        def ndjson():
+            for item in items_as_ready():
+                yield json.dumps(item) + '\n'
+        return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
+
+    manifest = sorted(items_as_ready(), key=lambda item: item['index'])
+    return jsonify({
+        'items': manifest,
+        'total': len(manifest),
+        'generation_time_ms': int((time.time() - start_time) * 1000)
+    })
+
+
+@app.route('/api/v2/generate/band', methods=['POST'])
+@requires_auth
+@verify_firebase_token
+@timed_stages
+def generate_band():
+    """
+    Generate one song in one concert key for every instrument in a band.
+
+    Each instrument's transposition, clef and optimal octave are resolved in
+    one pass. Instruments that share a variant (e.g. Trumpet and Tenor Sax
+    are both Bb treble) share a single compile.
+
+    Request body:
+    {
+        "song": "502 Blues",
+        "concert_key": "eb",
+        "instruments": ["Trumpet", "Tenor Sax", "Bass"]  // Labels from INSTRUMENTS
+    }
+
+    Returns:
+    {
+        "charts": {
+            "Trumpet": {"url": "...", "cached": true, "transposition": "Bb", "clef": "treble", "octave_offset": 0, ...},
+            "Bass": {"url": "...", ...},
+            "Kazoo": {"status": 400, "error": "Unknown instrument: Kazoo"}
+        },
+        "variants": 2,                 // Distinct charts generated
+        "generation_time_ms": 3120
+    }
+    """
+    start_time = time.time()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Request body must be JSON'}), 400
+
+    song_title = data.get('song')
+    concert_key = data.get('concert_key', '').lower()
+    instruments = data.get('instruments')
+
+    if not song_title:
+        return jsonify({'error': 'Missing required field: song'}), 400
+
+    if concert_key not in VALID_KEYS:
+        return jsonify({'error': f'Invalid concert_key. Must be one of: {", ".join(sorted(VALID_KEYS))}'}), 400
+
+    if not isinstance(instruments, list) or not instruments:
+        return jsonify({'error': 'Missing required field: instruments'}), 400
+
+    if len(instruments) > MAX_BAND_INSTRUMENTS:
+        return jsonify({'error': f'Too many instruments. Maximum is {MAX_BAND_INSTRUMENTS}'}), 400
+
+    # One catalog read for the whole band
+    song = db.resolve_song_for_generation(song_title)
+    if not song:
+        return jsonify({'error': f'Song not found: {song_title}'}), 404
+
+    charts = {}
+    variants = {}  # (transposition, clef, octave) -> (params, [instrument labels])
+    for label in instruments:
+        instrument = INSTRUMENTS.get(label)
+        if not instrument:
+            charts[label] = {'status': 400, 'error': f'Unknown instrument: {label}'}
+            continue
+
+        octave_offset = calculate_optimal_octave(song, concert_key, label)
+        variant = (instrument['transposition'], instrument['clef'], octave_offset)
+        if variant not in variants:
+            params = {
+                'song': song_title,
+                'concert_key': concert_key,
+                'transposition': instrument['transposition'],
+                'clef': instrument['clef'],
+                'instrument_label': label,  # Subtitle comes from the first member on this variant
+                'octave_offset': octave_offset,
+                'octave_offset_provided': True,
+                'priority': INTERACTIVE,
+            }
+            variants[variant] = (params, [])
+        variants[variant][1].append(label)
+
+    variant_list = list(variants.values())
+    for i, response_data, status in generate_many([params for params, _ in variant_list], as_unit=True):
+        params, labels = variant_list[i]
+        for label in labels:
+            charts[label] = {
+                'status': status,
+                'transposition': params['transposition'],
+                'clef': params['clef'],
+                'written_key': concert_to_written(concert_key, params['transposition']),
+                **response_data
+            }
+
+    return jsonify({
+        'song': song_title,
+        'concert_key': concert_key,
+        'charts': charts,
+        'variants': len(variant_list),
+        'generation_time_ms': int((time.time() - start_time) * 1000)
+    })
+
+
+@app.route('/api/v2/jobs/<job_id>')
+@requires_auth
+@verify_firebase_token
+def get_job(job_id):
+    """
+    Get the status of a queued generation job.
+
+    Query params:
+        wait: Optional long-poll timeout in seconds (max 30). Returns as soon as
+              the job finishes, or with its current status when the timeout expires.
+
+    Finished jobs are reported until shortly before the URL in their result
+    expires; after that the job is gone (404) and should be resubmitted.
+
+    Returns:
+    {
+        "job_id": "9f1c...",
+        "status": "queued" | "running" | "done" | "failed",
+        "position": 2,                 // Jobs ahead (queued only)
+        "http_status": 404,            // Status generate would have returned (failed only)
+        ...                            // Generate response fields once finished
+    }
+    """
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return jsonify({'error': 'wait must be a number'}), 400
+    wait = max(0.0, min(wait, MAX_JOB_WAIT))
+
+    # Make sure this process is draining the queue too
+    job_queue.start()
+
+    job = job_queue.wait(job_id, wait) if wait else job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Job not found: {job_id}'}), 404
+
+    response_data = {'job_id': job['job_id'], 'status': job['status']}
+    if 'position' in job:
+        response_data['position'] = job['position']
+    if job['result']:
+        response_data.update(job['result'])
+        if 'url' in response_data:
+            response_data['url'] = absolute_url(response_data['url'])
+    if job['status'] == 'failed':
+        response_data['http_status'] = job['http_status']
+
+    return jsonify(response_data)
+
+
+@app.route('/api/v2/registry/rebuild', methods=['POST'])
+@requires_auth
+def rebuild_registry_endpoint():
+    """Re-list generated assets in S3 into the asset registry."""
+    if not s3_client:
+        return jsonify({'error': 'S3 not configured'}), 400
+
+    try:
+        found = rebuild_asset_registry()
+    except (ClientError, BotoCoreError) as e:
+        return jsonify({'error': f'Could not list S3: {e}'}), 502
+    if found is None:
+        return jsonify({'error': 'Rebuild already in progress'}), 409
+    return jsonify({'assets': found, 'registered': asset_registry.count()})
+
+
+def rebuild_asset_registry():
+    """
+    Rebuild the asset registry from S3 listings.
+
+    Only one worker rebuilds at a time (flock on a shared lock file).
+    Returns the number of assets found, or None if another rebuild holds
+    the lock. S3 errors are logged and raised; the registry is unchanged.
+    """
+    LOCK_DIR.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_DIR / 'asset-registry-rebuild.lock', 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        start = time.time()
+        try:
+            found = asset_registry.rebuild_from_s3(
+                s3_client, list(dict.fromkeys([S3_BUCKET, S3_CUSTOM_BUCKET])), parse_generated_key
+            )
+        except (ClientError, BotoCoreError) as e:
+            print(f"⚠️  Asset registry rebuild failed: {e}")
+            raise
+        print(f"🗂️  Asset registry rebuilt: {found} assets ({time.time() - start:.1f}s)")
+        return found
+
+
+@app.route('/pdfs/<filename>')
+def serve_cached_pdf(filename):
+    """
+    Serve a PDF from the local cache: fresh compiles not yet uploaded to
+    S3, and everything in dev mode. Links are signed by local_pdf_url();
+    one naming another machine is replayed there if the file isn't here.
+    """
+    if not filename.endswith('.pdf'):
+        return jsonify({'error': 'Not found'}), 404
+    try:
+        expires = int(request.args.get('expires', ''))
+    except ValueError:
+        return jsonify({'error': 'Link missing or malformed'}), 403
+    if expires < time.time() or not hmac.compare_digest(
+            request.args.get('sig', ''), local_url_signature(filename, expires)):
+        return jsonify({'error': 'Link expired or invalid'}), 403
+    instance = request.args.get('instance')
+    if instance and instance != MACHINE_ID and not (pdf_cache.root / filename).exists():
+        # Fly's proxy re-sends the request to the machine that built the chart
+        return Response(status=409, headers={'fly-replay': f'instance={instance}'})
+    return send_from_directory(str(pdf_cache.root.resolve()), filename, mimetype='application/pdf')
+
+
+@app.route('/generated/<filename>')
 def serve_generated(filename):
-    """Serve locally generated PDFs (development mode only)."""
-    return send_from_directory(str(GENERATED_DIR), filename, mimetype='application/pdf')
+    """
+    Links handed out in dev mode before compiles moved to sandboxes
+    (/generated/{slug}-{key}-{transposition}-{clef}-{octave}.pdf). Redirects
+    to the newest local build of that variant, or 404 so the client
+    generates it again.
+    """
+    if not filename.endswith('.pdf'):
+        return jsonify({'error': 'Not found'}), 404
+    found = pdf_cache.find_latest(f"generated/{filename[:-len('.pdf')]}.")
+    if not found:
+        return jsonify({'error': 'Chart not found, generate it again'}), 404
+    key, entry = found
+    return redirect(local_pdf_url({**entry, 'uploaded': False}, None, key))
 
 
 def validate_startup():
@@ -987,11 +2011,21 @@ def validate_startup():
     # Initialize catalog database
     try:
         init_catalog_db()
+        if CATALOG_RELOAD_INTERVAL > 0:
+            threading.Thread(target=watch_catalog, name='catalog-watcher', daemon=True).start()
     except FileNotFoundError:
         errors.append(f"{DB_FILE} not found. Run build_catalog.py first!")
     except Exception as e:
         errors.append(f"Failed to load catalog database: {e}")
 
+    # LilyPond version is part of every chart's cache key
+    print(f"🎼 {lilypond_version()}")
+
+    # Compile sandboxes orphaned by killed workers
+    removed = sweep_sandboxes()
+    if removed:
+        print(f"🧹 Removed {removed} stale compile sandbox(es)")
+
     # Validate S3 configuration if enabled
     if USE_S3:
         if not s3_client:
@@ -1010,6 +2044,20 @@ def validate_startup():
                 else:
                     print(f"⚠️  Warning: Could not verify S3 bucket access: {e}")
 
+            # Uploads queued before a restart
+            if pdf_cache.stats()['pending_uploads']:
+                s3_uploader.start()
+
+            # Fresh disk (e.g. after a deploy): relist S3 in the background
+            if asset_registry.count() == 0:
+                def rebuild_in_background():
+                    try:
+                        rebuild_asset_registry()
+                    except (ClientError, BotoCoreError):
+                        pass  # Logged; lookups fall back to head_object until the next rebuild
+
+                threading.Thread(target=rebuild_in_background, name='registry-rebuild', daemon=True).start()
+
     # Check for required environment variables in production
     if os.getenv('PORT'):  # Assume production if PORT env var is set
         if USE_S3 and not os.getenv('AWS_ACCESS_KEY_ID'):
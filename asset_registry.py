@@ -0,0 +1,308 @@
+"""
+Local registry of generated chart assets stored in S3.
+
+Replaces per-request S3 head_object calls and bucket listings with a SQLite
+lookup. Rows are written whenever a chart is uploaded and can be rebuilt
+from an S3 listing (e.g. after a deploy wipes the machine's disk).
+
+Lookups are reads on a per-thread connection. Hit counts and access times
+are kept in memory and written in one transaction every
+HIT_FLUSH_SECONDS, so a cache hit never takes the SQLite write lock.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+REGISTRY_DB_PATH = Path(os.getenv('ASSET_REGISTRY_DB', 'assets.db'))  # Next to catalog.db
+HIT_FLUSH_SECONDS = 30  # How often buffered hit counts are written
+
+
+class AssetRegistry:
+    """
+    One row per generated asset and bucket: key, variant params, include
+    version, crop bounds, page count, size, and access stats. The standard
+    and custom buckets can hold the same key, so rows are identified by
+    (bucket, key).
+
+    Rows rebuilt from a listing have metadata_loaded = 0 until their S3
+    metadata (crop, includeVersion) is fetched on first use.
+    """
+
+    def __init__(self, db_path=REGISTRY_DB_PATH, flush_interval=HIT_FLUSH_SECONDS):
+        self.db_path = Path(db_path)
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._hits = Counter()  # (bucket, key) -> hits not yet written
+        self._last_access = {}  # (bucket, key) -> latest hit time not yet written
+        self._hits_lock = threading.Lock()
+        self._next_flush = time.monotonic() + flush_interval
+        self._init_schema()
+        atexit.register(self.flush_hits)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _thread_connection(self):
+        """This thread's long-lived connection (reopened in a forked worker)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def _init_schema(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS assets (
+                    key TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    slug TEXT,
+                    concert_key TEXT,
+                    transposition TEXT,
+                    clef TEXT,
+                    octave_offset INTEGER,
+                    content_hash TEXT,
+                    include_version TEXT,
+                    crop TEXT,
+                    page_count INTEGER,
+                    byte_size INTEGER,
+                    metadata_loaded INTEGER NOT NULL DEFAULT 1,
+                    created_at REAL NOT NULL,
+                    last_access REAL,
+                    hit_count INTEGER NOT NULL DEFAULT 0,
+                    crop_pages TEXT,
+                    page_sizes TEXT,
+                    PRIMARY KEY (bucket, key)
+                );
+                CREATE INDEX IF NOT EXISTS idx_assets_variant ON assets(transposition, clef);
+                CREATE INDEX IF NOT EXISTS idx_assets_slug ON assets(slug);
+            """)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _row_to_dict(row):
+        asset = dict(row)
+        asset['crop'] = json.loads(row['crop']) if row['crop'] else None
+        asset['crop_pages'] = json.loads(row['crop_pages']) if row['crop_pages'] else None
+        asset['page_sizes'] = json.loads(row['page_sizes']) if row['page_sizes'] else None
+        asset['metadata_loaded'] = bool(row['metadata_loaded'])
+        return asset
+
+    def register(self, key, bucket, parsed, include_version=None, crop=None,
+                 page_count=None, byte_size=None, metadata_loaded=True, created_at=None, crop_pages=None,
+                 page_sizes=None):
+        """
+        Insert or replace an asset row. parsed comes from parse_generated_key();
+        crop_pages is the compact per-page list ([top, bottom, left, right] or None)
+        and page_sizes a [width, height] per page.
+        """
+        parsed = parsed or {}
+        conn = self._connect()
+        try:
+            conn.execute(
+                """INSERT OR REPLACE INTO assets
+                   (key, bucket, slug, concert_key, transposition, clef, octave_offset, content_hash,
+                    include_version, crop, page_count, byte_size, metadata_loaded, created_at,
+                    last_access, hit_count, crop_pages, page_sizes)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,
+                           (SELECT last_access FROM assets WHERE key = ? AND bucket = ?),
+                           COALESCE((SELECT hit_count FROM assets WHERE key = ? AND bucket = ?), 0), ?, ?)""",
+                (key, bucket, parsed.get('slug'), parsed.get('concert_key'), parsed.get('transposition'),
+                 parsed.get('clef'), parsed.get('octave_offset'), parsed.get('hash'),
+                 include_version, json.dumps(crop) if crop else None, page_count, byte_size,
+                 int(metadata_loaded), created_at or time.time(), key, bucket, key, bucket,
+                 json.dumps(crop_pages) if crop_pages else None,
+                 json.dumps(page_sizes) if page_sizes else None)
+            )
+        finally:
+            conn.close()
+
+    def get(self, key, bucket, touch=True):
+        """Look up an asset (counting a hit unless touch=False). Returns dict or None."""
+        row = self._thread_connection().execute(
+            "SELECT * FROM assets WHERE key = ? AND bucket = ?", (key, bucket)
+        ).fetchone()
+        if not row:
+            return None
+
+        with self._hits_lock:
+            if touch:
+                self._hits[bucket, key] += 1
+                self._last_access[bucket, key] = time.time()
+            pending = self._hits.get((bucket, key), 0)
+        if touch and time.monotonic() >= self._next_flush:
+            self.flush_hits()
+
+        asset = self._row_to_dict(row)
+        asset['hit_count'] += pending
+        return asset
+
+    def flush_hits(self):
+        """Write buffered hit counts and access times (runs every flush_interval, and at exit)."""
+        with self._hits_lock:
+            hits, self._hits = self._hits, Counter()
+            last_access, self._last_access = self._last_access, {}
+            self._next_flush = time.monotonic() + self.flush_interval
+        if not hits or not self.db_path.exists():
+            return  # Nothing to write, or the registry was deleted under us
+
+        try:
+            conn = self._connect()
+            try:
+                with conn:  # One transaction for the batch
+                    conn.execute("BEGIN IMMEDIATE")
+                    conn.executemany(
+                        "UPDATE assets SET hit_count = hit_count + ?, last_access = ? WHERE bucket = ? AND key = ?",
+                        [(n, last_access[bucket_key], *bucket_key) for bucket_key, n in hits.items()]
+                    )
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            print(f"⚠️  Could not record asset hits: {e}")
+
+    def update_metadata(self, key, bucket, include_version, crop, crop_pages=None, page_sizes=None,
+                        page_count=None):
+        """Fill in S3 metadata for a row that came from a listing."""
+        conn = self._connect()
+        try:
+            conn.execute(
+                """UPDATE assets SET include_version = ?, crop = ?, crop_pages = ?, page_sizes = ?,
+                   metadata_loaded = 1, page_count = COALESCE(?, page_count) WHERE key = ? AND bucket = ?""",
+                (include_version, json.dumps(crop) if crop else None,
+                 json.dumps(crop_pages) if crop_pages else None,
+                 json.dumps(page_sizes) if page_sizes else None, page_count, key, bucket)
+            )
+        finally:
+            conn.close()
+
+    def remove(self, key, bucket):
+        """Forget an asset (e.g. it turned out to be missing from S3)."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM assets WHERE key = ? AND bucket = ?", (key, bucket))
+        finally:
+            conn.close()
+
+    def find_latest(self, prefix, bucket, exclude=None):
+        """Newest asset whose key starts with prefix (other than exclude), or None."""
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                """SELECT * FROM assets WHERE key >= ? AND key < ? AND key != ? AND bucket = ?
+                   ORDER BY created_at DESC LIMIT 1""",
+                (prefix, prefix + '\uffff', exclude or '', bucket)
+            ).fetchone()
+        finally:
+            conn.close()
+        return self._row_to_dict(row) if row else None
+
+    def variants(self, transposition, clef, bucket):
+        """(slug, concert_key) pairs with a stored build for a transposition/clef."""
+        conn = self._connect()
+        try:
+            return [
+                (row['slug'], row['concert_key'])
+                for row in conn.execute(
+                    """SELECT DISTINCT slug, concert_key FROM assets
+                       WHERE transposition = ? AND clef = ? AND bucket = ? ORDER BY slug""",
+                    (transposition, clef, bucket)
+                )
+            ]
+        finally:
+            conn.close()
+
+    def assets_for_variant(self, transposition, clef, bucket):
+        """All stored builds for a transposition/clef (key, slug, concert_key, octave_offset)."""
+        conn = self._connect()
+        try:
+            return [
+                dict(row)
+                for row in conn.execute(
+                    """SELECT key, slug, concert_key, octave_offset FROM assets
+                       WHERE transposition = ? AND clef = ? AND bucket = ? ORDER BY slug""",
+                    (transposition, clef, bucket)
+                )
+            ]
+        finally:
+            conn.close()
+
+    def assets_for_slug(self, slug, bucket):
+        """All stored builds of one song."""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT * FROM assets WHERE slug = ? AND bucket = ?", (slug, bucket)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [self._row_to_dict(row) for row in rows]
+
+    def count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM assets").fetchone()[0]
+        finally:
+            conn.close()
+
+    def rebuild_from_s3(self, s3_client, buckets, parse_key, prefix='generated/'):
+        """
+        Re-register every generated object in the given buckets.
+
+        Uses the listing only (key, size, LastModified); crop and
+        includeVersion are loaded lazily on first hit. Rows for objects
+        no longer in their bucket are dropped (rows of buckets not listed
+        are left alone). Returns the number of assets found.
+        """
+        seen = []
+        for bucket in buckets:
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+                for obj in page.get('Contents', []):
+                    parsed = parse_key(obj['Key'])
+                    if not parsed:
+                        continue
+                    seen.append((obj['Key'], bucket, parsed, obj['Size'], obj['LastModified'].timestamp()))
+
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            known = {
+                (row['bucket'], row['key'])
+                for row in conn.execute(
+                    f"SELECT bucket, key FROM assets WHERE bucket IN ({', '.join('?' * len(buckets))})", buckets
+                )
+            }
+            listed = set()
+            for key, bucket, parsed, size, modified in seen:
+                listed.add((bucket, key))
+                if (bucket, key) in known:
+                    continue  # Keep existing metadata and access stats
+                conn.execute(
+                    """INSERT INTO assets
+                       (key, bucket, slug, concert_key, transposition, clef, octave_offset, content_hash,
+                        byte_size, metadata_loaded, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)""",
+                    (key, bucket, parsed['slug'], parsed['concert_key'], parsed['transposition'],
+                     parsed['clef'], parsed['octave_offset'], parsed.get('hash'), size, modified)
+                )
+            for bucket, key in known - listed:
+                conn.execute("DELETE FROM assets WHERE key = ? AND bucket = ?", (key, bucket))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        return len(seen)
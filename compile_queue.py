@@ -0,0 +1,274 @@
+"""
+SQLite-backed job queue for chart generation.
+
+Lets /api/v2/generate hand LilyPond work to a small pool of background
+threads instead of compiling inside the request. Jobs live in a local
+SQLite file so any gunicorn worker can enqueue, drain or report on them -
+no external broker needed.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# Queue configuration
+QUEUE_DB_PATH = Path(os.getenv('JOB_QUEUE_DB', 'cache/jobs.db'))
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '1'))  # Compile threads per process
+JOB_LEASE_SECONDS = 180     # Running jobs not renewed for this long are assumed orphaned
+JOB_RETENTION_SECONDS = 3600  # Finished jobs are kept this long for status polls
+POLL_INTERVAL = 0.25        # Seconds between checks for cross-process updates
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class JobQueue:
+    """
+    Durable queue of generation jobs with a bounded pool of worker threads.
+
+    Jobs run by priority (lower first), oldest first within a priority.
+
+    handler(params) must return (response_data, http_status). A job is
+    'done' when the handler returns 200, otherwise 'failed'. Its lease is
+    renewed while the handler runs, so only jobs of a dead worker are
+    re-claimed. Finished jobs are reported for `retention` seconds (keep
+    it below the lifetime of any URLs in their results).
+    """
+
+    def __init__(self, db_path, handler, workers=JOB_WORKERS,
+                 lease_seconds=JOB_LEASE_SECONDS, retention=JOB_RETENTION_SECONDS):
+        self.db_path = Path(db_path)
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.lease_seconds = lease_seconds
+        self.retention = retention
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+        self._init_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_schema(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    http_status INTEGER,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    lease_expires REAL,
+                    priority INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_jobs_priority ON jobs(status, priority, created_at);
+            """)
+        finally:
+            conn.close()
+
+    def start(self):
+        """Start worker threads for this process (idempotent)."""
+        with self._start_lock:
+            if self._stopping.is_set():
+                return
+            # gunicorn forks workers, so threads started in a parent are gone
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker_loop, name='compile-worker', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def stop(self, timeout=5.0):
+        """
+        Stop this process's worker threads. A job that is mid-handler is
+        left to finish (up to timeout); if it doesn't, its lease runs out
+        and another worker re-claims it.
+        """
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        with self._start_lock:
+            deadline = time.time() + timeout
+            for t in self._threads:
+                t.join(max(0.0, deadline - time.time()))
+            self._threads = [t for t in self._threads if t.is_alive()]
+
+    def enqueue(self, params, priority=0):
+        """Add a job and return its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, status, params, created_at, priority) VALUES (?, ?, ?, ?, ?)",
+                (job_id, QUEUED, json.dumps(params), now, priority)
+            )
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, now - self.retention)
+            )
+        finally:
+            conn.close()
+
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        """Get job status dict, or None if unknown."""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+
+        # Expired jobs are only deleted on the next enqueue
+        if not row or (row['finished_at'] and row['finished_at'] < time.time() - self.retention):
+            return None
+
+        job = {
+            'job_id': row['id'],
+            'status': row['status'],
+            'http_status': row['http_status'],
+            'result': json.loads(row['result']) if row['result'] else None,
+        }
+        if row['status'] == QUEUED:
+            job['position'] = self.position(row['created_at'], row['priority'])
+        return job
+
+    def wait(self, job_id, timeout):
+        """Long-poll: block until the job finishes or timeout expires."""
+        deadline = time.time() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job['status'] in (DONE, FAILED):
+                return job
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return job
+            with self._wakeup:
+                self._wakeup.wait(min(POLL_INTERVAL, remaining))
+
+    def position(self, created_at, priority=0):
+        """Number of queued jobs ahead of a job created at created_at with this priority."""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                """SELECT COUNT(*) FROM jobs WHERE status = ?
+                   AND (priority < ? OR (priority = ? AND created_at < ?))""",
+                (QUEUED, priority, priority, created_at)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def depth(self):
+        """Number of jobs waiting to run."""
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()[0]
+        finally:
+            conn.close()
+
+    def _claim(self):
+        """Atomically claim the best runnable job. Returns (id, params) or None."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """SELECT id, params FROM jobs
+                   WHERE status = ? OR (status = ? AND lease_expires < ?)
+                   ORDER BY priority, created_at LIMIT 1""",
+                (QUEUED, RUNNING, now)
+            ).fetchone()
+            if row:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, started_at = ?, lease_expires = ? WHERE id = ?",
+                    (RUNNING, now, now + self.lease_seconds, row['id'])
+                )
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        if not row:
+            return None
+        return row['id'], json.loads(row['params'])
+
+    def _renew_lease(self, job_id, done):
+        """Push a running job's lease forward until done is set (runs beside the handler)."""
+        while not done.wait(self.lease_seconds / 3):
+            try:
+                conn = self._connect()
+                try:
+                    conn.execute(
+                        "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ?",
+                        (time.time() + self.lease_seconds, job_id, RUNNING)
+                    )
+                finally:
+                    conn.close()
+            except sqlite3.Error as e:
+                print(f"⚠️  Job lease renewal failed: {e}")
+
+    def _complete(self, job_id, result, http_status):
+        status = DONE if http_status == 200 else FAILED
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, http_status = ?, finished_at = ? WHERE id = ?",
+                (status, json.dumps(result), http_status, time.time(), job_id)
+            )
+        finally:
+            conn.close()
+
+        with self._wakeup:
+            self._wakeup.notify_all()
+
+    def _worker_loop(self):
+        while not self._stopping.is_set():
+            try:
+                claimed = self._claim()
+            except sqlite3.Error as e:
+                print(f"⚠️  Job queue claim failed: {e}")
+                claimed = None
+
+            if not claimed:
+                # Jobs may also arrive from other processes, so poll as well as wait
+                with self._wakeup:
+                    self._wakeup.wait(1.0)
+                continue
+
+            job_id, params = claimed
+            done = threading.Event()
+            heartbeat = threading.Thread(target=self._renew_lease, args=(job_id, done),
+                                         name='compile-lease', daemon=True)
+            heartbeat.start()
+            try:
+                result, http_status = self.handler(params)
+            except Exception as e:
+                result, http_status = {'error': f'Generation failed: {str(e)}'}, 500
+            finally:
+                done.set()
+                heartbeat.join()
+            self._complete(job_id, result, http_status)
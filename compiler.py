@@ -0,0 +1,412 @@
+"""
+LilyPond compile helpers for dynamic chart generation.
+
+Most of a one-chart LilyPond run is Guile/LilyPond startup and loading the
+Include files, not typesetting. LilyPondBatcher is a long-lived compile
+daemon (one thread per process) that collects wrapper jobs over a short
+window and compiles them in a single LilyPond invocation, then routes each
+PDF back to the request waiting for it.
+
+Every compile runs in its own scratch directory (on tmpfs when the
+machine has one), so concurrent compiles never share file names and
+nothing is left in the repo tree. Wrappers include Core files by absolute
+path, and a single wrapper is piped to LilyPond on stdin.
+"""
+import hashlib
+import itertools
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import metrics
+
+# Batching configuration
+BATCH_WINDOW_MS = int(os.getenv('LILYPOND_BATCH_WINDOW_MS', '50'))  # How long to gather jobs
+BATCH_MAX_SIZE = int(os.getenv('LILYPOND_BATCH_MAX', '8'))           # Max wrappers per invocation
+LILYPOND_PROCS = int(os.getenv('LILYPOND_PROCS', str(os.cpu_count() or 1)))  # Concurrent invocations
+COMPILE_TIMEOUT = 60        # Seconds allowed for a single chart
+BATCH_EXTRA_TIMEOUT = 30    # Extra seconds per additional chart in a batch
+
+# Scratch space for compiles: tmpfs if available
+SHM_DIR = Path('/dev/shm')
+SCRATCH_ROOT = Path(os.getenv(
+    'COMPILE_SCRATCH_DIR',
+    str(SHM_DIR) if SHM_DIR.is_dir() and os.access(SHM_DIR, os.W_OK) else tempfile.gettempdir()
+))
+SCRATCH_PREFIX = 'jazzpicker-compile-'
+SCRATCH_MAX_AGE = 3600      # Sandboxes older than this were left by a crashed worker
+
+
+def generate_wrapper_content(core_file, target_key, clef, instrument="", octave_offset=0, source='standard',
+                             core_dir=None):
+    """Generate LilyPond wrapper file content.
+
+    Args:
+        octave_offset: Integer from -2 to +2. Positive = up, negative = down.
+                       LilyPond syntax: ' = up one octave, , = down one octave
+        source: 'standard' or 'custom' - determines Core file path
+        core_dir: Absolute Core directory; lets the wrapper compile from any
+                  directory (otherwise paths are relative to lilypond-data/Generated)
+    """
+    # bassKey is always the key without octave modifier
+    bass_key = target_key.rstrip(',')
+
+    # For bass clef, whatKey starts one octave down
+    what_key = f"{target_key}," if clef == "bass" else target_key
+
+    # Apply octave offset: ' = up, , = down
+    if octave_offset > 0:
+        what_key += "'" * octave_offset
+    elif octave_offset < 0:
+        what_key += "," * abs(octave_offset)
+
+    # Core file path depends on source
+    if core_dir:
+        core_include = str(Path(core_dir).resolve() / core_file)
+    elif source == 'custom':
+        core_include = f'../../custom-charts/Core/{core_file}'
+    else:
+        core_include = f'../Core/{core_file}'
+
+    return f'''%% -*- Mode: LilyPond -*-
+
+\\version "2.24.0"
+
+\\include "english.ly"
+
+instrument = "{instrument}"
+whatKey = {what_key}
+bassKey = {bass_key}
+whatClef = "{clef}"
+
+\\include "{core_include}"
+'''
+
+
+@lru_cache(maxsize=1)
+def lilypond_version():
+    """First line of `lilypond --version` (e.g. 'GNU LilyPond 2.25.30'), or 'unknown'."""
+    try:
+        result = subprocess.run(['lilypond', '--version'], capture_output=True, text=True, timeout=30)
+        lines = result.stdout.strip().splitlines()
+        return lines[0] if lines else 'unknown'
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unknown'
+
+
+_file_hashes = {}  # path -> (mtime_ns, size, sha256)
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(path):
+    """SHA-256 of a file's contents, re-read only when its mtime or size changes."""
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except OSError:
+        return 'missing'
+
+    with _file_hashes_lock:
+        memo = _file_hashes.get(path)
+    if memo and memo[0] == stat.st_mtime_ns and memo[1] == stat.st_size:
+        return memo[2]
+
+    digest = hashlib.sha256(path.read_bytes()).hexdigest()
+    with _file_hashes_lock:
+        _file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def include_set_hash(include_dir):
+    """
+    Hash of every file in an Include directory (names and contents).
+
+    Each file's hash comes from file_hash(), so only files whose mtime or
+    size changed are re-read; an edited Include file changes the hash
+    without a restart.
+    """
+    include_dir = Path(include_dir)
+    hasher = hashlib.sha256()
+    if include_dir.exists():
+        for f in sorted(p for p in include_dir.rglob('*') if p.is_file()):
+            hasher.update(str(f.relative_to(include_dir)).encode())
+            hasher.update(file_hash(f).encode())
+    return hasher.hexdigest()
+
+
+def content_hash(core_path, include_dir, variant, include_hash=None):
+    """
+    Cache identity for a generated chart.
+
+    Combines the Core file contents, the Include set, the wrapper
+    parameters that change the music (variant) and the LilyPond version,
+    so any edit produces a new key and unchanged charts keep theirs.
+    Callers hashing many charts at once can pass include_set_hash() as
+    include_hash. Returns 16 hex chars.
+    """
+    include_hash = include_hash or include_set_hash(Path(include_dir))
+    hasher = hashlib.sha256()
+    for part in (file_hash(core_path), include_hash, repr(variant), lilypond_version()):
+        hasher.update(part.encode())
+        hasher.update(b'\0')
+    return hasher.hexdigest()[:16]
+
+
+@dataclass
+class CompileResult:
+    """Outcome of compiling one wrapper."""
+    pdf_path: Path
+    stderr: str       # LilyPond output for this wrapper only
+    batch_size: int   # Number of wrappers compiled in the same invocation
+    elapsed: float    # Wall time of the whole invocation (seconds)
+
+    @property
+    def ok(self):
+        return self.pdf_path.exists()
+
+
+def split_stderr(stderr, wrapper_args):
+    """
+    Split LilyPond's combined output into per-file chunks.
+
+    LilyPond announces each input with "Processing `file.ly'", so everything
+    up to the next announcement belongs to that file.
+    """
+    chunks = {arg: [] for arg in wrapper_args}
+    current = None
+    for line in stderr.splitlines():
+        if line.startswith('Processing `'):
+            name = line[len('Processing `'):].rstrip("'")
+            current = name if name in chunks else None
+        if current:
+            chunks[current].append(line)
+
+    # Unrecognized output format: every file gets the full log
+    if not any(chunks.values()):
+        return {arg: stderr for arg in wrapper_args}
+    return {arg: '\n'.join(lines) for arg, lines in chunks.items()}
+
+
+def run_lilypond(wrapper_paths, cwd, timeout, include_dirs=(), stdin=None):
+    """
+    Compile one or more wrappers in a single LilyPond process.
+
+    wrapper_paths are relative to cwd and must share a directory, which is
+    also where the PDFs are written. If stdin is given, it is the source of
+    the single wrapper, piped in instead of read from disk (wrapper_paths[0]
+    still names the output). Returns the CompletedProcess.
+    """
+    output_dir = str(Path(wrapper_paths[0]).parent)
+    args = [str(p) for p in wrapper_paths]
+    if len(args) == 1:
+        output = str(Path(args[0]).with_suffix(''))
+    else:
+        output = output_dir  # With several inputs, -o names a folder
+
+    includes = []
+    for include_dir in include_dirs:
+        includes += ['-I', str(include_dir)]
+    inputs = ['-'] if stdin is not None else args
+
+    return subprocess.run(
+        ['lilypond'] + includes + ['-o', output] + inputs,
+        cwd=str(cwd),
+        input=stdin,
+        capture_output=True,
+        text=True,
+        timeout=timeout
+    )
+
+
+@contextmanager
+def compile_sandbox(root=None):
+    """Private scratch directory for one compile, removed on exit no matter what."""
+    root = Path(root or SCRATCH_ROOT)
+    root.mkdir(parents=True, exist_ok=True)
+    path = Path(tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=root))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def sweep_sandboxes(root=None, max_age=SCRATCH_MAX_AGE):
+    """Remove sandboxes left behind by killed workers. Returns the number removed."""
+    root = Path(root or SCRATCH_ROOT)
+    cutoff = time.time() - max_age
+    removed = 0
+    for path in root.glob(f'{SCRATCH_PREFIX}*'):
+        try:
+            if path.is_dir() and path.stat().st_mtime < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
+
+
+class LilyPondBatcher:
+    """
+    Compile daemon that amortizes LilyPond startup across waiting requests.
+
+    compile() blocks the caller until its wrapper has been built. A job that
+    arrives while the daemon is idle compiles right away. Under load (other
+    jobs queued or compiling) a daemon thread waits BATCH_WINDOW_MS after
+    the first job for others to join, then hands up to BATCH_MAX_SIZE
+    wrappers to one LilyPond process.
+    With several threads (one per CPU by default), separate batches compile
+    side by side. If a gate (admission.CompileGate) is given, each
+    invocation first takes one of its global process slots.
+
+    Jobs carry a priority (lower runs first). A batch only holds jobs of
+    one priority, so an interactive chart never waits for a prefetch batch
+    to be typeset alongside it.
+
+    Each caller passes its own sandbox directory (see compile_sandbox) and
+    gets its PDF back there as chart.pdf. A lone wrapper is piped to
+    LilyPond on stdin; a batch is written to a shared scratch directory
+    that is removed once the PDFs have been handed out.
+    """
+
+    def __init__(self, include_dirs=(), window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE,
+                 workers=LILYPOND_PROCS, gate=None):
+        self.include_dirs = [Path(d).resolve() for d in include_dirs]
+        self.gate = gate
+        self.window = window_ms / 1000
+        self.max_size = max(1, max_size)
+        self.workers = max(1, workers)
+        self._jobs = queue.PriorityQueue()  # (priority, seq, wrapper_content, sandbox, future)
+        self._seq = itertools.count()
+        self._running = 0  # Groups being compiled right now
+        self._running_lock = threading.Lock()
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the daemon threads for this process (idempotent)."""
+        with self._start_lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, name='lilypond-batcher', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def compile(self, wrapper_content, sandbox, priority=0):
+        """
+        Compile wrapper source into sandbox/chart.pdf and wait for the result.
+
+        Returns CompileResult. Raises subprocess.TimeoutExpired if the
+        LilyPond invocation carrying this wrapper timed out.
+        """
+        self.start()
+        future = Future()
+        self._jobs.put((priority, next(self._seq), wrapper_content, Path(sandbox), future))
+        return future.result()
+
+    def _collect(self):
+        """
+        Block for the best waiting job, then gather more of the same
+        priority until the window closes. If a better job arrives while
+        gathering, the batch so far is put back and it starts a new one.
+
+        With nothing else queued or compiling there is no one to batch
+        with, so the job goes out without waiting for the window.
+        """
+        batch = [self._jobs.get()]
+        if self._jobs.empty() and not self._running:
+            return batch
+        deferred = []
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job[0] < batch[0][0]:
+                deferred.extend(batch)
+                batch = [job]
+            elif job[0] == batch[0][0]:
+                batch.append(job)
+            else:
+                deferred.append(job)
+
+        for job in deferred:
+            self._jobs.put(job)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            jobs = [(wrapper_content, sandbox, future) for _, _, wrapper_content, sandbox, future in batch]
+            with self._running_lock:
+                self._running += 1
+            try:
+                self._compile_group(jobs, batch[0][0])
+            except Exception as e:
+                # Never let a batch take the daemon thread down with it
+                for _, _, future in jobs:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                with self._running_lock:
+                    self._running -= 1
+
+    def _compile_group(self, jobs, priority=0):
+        timeout = COMPILE_TIMEOUT + BATCH_EXTRA_TIMEOUT * (len(jobs) - 1)
+        with compile_sandbox() if len(jobs) > 1 else nullcontext() as batch_dir:
+            if len(jobs) == 1:
+                wrapper_content, sandbox, _ = jobs[0]
+                wrapper_names = ['chart.ly']
+                cwd, stdin = sandbox, wrapper_content
+            else:
+                # Several inputs can't share stdin: write them next to each other in scratch space
+                wrapper_names = [f'{i}.ly' for i in range(len(jobs))]
+                for name, (wrapper_content, _, _) in zip(wrapper_names, jobs):
+                    (batch_dir / name).write_text(wrapper_content)
+                cwd, stdin = batch_dir, None
+
+            try:
+                with self.gate.slot(priority) if self.gate else nullcontext():
+                    start = time.time()
+                    result = run_lilypond(wrapper_names, cwd, timeout, self.include_dirs, stdin)
+            except Exception as e:
+                outcome = 'timeout' if isinstance(e, subprocess.TimeoutExpired) else 'error'
+                metrics.inc('lilypond_charts_total', len(jobs), result=outcome)
+                for _, _, future in jobs:
+                    future.set_exception(e)
+                return
+
+            elapsed = time.time() - start
+            metrics.observe('lilypond_run_seconds', elapsed)
+            if len(jobs) > 1:
+                print(f"📦 Compiled {len(jobs)} charts in one LilyPond run ({elapsed:.1f}s)")
+                per_file = split_stderr(result.stderr, wrapper_names)
+                # Hand each PDF to its caller's sandbox before the batch directory goes away
+                for name, (_, sandbox, _) in zip(wrapper_names, jobs):
+                    pdf = batch_dir / Path(name).with_suffix('.pdf')
+                    if pdf.exists():
+                        shutil.move(str(pdf), str(sandbox / 'chart.pdf'))
+            else:
+                per_file = {wrapper_names[0]: result.stderr}
+
+        for name, (_, sandbox, future) in zip(wrapper_names, jobs):
+            compiled = CompileResult(
+                pdf_path=sandbox / 'chart.pdf',
+                stderr=per_file.get(name, ''),
+                batch_size=len(jobs),
+                elapsed=elapsed,
+            )
+            metrics.inc('lilypond_charts_total', result='ok' if compiled.ok else 'failed')
+            future.set_result(compiled)
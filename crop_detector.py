@@ -1,12 +1,23 @@
 """
 Auto-detect content bounds in PDF pages for smart cropping.
-Uses PyMuPDF to render pages and find non-white content areas.
+Uses PyMuPDF to read the page's vector drawing boxes, or to render pages
+and find non-white content areas.
 """
 import fitz  # PyMuPDF
 from dataclasses import dataclass
-from typing import Optional
+from typing import List, Optional, Union
 import json
 
+PdfSource = Union[str, bytes, bytearray]  # A path, or the PDF itself
+
+# NumPy is optional - without it we fall back to the sampling scanner
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    np = None
+    NUMPY_AVAILABLE = False
+
 
 @dataclass
 class CropBounds:
@@ -24,6 +35,14 @@ class CropBounds:
             'right': round(self.right, 1),
         }
 
+    def to_list(self):
+        """Compact form for per-page arrays: [top, bottom, left, right]."""
+        return [round(self.top, 1), round(self.bottom, 1), round(self.left, 1), round(self.right, 1)]
+
+    @classmethod
+    def from_list(cls, values):
+        return cls(*values)
+
     @classmethod
     def from_dict(cls, d):
         return cls(
@@ -195,5 +214,217 @@ def detect_content_bounds_fast(pdf_path: str, padding: float = 20.0) -> Optional
         return None
 
 
-# Use the fast version by default
-detect_bounds = detect_content_bounds_fast
+def _ink_box_numpy(page, dpi: int = 72) -> Optional[fitz.Rect]:
+    """
+    Bounding box of non-white pixels on a page, in points (pixel grid units).
+
+    The pixmap buffer is viewed as an array without copying, and the
+    row/column ink masks come from min() reductions along each axis (a
+    pixel is content if any channel is below the white threshold).
+    """
+    pix = page.get_pixmap(dpi=dpi)
+    width, height, n = pix.width, pix.height, pix.n
+
+    # (height, stride) rows of bytes, no copy; padding past width*n dropped
+    pixels = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(height, pix.stride)[:, :width * n]
+
+    # Darkest byte per row / per column byte, then per pixel column
+    threshold = 250
+    row_min = pixels.min(axis=1) if n == 3 else pixels.reshape(height, width, n)[:, :, :3].min(axis=(1, 2))
+    col_min = pixels.min(axis=0).reshape(width, n)[:, :3].min(axis=1)
+    rows = np.flatnonzero(row_min < threshold)
+    cols = np.flatnonzero(col_min < threshold)
+
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    scale = 72 / dpi  # Pixels back to points (1:1 at 72 DPI)
+    return fitz.Rect(int(cols[0]) * scale, int(rows[0]) * scale, int(cols[-1]) * scale, int(rows[-1]) * scale)
+
+
+def _ink_box_bytes(page, dpi: int = 72) -> Optional[fitz.Rect]:
+    """
+    _ink_box_numpy without NumPy: min() over byte slices of each row and
+    (strided) column, so the per-pixel work still runs in C.
+    """
+    pix = page.get_pixmap(dpi=dpi)
+    width, height, n, stride = pix.width, pix.height, pix.n, pix.stride
+    samples = pix.samples
+    threshold = 250
+
+    rows = [y for y in range(height)
+            if min(samples[y * stride:y * stride + width * n]) < threshold]
+    if not rows:
+        return None
+    cols = [x for x in range(width)
+            if min(min(samples[x * n + c::stride]) for c in range(3)) < threshold]
+    if not cols:
+        return None
+    scale = 72 / dpi
+    return fitz.Rect(cols[0] * scale, rows[0] * scale, cols[-1] * scale, rows[-1] * scale)
+
+
+def _vector_box(page) -> Optional[fitz.Rect]:
+    """
+    Bounding box of everything the page paints, from its drawing log.
+
+    LilyPond output is pure vector (glyphs and paths), so the union of the
+    fill/stroke boxes is the content area without rendering anything. The
+    boxes are conservative: text boxes are glyph boxes, and stroke boxes
+    include the line width (times the miter limit for mitered joins;
+    LilyPond strokes with round joins). Returns None when the log can't
+    be trusted: nothing painted, or a shape covering most of the page
+    (e.g. a background rectangle or a full-page image).
+    """
+    page_rect = page.rect
+    boxes = [rect for kind, rect in page.get_bboxlog() if kind.startswith(('fill-', 'stroke-'))]
+    if not boxes:
+        return None
+
+    # Plain tuples: building a Rect per entry costs more than rendering
+    page_area = page_rect.width * page_rect.height
+    if any((x1 - x0) * (y1 - y0) > 0.9 * page_area for x0, y0, x1, y1 in boxes):
+        return None
+    x0s, y0s, x1s, y1s = zip(*boxes)
+    box = fitz.Rect(min(x0s), min(y0s), max(x1s), max(y1s)) & page_rect
+    if box.is_empty:
+        return None
+    return box
+
+
+def _crop_from_box(box: fitz.Rect, page_rect: fitz.Rect, padding: float) -> Optional[CropBounds]:
+    """Trim amounts for a content box, keeping padding points of whitespace."""
+    if box.x1 <= box.x0 or box.y1 <= box.y0:
+        return None
+    return CropBounds(
+        top=max(0, box.y0 - page_rect.y0 - padding),
+        bottom=max(0, page_rect.y1 - box.y1 - padding),
+        left=max(0, box.x0 - page_rect.x0 - padding),
+        right=max(0, page_rect.x1 - box.x1 - padding),
+    )
+
+
+def detect_content_bounds_numpy(pdf_path: str, padding: float = 20.0, dpi: int = 72) -> Optional[CropBounds]:
+    """
+    Vectorized version: same result as detect_content_bounds, in a few array ops.
+    """
+    try:
+        with fitz.open(pdf_path) as doc:
+            if doc.page_count == 0:
+                return None
+            page = doc[0]
+            box = _ink_box_numpy(page, dpi)
+            return _crop_from_box(box, page.rect, padding) if box else None
+
+    except Exception as e:
+        print(f"Error detecting content bounds: {e}")
+        return None
+
+
+def _open_pdf(source: PdfSource):
+    """Open a PDF from a path or from bytes already in memory (no copy, no disk read)."""
+    if isinstance(source, (bytes, bytearray)):
+        return fitz.open(stream=source, filetype='pdf')
+    return fitz.open(source)
+
+
+def _page_crop(page, padding: float) -> Optional[CropBounds]:
+    """Crop for one page: vector geometry, rasterizing only if that fails."""
+    try:
+        box = _vector_box(page)
+    except Exception as e:
+        print(f"Vector crop detection failed, rasterizing: {e}")
+        box = None
+    if box is None:
+        box = _ink_box_numpy(page) if NUMPY_AVAILABLE else _ink_box_bytes(page)
+    return _crop_from_box(box, page.rect, padding) if box else None
+
+
+def detect_content_bounds_vector(pdf_path: PdfSource, padding: float = 20.0) -> Optional[CropBounds]:
+    """
+    Content bounds from the page's drawing and text boxes, without rendering.
+
+    Falls back to rasterizing (NumPy if available) when the page's
+    drawing log gives no usable box.
+    """
+    try:
+        with _open_pdf(pdf_path) as doc:
+            if doc.page_count == 0:
+                return None
+            return _page_crop(doc[0], padding)
+
+    except Exception as e:
+        print(f"Error detecting content bounds: {e}")
+        return None
+
+
+@dataclass
+class PageLayout:
+    """Per-page geometry of a chart: size in points and crop bounds (None for blank pages)."""
+    sizes: List[List[float]]
+    bounds: List[Optional[CropBounds]]
+
+    @property
+    def page_count(self):
+        return len(self.sizes)
+
+    def crop_pages(self):
+        """Compact per-page bounds: [top, bottom, left, right] or None."""
+        return [b.to_list() if b else None for b in self.bounds]
+
+
+def detect_page_layout(pdf_path: PdfSource, padding: float = 20.0) -> Optional[PageLayout]:
+    """
+    Page sizes and crop bounds for every page, in one pass over the document.
+
+    Page 2 of a chart is often half empty, so sharing page 1's margins
+    either over-crops it or wastes screen space. Returns None if the PDF
+    can't be read or has no pages. pdf_path may also be the PDF's bytes.
+    """
+    try:
+        with _open_pdf(pdf_path) as doc:
+            if doc.page_count == 0:
+                return None
+            sizes, bounds = [], []
+            for page in doc:
+                sizes.append([round(page.rect.width, 1), round(page.rect.height, 1)])
+                bounds.append(_page_crop(page, padding))
+            return PageLayout(sizes, bounds)
+
+    except Exception as e:
+        print(f"Error detecting content bounds: {e}")
+        return None
+
+
+def detect_page_bounds(pdf_path: PdfSource, padding: float = 20.0) -> Optional[List[Optional[CropBounds]]]:
+    """Crop bounds for every page (see detect_page_layout)."""
+    layout = detect_page_layout(pdf_path, padding)
+    return layout.bounds if layout else None
+
+
+# Vector geometry by default; it rasterizes only pages it can't handle
+detect_bounds = detect_content_bounds_vector
+
+
+def get_page_count(pdf_path: PdfSource) -> Optional[int]:
+    """Number of pages in a PDF (path or bytes), or None if it can't be opened."""
+    try:
+        with _open_pdf(pdf_path) as doc:
+            return doc.page_count
+    except Exception as e:
+        print(f"Error reading page count: {e}")
+        return None
+
+
+def optimize_pdf(pdf_bytes: bytes) -> bytes:
+    """
+    Rewrite a PDF compactly (unused objects dropped, streams deflated,
+    objects packed into object streams). Returns the smaller of the
+    rewritten and original bytes.
+    """
+    try:
+        with _open_pdf(pdf_bytes) as doc:
+            optimized = doc.tobytes(garbage=3, deflate=True, use_objstms=1)
+    except Exception as e:
+        print(f"Error optimizing PDF: {e}")
+        return pdf_bytes
+    return optimized if len(optimized) < len(pdf_bytes) else pdf_bytes
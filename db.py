@@ -1,250 +1,324 @@
 """
 SQLite database access layer for Jazz Picker catalog.
 """
+import os
 import sqlite3
 import json
+import time
 from pathlib import Path
 from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import wraps
+from typing import Optional, Tuple
+
+import metrics
 
 # Database file paths
 LOCAL_DB_PATH = Path('catalog.db')
 S3_DB_KEY = 'catalog.db'
 
-# Global connection (initialized on first use)
+# Connection settings. catalog.db is only ever replaced, never written in
+# place, so connections open it immutable: no locking or change checks.
+CATALOG_MMAP_BYTES = int(os.getenv('CATALOG_MMAP_BYTES', str(64 * 1024 * 1024)))
+CATALOG_CACHE_KB = int(os.getenv('CATALOG_CACHE_KB', '8192'))
+
+# Path of the loaded catalog (set by init_db, opened by get_connection)
 _db_path = None
 
+# Current catalog snapshot. Replaced wholesale by init_db(), and only its
+# lookup memo is ever added to, so readers that grab it once see a
+# consistent catalog.
+_snapshot = None
 
-def init_db(db_path=None):
-    """Initialize database path. Call once at startup."""
-    global _db_path
-    _db_path = db_path or LOCAL_DB_PATH
+SONG_COLUMNS = (
+    'id', 'title', 'default_key', 'composer', 'core_files', 'low_note_midi', 'high_note_midi', 'source',
+    'core_modified', 'score_id', 'part_name', 'tempo_style', 'tempo_source', 'tempo_bpm', 'tempo_note_value',
+    'time_signature',
+)
+
+# Fields returned by get_all_songs()
+LISTING_FIELDS = (
+    'title', 'default_key', 'composer', 'low_note_midi', 'high_note_midi', 'score_id', 'part_name',
+    'tempo_style', 'tempo_source', 'tempo_bpm', 'tempo_note_value', 'time_signature',
+)
 
-    if not Path(_db_path).exists():
-        raise FileNotFoundError(f"Database not found: {_db_path}")
 
-    # Verify we can connect
-    with get_connection() as conn:
-        cursor = conn.execute("SELECT COUNT(*) FROM songs")
-        count = cursor.fetchone()[0]
+class Song:
+    """One catalog row. core_files is parsed once, as a tuple."""
+    __slots__ = SONG_COLUMNS + ('title_lower',)
+
+    def __init__(self, row):
+        for column in SONG_COLUMNS:
+            setattr(self, column, row[column])
+        self.core_files = tuple(json.loads(self.core_files)) if self.core_files else ()
+        self.title_lower = self.title.lower()
+
+
+class CatalogSnapshot:
+    """
+    The whole catalog in memory (~750 songs), loaded in one pass.
 
+    Every read helper below is a dict lookup or a scan of this instead of
+    a connect/query/close round-trip; a generate request used to make six.
+    """
+    __slots__ = ('path', 'songs', 'by_title', 'metadata', 'providers', 'listing', 'loaded_at', 'resolved')
+
+    def __init__(self, path, songs, metadata):
+        self.path = path
+        self.songs = songs  # Tuple of Song, sorted by title
+        self.by_title = {song.title: song for song in songs}
+        self.metadata = metadata
+        self.providers = json.loads(metadata['providers']) if metadata.get('providers') else {}
+        self.listing = [{field: getattr(song, field) for field in LISTING_FIELDS} for song in songs]
+        self.loaded_at = time.time()
+        # resolve_song_for_generation() memo; goes away with the snapshot
+        self.resolved = {}
+
+
+@dataclass(frozen=True)
+class ResolvedSong:
+    """Everything the generate path needs to know about one song."""
+    title: str
+    core_files: Tuple[str, ...]
+    source: str                     # 'standard' or 'custom'
+    default_key: str                # Concert key, 'c' if the catalog has none
+    low_note_midi: Optional[int]
+    high_note_midi: Optional[int]
+    core_modified: Optional[str]
+    include_version: Optional[str]  # The source provider's includeVersion
+
+
+def connect(db_path):
+    """Open catalog.db read-only and immutable, with mmap and a larger page cache."""
+    uri = Path(db_path).resolve().as_uri() + '?mode=ro&immutable=1'
+    conn = sqlite3.connect(uri, uri=True)
+    conn.row_factory = sqlite3.Row  # Enable column access by name
+    conn.execute(f"PRAGMA mmap_size = {CATALOG_MMAP_BYTES}")
+    conn.execute(f"PRAGMA cache_size = -{CATALOG_CACHE_KB}")
+    return conn
+
+
+def load_snapshot(db_path):
+    """Read a catalog database into a CatalogSnapshot."""
+    conn = connect(db_path)
+    try:
+        # ORDER BY title uses SQLite's binary collation, same as sorting str in Python
+        rows = conn.execute(f"SELECT {', '.join(SONG_COLUMNS)} FROM songs ORDER BY title").fetchall()
+        metadata = {row['key']: row['value'] for row in conn.execute("SELECT key, value FROM metadata")}
+    finally:
+        conn.close()
+    return CatalogSnapshot(str(db_path), tuple(Song(row) for row in rows), metadata)
+
+
+def validate_catalog(db_path):
+    """
+    Check that a catalog file is intact and usable before loading it.
+    Returns the song count; raises ValueError otherwise.
+    """
+    try:
+        conn = connect(db_path)
+        try:
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            count = conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0]
+            conn.execute("SELECT key, value FROM metadata").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        raise ValueError(f"unreadable catalog {db_path}: {e}")
+
+    if check != 'ok':
+        raise ValueError(f"corrupt catalog {db_path}: {check}")
+    if count == 0:
+        raise ValueError(f"catalog {db_path} has no songs")
     return count
 
 
+def init_db(db_path=None):
+    """
+    Load the catalog into memory. Call at startup, and again whenever
+    catalog.db changes: the new snapshot replaces the old one in a single
+    assignment, so in-flight requests finish on the version they started with.
+    """
+    global _db_path, _snapshot
+    db_path = db_path or LOCAL_DB_PATH
+
+    if not Path(db_path).exists():
+        raise FileNotFoundError(f"Database not found: {db_path}")
+
+    snapshot = load_snapshot(db_path)
+    _db_path, _snapshot = db_path, snapshot
+
+    return len(snapshot.songs)
+
+
+def get_snapshot():
+    """The current CatalogSnapshot (read-only)."""
+    snapshot = _snapshot
+    if snapshot is None:
+        raise RuntimeError("Database not initialized. Call init_db() first.")
+    return snapshot
+
+
+def _song(title):
+    return get_snapshot().by_title.get(title)
+
+
+def timed(fn):
+    """Record a query function's duration in the catalog_query_seconds histogram."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.observe('catalog_query_seconds', time.perf_counter() - start, query=fn.__name__)
+    return wrapper
+
+
 @contextmanager
 def get_connection():
-    """Get a database connection. Use as context manager."""
+    """
+    Get a read-only connection to the loaded catalog, for ad-hoc queries
+    (requests read the snapshot instead). Use as context manager.
+    """
     if _db_path is None:
         raise RuntimeError("Database not initialized. Call init_db() first.")
 
-    conn = sqlite3.connect(_db_path)
-    conn.row_factory = sqlite3.Row  # Enable column access by name
+    conn = connect(_db_path)
     try:
         yield conn
     finally:
         conn.close()
 
 
+@timed
 def get_metadata():
     """Get catalog metadata."""
-    with get_connection() as conn:
-        cursor = conn.execute("SELECT key, value FROM metadata")
-        return {row['key']: row['value'] for row in cursor.fetchall()}
+    return dict(get_snapshot().metadata)
 
 
+@timed
 def get_total_songs():
     """Get total number of songs."""
-    with get_connection() as conn:
-        cursor = conn.execute("SELECT COUNT(*) FROM songs")
-        return cursor.fetchone()[0]
+    return len(get_snapshot().songs)
 
 
+@timed
 def get_all_songs():
     """
     Get all songs sorted alphabetically.
     Returns lightweight list with title, default_key, composer, multi-part info, and tempo.
+    The dicts are shared with the snapshot - don't modify them.
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT title, default_key, composer, low_note_midi, high_note_midi, score_id, part_name, tempo_style, tempo_source, tempo_bpm, tempo_note_value, time_signature FROM songs ORDER BY title"
-        )
-        return [
-            {
-                'title': row['title'],
-                'default_key': row['default_key'],
-                'composer': row['composer'],
-                'low_note_midi': row['low_note_midi'],
-                'high_note_midi': row['high_note_midi'],
-                'score_id': row['score_id'],
-                'part_name': row['part_name'],
-                'tempo_style': row['tempo_style'],
-                'tempo_source': row['tempo_source'],
-                'tempo_bpm': row['tempo_bpm'],
-                'tempo_note_value': row['tempo_note_value'],
-                'time_signature': row['time_signature'],
-            }
-            for row in cursor.fetchall()
-        ]
+    return list(get_snapshot().listing)
 
 
+@timed
 def search_songs(query='', limit=50, offset=0):
     """
     Search songs by title.
     Returns list of song dicts and total count.
     """
-    with get_connection() as conn:
-        params = []
-
-        # Base query
-        base_query = "SELECT id, title, default_key, composer FROM songs"
-
-        # Build WHERE clause for search
-        if query:
-            base_query += " WHERE LOWER(title) LIKE ?"
-            params.append(f"%{query.lower()}%")
-
-        base_query += " ORDER BY title"
-
-        # Add pagination
-        base_query += " LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-
-        cursor = conn.execute(base_query, params)
-        songs = []
-        for row in cursor.fetchall():
-            songs.append({
-                'title': row['title'],
-                'default_key': row['default_key'],
-                'composer': row['composer'],
-            })
-
-        # Get total count (without pagination)
-        count_query = "SELECT COUNT(*) FROM songs"
-        if query:
-            count_query += " WHERE LOWER(title) LIKE ?"
-            count_params = [f"%{query.lower()}%"]
-        else:
-            count_params = []
-
-        cursor = conn.execute(count_query, count_params)
-        total = cursor.fetchone()[0]
-
-        return songs, total
+    songs = get_snapshot().songs
+
+    if query:
+        query = query.lower()
+        songs = [song for song in songs if query in song.title_lower]
+
+    page = songs[offset:offset + limit]
+    return [
+        {
+            'title': song.title,
+            'default_key': song.default_key,
+            'composer': song.composer,
+        }
+        for song in page
+    ], len(songs)
 
 
+@timed
 def get_song_by_title(title):
     """Get a song by title."""
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT id, title, default_key, core_files, low_note_midi, high_note_midi FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-
-        if not row:
-            return None
-
-        return {
-            'id': row['id'],
-            'title': row['title'],
-            'default_key': row['default_key'],
-            'core_files': json.loads(row['core_files']) if row['core_files'] else [],
-            'low_note_midi': row['low_note_midi'],
-            'high_note_midi': row['high_note_midi'],
-        }
+    song = _song(title)
+    if not song:
+        return None
+
+    return {
+        'id': song.id,
+        'title': song.title,
+        'default_key': song.default_key,
+        'core_files': list(song.core_files),
+        'low_note_midi': song.low_note_midi,
+        'high_note_midi': song.high_note_midi,
+    }
 
 
+@timed
 def get_song_default_key(title):
     """
     Get the default concert key for a song.
     Returns (key, clef) tuple, or ('c', 'treble') if not found.
     Clef is always 'treble' - bass clef is determined by user's instrument setting.
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT default_key FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-        if row and row['default_key']:
-            return row['default_key'], 'treble'
+    song = _song(title)
+    if song and song.default_key:
+        return song.default_key, 'treble'
 
-        return 'c', 'treble'
+    return 'c', 'treble'
 
 
+@timed
 def get_core_files(title):
     """Get core files for a song."""
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT core_files FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-        if row and row['core_files']:
-            return json.loads(row['core_files'])
-        return []
+    song = _song(title)
+    return list(song.core_files) if song else []
 
 
+@timed
 def song_exists(title):
     """Check if a song exists in the catalog."""
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT 1 FROM songs WHERE title = ? LIMIT 1",
-            (title,)
-        )
-        return cursor.fetchone() is not None
+    return title in get_snapshot().by_title
 
 
+@timed
 def get_song_note_range(title):
     """
     Get the MIDI note range for a song's melody.
     Returns (low_note_midi, high_note_midi) tuple, or (None, None) if not found.
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT low_note_midi, high_note_midi FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-        if row:
-            return row['low_note_midi'], row['high_note_midi']
-        return None, None
+    song = _song(title)
+    if song:
+        return song.low_note_midi, song.high_note_midi
+    return None, None
 
 
+@timed
 def get_song_source(title):
     """
     Get the source of a song ('standard' or 'custom').
     Returns 'standard' if not found.
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT source FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-        if row and row['source']:
-            return row['source']
-        return 'standard'
+    song = _song(title)
+    if song and song.source:
+        return song.source
+    return 'standard'
 
 
+@timed
 def get_providers():
     """
     Get providers metadata including includeVersion for cache invalidation.
+    Parsed once per snapshot; don't modify the result.
     Returns dict of provider objects, e.g.:
     {
         'standard': {'id': 'standard', 'name': 'Eric Royer', 'includeVersion': 'abc123'},
         'custom': {'id': 'custom', 'name': 'Custom Charts', 'includeVersion': 'abc123'}
     }
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT value FROM metadata WHERE key = 'providers'"
-        )
-        row = cursor.fetchone()
-        if row and row['value']:
-            return json.loads(row['value'])
-        return {}
+    return get_snapshot().providers
 
 
+@timed
 def get_include_version(source='standard'):
     """
     Get the includeVersion for a source/provider.
@@ -257,17 +331,46 @@ def get_include_version(source='standard'):
     return None
 
 
+@timed
+def resolve_song_for_generation(title):
+    """
+    Core files, source, default key, note range, core_modified and the
+    provider's includeVersion in one lookup, instead of a helper call for
+    each. Memoized per catalog snapshot. Returns a ResolvedSong, or None
+    if the song isn't in the catalog.
+    """
+    snapshot = get_snapshot()
+    resolved = snapshot.resolved.get(title)
+    if resolved is not None:
+        return resolved
+
+    song = snapshot.by_title.get(title)
+    if song is None:
+        return None
+
+    source = song.source or 'standard'
+    provider = snapshot.providers.get(source) or {}
+    resolved = ResolvedSong(
+        title=song.title,
+        core_files=song.core_files,
+        source=source,
+        default_key=song.default_key or 'c',
+        low_note_midi=song.low_note_midi,
+        high_note_midi=song.high_note_midi,
+        core_modified=song.core_modified,
+        include_version=provider.get('includeVersion'),
+    )
+    snapshot.resolved[title] = resolved
+    return resolved
+
+
+@timed
 def get_song_core_modified(title):
     """
     Get the core_modified timestamp for a song.
     Returns ISO timestamp string or None if not found.
     """
-    with get_connection() as conn:
-        cursor = conn.execute(
-            "SELECT core_modified FROM songs WHERE title = ?",
-            (title,)
-        )
-        row = cursor.fetchone()
-        if row and row['core_modified']:
-            return row['core_modified']
-        return None
+    song = _song(title)
+    if song and song.core_modified:
+        return song.core_modified
+    return None
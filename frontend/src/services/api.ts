@@ -1,5 +1,5 @@
 import type { SongListResponse, SongSummary, Transposition, Clef } from '@/types/catalog';
-import type { CropBounds } from '@/types/pdf';
+import type { CropBounds, CropBoundsList } from '@/types/pdf';
 import { auth } from '../firebase';
 
 // Web uses relative URLs (Vite proxy in dev, same origin in prod)
@@ -44,6 +44,10 @@ export interface GenerateResponse {
   cached: boolean;
   generation_time_ms: number;
   crop?: CropBounds;
+  crop_pages?: (CropBoundsList | null)[];
+  page_count?: number;
+  /** [width, height] in points, one per page */
+  page_sizes?: [number, number][];
   octave_offset?: number;
 }
 
@@ -8,3 +8,8 @@ export interface CropBounds {
   left: number;
   right: number;
 }
+
+/**
+ * Compact per-page crop bounds from generate: [top, bottom, left, right].
+ */
+export type CropBoundsList = [number, number, number, number];
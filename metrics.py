@@ -0,0 +1,414 @@
+"""
+In-process counters and latency histograms for the generate pipeline.
+
+Cheap enough to bump on every request; read back by /health and /metrics.
+
+StageTimer breaks one generate request into named stages (catalog lookup,
+cache checks, LilyPond, crop detection, upload, ...). Code deep in the
+pipeline records into whichever timer is active on its thread via
+stage(), so helpers don't need a timer argument. Every stage duration
+also lands in a histogram, which shows which stage dominates p95.
+
+Each gunicorn worker keeps its own numbers. To export totals, every
+process writes a snapshot file to METRICS_DIR every few seconds, and
+aggregate() sums all of them. Snapshots of workers that have exited are
+folded into one totals file and deleted, so counters never go backwards
+when a worker is recycled and the directory stays one file per live
+process.
+"""
+import atexit
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+METRICS_DIR = Path(os.getenv('METRICS_DIR', 'cache/metrics'))
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+EXITED_TOTALS = 'exited.json'  # Summed snapshots of processes that have exited
+STALE_SNAPSHOT_SECONDS = 3600  # A snapshot not rewritten for this long is treated as exited
+PREFIX = 'jazzpicker_'
+
+# Histogram bucket upper bounds in seconds (last bucket is +Inf)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_counters = Counter()  # (name, labels) -> value
+_histograms = {}       # (name, labels) -> _Histogram
+_lock = threading.Lock()
+_active = threading.local()
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _series_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def inc(name, value=1, **labels):
+    """Increment a named counter (optionally per label set)."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] += value
+
+
+def counters():
+    """Snapshot of this process's counters as a plain dict ('name{label="v"}' -> value)."""
+    with _lock:
+        return {_series_name(name, labels): value for (name, labels), value in _counters.items()}
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def quantile(self, q):
+        """Estimate a quantile by interpolating inside its bucket."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+def observe(name, seconds, **labels):
+    """Record a duration into the histogram for name (and labels)."""
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = _Histogram()
+        hist.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        hist.sum += seconds
+        hist.count += 1
+
+
+def histograms():
+    """
+    Snapshot of this process's histograms.
+
+    Returns a list of dicts with name, labels, series ('name{label="v"}'),
+    count, sum, p50, p95 and cumulative bucket counts (upper bound -> count, '+Inf' last).
+    """
+    with _lock:
+        items = [(key, list(h.counts), h.sum, h.count, h.quantile(0.5), h.quantile(0.95))
+                 for key, h in _histograms.items()]
+
+    snapshot = []
+    for (name, labels), counts, total, count, p50, p95 in items:
+        cumulative = {}
+        running = 0
+        for bound, n in zip(list(BUCKETS) + ['+Inf'], counts):
+            running += n
+            cumulative[bound] = running
+        snapshot.append({
+            'name': name, 'labels': dict(labels), 'series': _series_name(name, labels),
+            'count': count, 'sum': total,
+            'p50': p50, 'p95': p95, 'buckets': cumulative,
+        })
+    return snapshot
+
+
+class StageTimer:
+    """
+    Per-request breakdown of time spent in each stage.
+
+    Use as a context manager to make it the active timer for the current
+    thread; stage() calls made while it is active are added to it. A stage
+    entered more than once (e.g. two cache lookups) accumulates.
+    """
+
+    def __init__(self, histogram='generate_stage_seconds'):
+        self.histogram = histogram
+        self.stages = {}  # name -> seconds, in first-seen order
+        self.start = time.perf_counter()
+        self._previous = None
+        self._lock = threading.Lock()  # Pool threads may add stages (see bind_timer)
+
+    def __enter__(self):
+        self._previous = getattr(_active, 'timer', None)
+        _active.timer = self
+        return self
+
+    def __exit__(self, *exc):
+        _active.timer = self._previous
+        return False
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        observe(self.histogram, seconds, stage=name)
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """Server-Timing header value, e.g. 'catalog;dur=0.4, lilypond;dur=2310.2, total;dur=2402.9'."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        parts.append(f"total;dur={self.total() * 1000:.1f}")
+        return ', '.join(parts)
+
+
+@contextmanager
+def stage(name):
+    """Time a block as one stage of the active StageTimer (histogram only if none is active)."""
+    timer = getattr(_active, 'timer', None)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if timer is not None:
+            timer.add(name, elapsed)
+        else:
+            observe('generate_stage_seconds', elapsed, stage=name)
+
+
+def bind_timer(fn):
+    """
+    Wrap fn so its stages go to this thread's active StageTimer wherever it
+    runs (e.g. a compile handed to a pool thread). Concurrent stages add up,
+    so a stage can exceed the request's total.
+    """
+    timer = getattr(_active, 'timer', None)
+
+    @wraps(fn)
+    def bound(*args, **kwargs):
+        previous = getattr(_active, 'timer', None)
+        _active.timer = timer
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active.timer = previous
+    return bound
+
+
+# Cross-process export
+
+_process_id = f"{os.getpid()}-{int(time.time() * 1000)}"  # Unique even if a pid is reused
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def write_snapshot(metrics_dir=None):
+    """Write this process's raw counters and histograms to its snapshot file."""
+    metrics_dir = Path(metrics_dir or METRICS_DIR)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    with _lock:
+        data = {
+            'counters': [[name, list(labels), value] for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), list(h.counts), h.sum, h.count]
+                           for (name, labels), h in _histograms.items()],
+        }
+    path = metrics_dir / f"{_process_id}.json"
+    tmp_path = metrics_dir / f"{_process_id}.json.tmp"
+    tmp_path.write_text(json.dumps(data))
+    os.replace(tmp_path, path)
+
+
+def start_flusher(metrics_dir=None, interval=FLUSH_INTERVAL):
+    """Start the background thread that keeps this process's snapshot fresh (idempotent)."""
+    global _flusher
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(metrics_dir)
+            except OSError as e:
+                print(f"⚠️  Could not write metrics snapshot: {e}")
+
+    with _flusher_lock:
+        if _flusher and _flusher.is_alive():
+            return
+        _flusher = threading.Thread(target=run, name='metrics-flush', daemon=True)
+        _flusher.start()
+    atexit.register(write_snapshot, metrics_dir)
+
+
+def _merge(data, total_counters, total_histograms):
+    """Add one snapshot's raw counters and histograms into the running totals."""
+    for name, labels, value in data.get('counters', []):
+        total_counters[(name, tuple(map(tuple, labels)))] += value
+
+    for name, labels, counts, total, count in data.get('histograms', []):
+        key = (name, tuple(map(tuple, labels)))
+        if len(counts) != len(BUCKETS) + 1:
+            continue  # Written by a build with different buckets
+        if key in total_histograms:
+            prev_counts, prev_sum, prev_count = total_histograms[key]
+            counts = [a + b for a, b in zip(prev_counts, counts)]
+            total += prev_sum
+            count += prev_count
+        total_histograms[key] = (counts, total, count)
+
+
+def _has_exited(path):
+    """Whether a snapshot's process is gone (dead pid, or not rewritten in a long time)."""
+    try:
+        pid = int(path.stem.split('-')[0])
+    except ValueError:
+        return False  # Not a process snapshot
+    if pid == os.getpid():
+        return False
+    try:
+        if path.stat().st_mtime < time.time() - STALE_SNAPSHOT_SECONDS:
+            return True  # The pid may have been reused
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False  # Alive under another user, or the file just went away
+    return False
+
+
+def compact(metrics_dir=None):
+    """
+    Fold the snapshots of exited processes into the totals file and delete them.
+
+    The totals file lists the snapshots it already contains, so a crash
+    between writing it and deleting them doesn't count them twice.
+    Returns the number of snapshots folded in.
+    """
+    metrics_dir = Path(metrics_dir or METRICS_DIR)
+    metrics_dir.mkdir(parents=True, exist_ok=True)
+    totals_path = metrics_dir / EXITED_TOTALS
+
+    with open(metrics_dir / '.compact.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            totals = json.loads(totals_path.read_text())
+        except FileNotFoundError:
+            totals = {}
+        except ValueError:
+            return 0  # Leave a damaged totals file for someone to look at
+
+        already_merged = set(totals.get('merged', []))
+        exited = [path for path in metrics_dir.glob('*.json')
+                  if path.name != EXITED_TOTALS and _has_exited(path)]
+        fresh = [path for path in exited if path.name not in already_merged]
+        if not exited:
+            return 0
+
+        total_counters = Counter()
+        total_histograms = {}
+        _merge(totals, total_counters, total_histograms)
+        merged = []
+        for path in fresh:
+            try:
+                _merge(json.loads(path.read_text()), total_counters, total_histograms)
+            except (OSError, ValueError):
+                continue  # Partial write from a crash: nothing to keep
+            merged.append(path.name)
+
+        if fresh:
+            data = {
+                'counters': [[name, list(labels), value] for (name, labels), value in total_counters.items()],
+                'histograms': [[name, list(labels), counts, total, count]
+                               for (name, labels), (counts, total, count) in total_histograms.items()],
+                'merged': merged,
+            }
+            tmp_path = metrics_dir / f"{EXITED_TOTALS}.tmp"
+            tmp_path.write_text(json.dumps(data))
+            os.replace(tmp_path, totals_path)
+
+        for path in exited:
+            path.unlink(missing_ok=True)
+        return len(fresh)
+
+
+def aggregate(metrics_dir=None):
+    """
+    Sum the snapshots of every process (this one is written first), plus
+    the totals of processes that have exited.
+
+    Returns (counters, histograms): {(name, labels): value} and
+    {(name, labels): (counts, sum, count)}.
+    """
+    metrics_dir = Path(metrics_dir or METRICS_DIR)
+    write_snapshot(metrics_dir)
+    compact(metrics_dir)
+
+    total_counters = Counter()
+    total_histograms = {}
+    # Totals first: a snapshot compacted after this read is still read below,
+    # and one compacted before it is listed in merged (its file may linger).
+    try:
+        totals = json.loads((metrics_dir / EXITED_TOTALS).read_text())
+    except (OSError, ValueError):
+        totals = {}
+    _merge(totals, total_counters, total_histograms)
+    skip = set(totals.get('merged', [])) | {EXITED_TOTALS}
+
+    for path in metrics_dir.glob('*.json'):
+        if path.name in skip:
+            continue
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue  # Being replaced, or a partial write from a crash
+        _merge(data, total_counters, total_histograms)
+
+    return dict(total_counters), total_histograms
+
+
+def render_prometheus(counter_values, histogram_values, gauges=None):
+    """
+    Prometheus text exposition format.
+
+    counter_values and histogram_values come from aggregate(); gauges is
+    {name: value} or {name: {labels_tuple: value}} for point-in-time values.
+    """
+    lines = []
+
+    def family(values):
+        grouped = {}
+        for (name, labels), value in values.items():
+            grouped.setdefault(name, []).append((labels, value))
+        return sorted(grouped.items())
+
+    for name, series in family(counter_values):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        for labels, value in sorted(series):
+            lines.append(f"{_series_name(PREFIX + name, labels)} {value}")
+
+    for name, series in family(histogram_values):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for labels, (counts, total, count) in sorted(series):
+            running = 0
+            for bound, n in zip(list(BUCKETS) + ['+Inf'], counts):
+                running += n
+                bucket_labels = labels + (('le', str(bound)),)
+                lines.append(f"{_series_name(PREFIX + name + '_bucket', bucket_labels)} {running}")
+            lines.append(f"{_series_name(PREFIX + name + '_sum', labels)} {total}")
+            lines.append(f"{_series_name(PREFIX + name + '_count', labels)} {count}")
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {PREFIX}{name} gauge")
+        series = value if isinstance(value, dict) else {(): value}
+        for labels, v in sorted(series.items()):
+            lines.append(f"{_series_name(PREFIX + name, labels)} {v}")
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,314 @@
+"""
+Size-bounded local PDF cache in front of S3.
+
+Generated charts are kept on the machine's disk so repeat requests skip the
+S3 head_object round-trip (and dev mode without S3 gets reuse at all). The
+index lives in SQLite next to the files, so it survives restarts and is
+shared by every gunicorn worker. Least recently used entries are evicted
+once the cache grows past its byte cap.
+
+Entries can also be marked as pending upload to an S3 bucket. The index
+then doubles as the write-behind queue: uploaders in any worker claim
+pending entries, and eviction takes them last.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+CACHE_DIR = Path(os.getenv('LOCAL_CACHE_DIR', 'cache/pdfs'))
+CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+UPLOAD_LEASE_SECONDS = 120  # A claimed upload not finished by then is retried by anyone
+ACCESS_TOUCH_SECONDS = 60   # A hit rewrites last_access only if it is older than this
+
+
+class LocalPDFCache:
+    """
+    Content-keyed PDF store with LRU eviction.
+
+    Keys are the generated asset keys (same as the S3 key). Each entry keeps
+    the crop bounds and includeVersion it was built with and whether the
+    PDF has been uploaded to S3 (or is waiting to be, in pending_bucket).
+
+    Recency is tracked to within touch_interval seconds: a hit only writes
+    to the index when the entry's last_access is older than that, so most
+    hits are a single read.
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, touch_interval=ACCESS_TOUCH_SECONDS):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self.index_path = self.root / 'index.db'
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._init_index()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_index(self):
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    crop TEXT,
+                    include_version TEXT,
+                    uploaded INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    pending_bucket TEXT,
+                    upload_attempts INTEGER NOT NULL DEFAULT 0,
+                    next_upload_at REAL,
+                    crop_pages TEXT,
+                    page_sizes TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access);
+                CREATE INDEX IF NOT EXISTS idx_entries_pending ON entries(pending_bucket, next_upload_at);
+            """)
+        finally:
+            conn.close()
+
+        # Partial writes from a crashed worker (recent ones may still be in progress)
+        cutoff = time.time() - 300
+        for tmp in self.root.glob('*.tmp'):
+            if tmp.stat().st_mtime < cutoff:
+                tmp.unlink(missing_ok=True)
+
+    @staticmethod
+    def filename_for(key):
+        """Stable on-disk name for a key (keys contain slashes and song slugs)."""
+        return hashlib.sha256(key.encode()).hexdigest()[:32] + '.pdf'
+
+    def get(self, key, include_version=None):
+        """
+        Look up a cached PDF and mark it recently used.
+
+        Returns a dict with path, filename, crop, crop_pages, page_sizes,
+        page_count, include_version and uploaded, or None on a miss. Entries built with a different
+        includeVersion are discarded.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT * FROM entries WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+
+            path = self.root / row['filename']
+            stale = include_version and row['include_version'] != include_version
+            if stale or not path.exists():
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                if stale:
+                    path.unlink(missing_ok=True)
+                return None
+
+            now = time.time()
+            if row['last_access'] < now - self.touch_interval:
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+        finally:
+            conn.close()
+
+        return {
+            'path': path,
+            'filename': row['filename'],
+            'size': row['size'],
+            'crop': json.loads(row['crop']) if row['crop'] else None,
+            'crop_pages': json.loads(row['crop_pages']) if row['crop_pages'] else None,
+            'page_sizes': json.loads(row['page_sizes']) if row['page_sizes'] else None,
+            'page_count': len(json.loads(row['page_sizes'])) if row['page_sizes'] else None,
+            'include_version': row['include_version'],
+            'uploaded': bool(row['uploaded']),
+        }
+
+    def put(self, key, source, crop=None, include_version=None, uploaded=False, pending_bucket=None,
+            crop_pages=None, page_sizes=None):
+        """
+        Store a PDF (path or bytes) under key and evict old entries if needed.
+
+        The file is written to a temp name and renamed into place, so readers
+        never see a partial PDF. With pending_bucket, the entry is queued for
+        upload to that bucket (see claim_upload). Returns the cached path.
+        """
+        filename = self.filename_for(key)
+        path = self.root / filename
+        tmp_path = self.root / f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            with open(tmp_path, 'wb') as f:
+                f.write(source)
+        else:
+            shutil.copyfile(source, tmp_path)
+        size = tmp_path.stat().st_size
+        os.replace(tmp_path, path)
+
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                """INSERT OR REPLACE INTO entries
+                   (key, filename, size, crop, include_version, uploaded, created_at, last_access,
+                    pending_bucket, next_upload_at, crop_pages, page_sizes)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (key, filename, size, json.dumps(crop) if crop else None,
+                 include_version, int(uploaded), now, now,
+                 None if uploaded else pending_bucket, now if pending_bucket and not uploaded else None,
+                 json.dumps(crop_pages) if crop_pages else None,
+                 json.dumps(page_sizes) if page_sizes else None)
+            )
+            self._evict(conn, keep=key)
+        finally:
+            conn.close()
+
+        return path
+
+    def find_latest(self, prefix, exclude=None):
+        """
+        Most recently stored entry whose key starts with prefix, skipping exclude.
+
+        Used to find an earlier build of the same chart variant. Returns
+        (key, entry) or None.
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT key FROM entries WHERE key >= ? AND key < ? AND key != ? ORDER BY created_at DESC",
+                (prefix, prefix + '\uffff', exclude or '')
+            ).fetchall()
+        finally:
+            conn.close()
+
+        for row in rows:
+            entry = self.get(row['key'])
+            if entry:
+                return row['key'], entry
+        return None
+
+    def mark_uploaded(self, key):
+        """Record that the entry's PDF is now in S3."""
+        conn = self._connect()
+        try:
+            conn.execute(
+                "UPDATE entries SET uploaded = 1, pending_bucket = NULL, next_upload_at = NULL WHERE key = ?",
+                (key,)
+            )
+        finally:
+            conn.close()
+
+    def claim_upload(self, lease=UPLOAD_LEASE_SECONDS):
+        """
+        Atomically claim the oldest entry due for upload.
+
+        The claim is a lease: if the claimer dies, the entry becomes due
+        again after lease seconds. Returns a dict with key, bucket, path,
+        size, crop, crop_pages, page_sizes, include_version, attempts and
+        created_at, or None.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                """SELECT * FROM entries WHERE pending_bucket IS NOT NULL AND next_upload_at <= ?
+                   ORDER BY next_upload_at LIMIT 1""",
+                (now,)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE entries SET next_upload_at = ? WHERE key = ?", (now + lease, row['key']))
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+        if not row:
+            return None
+        return {
+            'key': row['key'],
+            'bucket': row['pending_bucket'],
+            'path': self.root / row['filename'],
+            'size': row['size'],
+            'crop': json.loads(row['crop']) if row['crop'] else None,
+            'crop_pages': json.loads(row['crop_pages']) if row['crop_pages'] else None,
+            'page_sizes': json.loads(row['page_sizes']) if row['page_sizes'] else None,
+            'include_version': row['include_version'],
+            'attempts': row['upload_attempts'],
+            'created_at': row['created_at'],
+        }
+
+    def upload_failed(self, key, retry_at=None):
+        """Count a failed upload; retry at retry_at, or give up (entry stays local-only) if None."""
+        conn = self._connect()
+        try:
+            if retry_at is None:
+                conn.execute(
+                    """UPDATE entries SET upload_attempts = upload_attempts + 1,
+                       pending_bucket = NULL, next_upload_at = NULL WHERE key = ?""",
+                    (key,)
+                )
+            else:
+                conn.execute(
+                    "UPDATE entries SET upload_attempts = upload_attempts + 1, next_upload_at = ? WHERE key = ?",
+                    (retry_at, key)
+                )
+        finally:
+            conn.close()
+
+    def discard(self, key):
+        """Remove an entry and its file."""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        finally:
+            conn.close()
+        (self.root / self.filename_for(key)).unlink(missing_ok=True)
+
+    def stats(self):
+        """Entry count, total bytes and uploads still pending, for health and metrics."""
+        conn = self._connect()
+        try:
+            count, total, pending = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0), COUNT(pending_bucket) FROM entries"
+            ).fetchone()
+        finally:
+            conn.close()
+        return {'entries': count, 'bytes': total, 'max_bytes': self.max_bytes, 'pending_uploads': pending}
+
+    def _evict(self, conn, keep=None):
+        """
+        Drop least recently used entries (except keep) until the cache fits its cap.
+
+        Entries still waiting for upload go last: their file is the only copy.
+        """
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            victims = []
+            if total > self.max_bytes:
+                rows = conn.execute(
+                    """SELECT key, filename, size FROM entries WHERE key != ?
+                       ORDER BY pending_bucket IS NOT NULL, last_access""",
+                    (keep or '',)
+                ).fetchall()
+                for row in rows:
+                    if total <= self.max_bytes:
+                        break
+                    victims.append(row['filename'])
+                    conn.execute("DELETE FROM entries WHERE key = ?", (row['key'],))
+                    total -= row['size']
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+        for filename in victims:
+            (self.root / filename).unlink(missing_ok=True)
@@ -0,0 +1,43 @@
+"""
+Circuit breaker for S3.
+
+Every S3 call reports its outcome here (app.py hooks botocore's call
+events). After a run of consecutive failures - connection errors,
+timeouts, 5xx - the breaker opens for a cooldown, and code that has a
+local alternative uses it instead of handing out S3 URLs: charts in the
+local PDF cache are served from this machine. The first successful call
+closes the breaker again.
+
+State is per process; each gunicorn worker judges S3 by its own calls.
+"""
+import os
+import threading
+import time
+
+S3_FAILURE_THRESHOLD = int(os.getenv('S3_FAILURE_THRESHOLD', '3'))  # Consecutive failures that open the breaker
+S3_OPEN_SECONDS = float(os.getenv('S3_OPEN_SECONDS', '30'))         # How long it stays open without a success
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker. is_open() is cheap enough for every request."""
+
+    def __init__(self, threshold=S3_FAILURE_THRESHOLD, open_seconds=S3_OPEN_SECONDS):
+        self.threshold = max(1, threshold)
+        self.open_seconds = open_seconds
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = 0.0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._open_until = time.time() + self.open_seconds
+
+    def is_open(self):
+        return time.time() < self._open_until
@@ -0,0 +1,96 @@
+"""
+Single-flight coalescing for chart compiles.
+
+When several requests ask for the same chart at once (Groove Sync followers
+with the same instrument), only one LilyPond compile should run. Threads in
+the same process share the leader's result directly; other gunicorn workers
+serialize on a per-key file lock and re-check the cache once they get it.
+Lock files are removed by their holder on release, so cache/locks only
+holds locks for compiles in progress.
+"""
+import fcntl
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+LOCK_DIR = Path(os.getenv('COMPILE_LOCK_DIR', 'cache/locks'))
+
+
+class _Call:
+    """An in-flight call that followers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """
+    Run at most one fn per key at a time, across threads and processes.
+
+    fn is called while holding an exclusive file lock for the key, so it must
+    re-check for an existing result before doing expensive work - a caller in
+    another process may have just produced it.
+    """
+
+    def __init__(self, lock_dir=LOCK_DIR):
+        self.lock_dir = Path(lock_dir)
+        self._calls = {}
+        self._mutex = threading.Lock()
+
+    def lock_path(self, key):
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return self.lock_dir / f"{digest}.lock"
+
+    def do(self, key, fn):
+        """Return fn()'s result, sharing one call among concurrent callers of key."""
+        with self._mutex:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_locked(key, fn)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._mutex:
+                del self._calls[key]
+            call.done.set()
+            if call.followers:
+                print(f"🔗 Coalesced {call.followers} duplicate request(s) for {key}")
+        return call.result
+
+    def _run_locked(self, key, fn):
+        path = self.lock_path(key)
+        while True:
+            self.lock_dir.mkdir(parents=True, exist_ok=True)
+            with open(path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # The previous holder may have unlinked the file we waited on;
+                # then someone else can already be holding a new one
+                try:
+                    current = os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if not current:
+                    continue
+                try:
+                    return fn()
+                finally:
+                    path.unlink(missing_ok=True)
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
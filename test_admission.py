@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Tests for compile admission control.
+
+Run with: python3 test_admission.py
+Or with pytest: pytest test_admission.py -v
+"""
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from admission import CompileGate, CompileBusy, PRIORITIES
+
+
+def test_full_queue_is_refused_with_retry_after():
+    """Charts beyond slots + queue_max get CompileBusy instead of waiting."""
+    with tempfile.TemporaryDirectory() as tmp:
+        gate = CompileGate(Path(tmp) / 'gate.db', slots=1, queue_max=1)
+        gate.record_compile(4.0)
+
+        with gate.admit(), gate.admit():
+            try:
+                with gate.admit():
+                    pass
+                assert False, "Expected CompileBusy"
+            except CompileBusy as e:
+                assert e.retry_after >= 4
+                print(f"OK: refused, retry after {e.retry_after}s")
+
+        with gate.admit():
+            pass  # Room again once tickets are released
+
+
+def test_process_slots_are_exclusive():
+    """Only `slots` lilypond invocations hold a slot at once, across gate instances."""
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / 'gate.db'
+        gates = [CompileGate(db_path, slots=1), CompileGate(db_path, slots=1)]
+        active = []
+        overlaps = []
+
+        def run(gate):
+            with gate.slot():
+                active.append(1)
+                if len(active) > 1:
+                    overlaps.append(True)
+                time.sleep(0.1)
+                active.pop()
+
+        threads = [threading.Thread(target=run, args=(g,)) for g in gates]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert not overlaps, "Two invocations held the only slot"
+        assert gates[0].stats()['running'] == 0
+        print("OK: slots exclusive")
+
+
+def test_interactive_runs_before_waiting_prefetch():
+    """A free slot goes to the interactive lane even if prefetch asked first."""
+    with tempfile.TemporaryDirectory() as tmp:
+        gate = CompileGate(Path(tmp) / 'gate.db', slots=1)
+        order = []
+
+        def run(priority, name):
+            with gate.slot(priority):
+                order.append(name)
+
+        with gate.slot(PRIORITIES['interactive']):
+            prefetch = threading.Thread(target=run, args=(PRIORITIES['prefetch'], 'prefetch'))
+            prefetch.start()
+            time.sleep(0.1)
+            interactive = threading.Thread(target=run, args=(PRIORITIES['interactive'], 'interactive'))
+            interactive.start()
+            time.sleep(0.1)
+        prefetch.join()
+        interactive.join()
+
+        assert order == ['interactive', 'prefetch'], order
+        print(f"OK: {order}")
+
+
+def test_background_lanes_do_not_block_interactive_admission():
+    """Prefetch tickets don't count against interactive admission."""
+    with tempfile.TemporaryDirectory() as tmp:
+        gate = CompileGate(Path(tmp) / 'gate.db', slots=1, queue_max=0)
+        with gate.admit(PRIORITIES['prefetch']):
+            with gate.admit(PRIORITIES['interactive']):
+                pass
+            try:
+                with gate.admit(PRIORITIES['maintenance']):
+                    pass
+                assert False, "Expected CompileBusy for a second background chart"
+            except CompileBusy:
+                pass
+        print("OK: interactive admitted alongside prefetch")
+
+
+def test_unit_is_admitted_whole():
+    """A unit of charts gets in whenever one chart would, and holds a ticket per chart."""
+    with tempfile.TemporaryDirectory() as tmp:
+        gate = CompileGate(Path(tmp) / 'gate.db', slots=1, queue_max=1)
+        with gate.admit(charts=4):
+            assert gate.stats()['charts']['interactive'] == 4
+            try:
+                with gate.admit():
+                    pass
+                assert False, "Expected CompileBusy while the unit holds the gate"
+            except CompileBusy:
+                pass
+        assert gate.stats()['charts']['interactive'] == 0
+        print("OK: 4 charts admitted through a gate of 2")
+
+
+def test_tickets_of_dead_processes_are_reaped():
+    """Tickets left by a crashed worker don't block the queue forever."""
+    with tempfile.TemporaryDirectory() as tmp:
+        gate = CompileGate(Path(tmp) / 'gate.db', slots=1, queue_max=0)
+        conn = gate._connect()
+        conn.execute("INSERT INTO tickets (id, kind, pid, created_at) VALUES ('x', 'chart', 999999999, ?)",
+                     (time.time(),))
+        conn.close()
+
+        with gate.admit():
+            pass
+        print("OK: orphaned ticket reaped")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_full_queue_is_refused_with_retry_after,
+        test_process_slots_are_exclusive,
+        test_interactive_runs_before_waiting_prefetch,
+        test_background_lanes_do_not_block_interactive_admission,
+        test_unit_is_admitted_whole,
+        test_tickets_of_dead_processes_are_reaped,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
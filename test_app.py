@@ -0,0 +1,694 @@
+#!/usr/bin/env python3
+"""
+Tests for the generate endpoints.
+
+app.py loads its catalog and opens its queues at import time, so this
+module points every runtime path at a scratch directory, writes a small
+catalog there and imports the app with S3 off. LilyPond is replaced by a
+fake compile that writes a placeholder PDF.
+
+Run with: python3 test_app.py
+Or with pytest: pytest test_app.py -v
+"""
+
+import atexit
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from botocore.exceptions import EndpointConnectionError
+
+from compiler import CompileResult
+from test_db import make_catalog
+
+SCRATCH = Path(tempfile.mkdtemp(prefix='jazzpicker-test-app-'))
+atexit.register(shutil.rmtree, SCRATCH, ignore_errors=True)  # Runs after the app's own atexit flushes
+
+SONGS = ['Blue Bossa', 'Autumn Leaves', 'Solar', 'Giant Steps']
+# (environment variable, module, constant it sets, value)
+RUNTIME_PATHS = [
+    ('JOB_QUEUE_DB', 'compile_queue', 'QUEUE_DB_PATH', SCRATCH / 'cache' / 'jobs.db'),
+    ('COMPILE_GATE_DB', 'admission', 'GATE_DB_PATH', SCRATCH / 'cache' / 'compile_gate.db'),
+    ('COMPILE_LOCK_DIR', 'singleflight', 'LOCK_DIR', SCRATCH / 'cache' / 'locks'),
+    ('LOCAL_CACHE_DIR', 'pdf_cache', 'CACHE_DIR', SCRATCH / 'cache' / 'pdfs'),
+    ('ASSET_REGISTRY_DB', 'asset_registry', 'REGISTRY_DB_PATH', SCRATCH / 'assets.db'),
+    ('METRICS_DIR', 'metrics', 'METRICS_DIR', SCRATCH / 'cache' / 'metrics'),
+    ('COMPILE_SCRATCH_DIR', 'compiler', 'SCRATCH_ROOT', SCRATCH / 'sandboxes'),
+]
+TEST_ENV = {'USE_S3': 'false', 'CATALOG_RELOAD_INTERVAL': '0',
+            **{env_name: str(path) for env_name, _, _, path in RUNTIME_PATHS}}
+
+
+def import_app():
+    """Import app.py against the scratch directory, leaving the environment as it was."""
+    saved_env = {name: os.environ.get(name) for name in TEST_ENV}
+    saved_cwd = os.getcwd()
+    os.environ.update(TEST_ENV)
+    # Other test files may have imported these modules before the environment was set
+    for _, module, constant, path in RUNTIME_PATHS:
+        if module in sys.modules:
+            setattr(sys.modules[module], constant, path)
+    os.chdir(SCRATCH)
+    try:
+        make_catalog(SCRATCH / 'catalog.db', SONGS)
+        import app
+        return app
+    finally:
+        os.chdir(saved_cwd)
+        for name, value in saved_env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+app = import_app()
+client = app.app.test_client()
+
+
+@contextmanager
+def fake_lilypond(delay=0.0):
+    """Swap the compile daemon for one that writes a placeholder PDF; yields the list of compiled wrappers."""
+    compiled = []
+
+    def compile(wrapper_content, sandbox, priority=0):
+        compiled.append(wrapper_content)
+        time.sleep(delay)
+        pdf_path = Path(sandbox) / 'chart.pdf'
+        pdf_path.write_bytes(b'%PDF-1.4 fake chart')
+        return CompileResult(pdf_path=pdf_path, stderr='', batch_size=1, elapsed=delay)
+
+    app.lilypond_batcher.compile = compile
+    try:
+        yield compiled
+    finally:
+        del app.lilypond_batcher.compile
+
+
+class FakeS3:
+    """Just enough of a boto3 S3 client for the generate path."""
+
+    def __init__(self):
+        self.uploads = []
+        self.catalog = None  # (bytes, etag) served as catalog.db
+        self.catalog_requests = []  # (IfNoneMatch, status) per get_object
+
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+    def head_object(self, Bucket, Key):
+        raise app.ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.uploads.append(Key)
+
+    def upload_file(self, path, bucket, key, ExtraArgs=None):
+        self.uploads.append(key)
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        if self.catalog is None:
+            self.catalog_requests.append((IfNoneMatch, 404))
+            raise app.ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body, etag = self.catalog
+        if IfNoneMatch == f'"{etag}"':
+            self.catalog_requests.append((IfNoneMatch, 304))
+            raise app.ClientError({'Error': {'Code': '304'}}, 'GetObject')
+        self.catalog_requests.append((IfNoneMatch, 200))
+        return {'ETag': f'"{etag}"', 'Body': io.BytesIO(body)}
+
+
+class UnreachableS3(FakeS3):
+    """An S3 client whose endpoint can't be reached."""
+
+    def __init__(self):
+        super().__init__()
+        self.head_calls = 0
+
+    def head_object(self, Bucket, Key):
+        self.head_calls += 1
+        raise EndpointConnectionError(endpoint_url=f'https://{Bucket}.s3.amazonaws.com')
+
+
+class UnlistableS3(FakeS3):
+    """An S3 client whose bucket listings are refused."""
+
+    def get_paginator(self, name):
+        raise app.ClientError({'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'}}, 'ListObjectsV2')
+
+
+@contextmanager
+def fake_s3(client_class=FakeS3):
+    """Run with S3 'configured' (a FakeS3 client); yields the client."""
+    client = client_class()
+    app.s3_client = client
+    try:
+        yield client
+    finally:
+        app.s3_client = None
+        app.s3_breaker.record_success()
+
+
+@contextmanager
+def s3_catalog():
+    """
+    Point the catalog at a scratch catalog.db and sidecar, with a FakeS3
+    serving catalog.db; yields (client, catalog path, publish(titles, etag)).
+    The original catalog is reloaded afterwards.
+    """
+    saved = app.DB_FILE, app.CATALOG_META_FILE, app.USE_S3
+    with tempfile.TemporaryDirectory() as tmp, fake_s3() as s3:
+        db_path = Path(tmp) / 'catalog.db'
+        app.DB_FILE, app.CATALOG_META_FILE, app.USE_S3 = str(db_path), f'{db_path}.meta', True
+
+        def publish(titles, etag):
+            built = Path(tmp) / f'{etag}.db'
+            make_catalog(built, titles)
+            s3.catalog = (built.read_bytes(), etag)
+
+        try:
+            yield s3, db_path, publish
+        finally:
+            app.DB_FILE, app.CATALOG_META_FILE, app.USE_S3 = saved
+            app.load_catalog(SCRATCH / 'catalog.db')
+
+
+def clear_cache():
+    """Forget every compiled chart so each test starts cold."""
+    for key in [row[0] for row in app.pdf_cache._connect().execute("SELECT key FROM entries")]:
+        app.pdf_cache.discard(key)
+
+
+def cache_chart(song, concert_key, transposition='C', clef='treble', octave_offset=0):
+    """Put a chart in the local cache as if it had been compiled earlier."""
+    resolved = app.db.resolve_song_for_generation(song)
+    key = app.chart_key(app.slugify(song), resolved.core_files[0], resolved.source, concert_key,
+                        transposition, clef, octave_offset)
+    app.pdf_cache.put(key, b'%PDF-1.4 cached chart')
+    return key
+
+
+def old_build_key(current_key):
+    """Key of an earlier build of the same variant (another content hash)."""
+    base, digest, suffix = current_key.rsplit('.', 2)
+    return f"{base}.{'0' * 16 if digest != '0' * 16 else '1' * 16}.{suffix}"
+
+
+def wait_for_revalidation(timeout=5):
+    deadline = time.time() + timeout
+    while app.revalidating and time.time() < deadline:
+        time.sleep(0.02)
+    assert not app.revalidating, "Revalidation did not finish"
+
+
+def item(song, concert_key, **fields):
+    return {'song': song, 'concert_key': concert_key, 'transposition': 'C', 'clef': 'treble',
+            'octave_offset': 0, **fields}
+
+
+def test_batch_reports_every_item_by_index():
+    """Hits, misses, unknown songs and invalid items all come back in request order."""
+    clear_cache()
+    cache_chart('Blue Bossa', 'c')
+    with fake_lilypond() as compiled:
+        response = client.post('/api/v2/generate/batch', json={'items': [
+            item('Blue Bossa', 'c'),
+            item('Solar', 'd'),
+            item('Nonexistent Song', 'c'),
+            {'song': 'Solar', 'concert_key': 'h'},
+        ]})
+
+    assert response.status_code == 200
+    items = response.get_json()['items']
+    assert [i['index'] for i in items] == [0, 1, 2, 3]
+    assert [i['status'] for i in items] == [200, 200, 404, 400]
+    assert items[0]['cached'] is True and items[1]['cached'] is False
+    assert items[1]['url'].startswith('http://localhost/pdfs/')
+    assert len(compiled) == 1, "Only the miss should compile"
+    timing = response.headers['Server-Timing']
+    assert 'lilypond;dur=' in timing, "Stages from the compile pool belong to the request"
+    assert 'total;dur=' in timing
+    print(f"OK: {[i['status'] for i in items]}")
+
+
+def test_batch_streams_ndjson():
+    """Streaming mode writes one JSON object per line, hits first."""
+    clear_cache()
+    cache_chart('Autumn Leaves', 'g')
+    with fake_lilypond(delay=0.1):
+        response = client.post('/api/v2/generate/batch', json={
+            'stream': True,
+            'items': [item('Solar', 'c'), item('Autumn Leaves', 'g')],
+        })
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert response.mimetype == 'application/x-ndjson'
+    assert [line['index'] for line in lines] == [1, 0], "Cached item should stream first"
+    assert all(line['status'] == 200 for line in lines)
+    print("OK: NDJSON in completion order")
+
+
+def test_every_generate_response_has_server_timing():
+    """Async, streamed, band and refused requests all carry Server-Timing."""
+    clear_cache()
+    cache_chart('Solar', 'c')
+    with fake_lilypond():
+        responses = {
+            'async': client.post('/api/v2/generate', json={**item('Solar', 'c'), 'async': True}),
+            'stream': client.post('/api/v2/generate/batch', json={'stream': True, 'items': [item('Solar', 'c')]}),
+            'band': client.post('/api/v2/generate/band', json={'song': 'Solar', 'concert_key': 'c',
+                                                               'instruments': ['Piano']}),
+            'refused': client.post('/api/v2/generate/batch', json={}),
+        }
+        responses['stream'].get_data()
+
+    assert [r.status_code for r in responses.values()] == [202, 200, 200, 400]
+    for name, response in responses.items():
+        assert 'total;dur=' in response.headers.get('Server-Timing', ''), f"{name} has no Server-Timing"
+    print("OK: Server-Timing on every generate endpoint")
+
+
+def test_batch_rejects_bad_requests():
+    """Missing items, oversize batches and unknown lanes are refused up front."""
+    assert client.post('/api/v2/generate/batch', json={}).status_code == 400
+    too_many = {'items': [item('Solar', 'c')] * (app.MAX_BATCH_ITEMS + 1)}
+    assert client.post('/api/v2/generate/batch', json=too_many).status_code == 400
+    bad_lane = {'items': [item('Solar', 'c')], 'priority': 'urgent'}
+    assert client.post('/api/v2/generate/batch', json=bad_lane).status_code == 400
+    print("OK: bad batches refused")
+
+
+def test_cached_band_does_not_wait_behind_prefetch_batch():
+    """A fully cached band answers at once while a slow prefetch batch compiles."""
+    clear_cache()
+    for transposition, clef in (('Bb', 'treble'), ('C', 'bass')):
+        for octave_offset in range(-2, 3):
+            cache_chart('Blue Bossa', 'f', transposition, clef, octave_offset)
+
+    with fake_lilypond(delay=0.5):
+        # More misses than the pool has workers
+        misses = [item('Giant Steps', key, octave_offset=octave_offset)
+                  for key in sorted(app.VALID_KEYS) for octave_offset in range(-2, 3)]
+        batch = threading.Thread(target=client.post, args=('/api/v2/generate/batch',), kwargs={
+            'json': {'items': misses[:app.PREFETCH_WORKERS + 4]}
+        })
+        batch.start()
+        time.sleep(0.1)  # Let the batch fill the pool
+
+        start = time.time()
+        response = client.post('/api/v2/generate/band', json={
+            'song': 'Blue Bossa', 'concert_key': 'f', 'instruments': ['Trumpet', 'Bass'],
+        })
+        elapsed = time.time() - start
+        batch.join(30)
+
+    charts = response.get_json()['charts']
+    assert all(chart['status'] == 200 and chart['cached'] for chart in charts.values()), charts
+    assert elapsed < 0.4, f"Cached band took {elapsed:.2f}s"
+    print(f"OK: cached band answered in {elapsed * 1000:.0f}ms")
+
+
+def test_interactive_batch_does_not_wait_behind_prefetch():
+    """Interactive misses compile on their own pool while prefetch misses fill theirs."""
+    clear_cache()
+    with fake_lilypond(delay=0.5):
+        misses = [item('Giant Steps', key, octave_offset=octave_offset)
+                  for key in sorted(app.VALID_KEYS) for octave_offset in range(-2, 3)]
+        prefetch = threading.Thread(target=client.post, args=('/api/v2/generate/batch',), kwargs={
+            'json': {'items': misses[:app.BATCH_WORKERS + 4], 'priority': 'prefetch'}
+        })
+        prefetch.start()
+        time.sleep(0.1)  # Let the prefetch fill its pool
+
+        start = time.time()
+        response = client.post('/api/v2/generate/batch', json={
+            'items': [item('Solar', 'd')], 'priority': 'interactive',
+        })
+        elapsed = time.time() - start
+        prefetch.join(60)
+
+    assert response.get_json()['items'][0]['status'] == 200
+    assert elapsed < 0.9, f"Interactive miss took {elapsed:.2f}s behind the prefetch"
+    print(f"OK: interactive miss compiled in {elapsed * 1000:.0f}ms")
+
+
+def test_interactive_request_is_not_coalesced_onto_prefetch():
+    """A chart being prefetched behind a full gate still gets an interactive 429, not a long wait."""
+    clear_cache()
+    chart = item('Blue Bossa', 'f')
+    saved = app.compile_gate.slots, app.compile_gate.queue_max
+    app.compile_gate.slots, app.compile_gate.queue_max = 1, 0
+    release = threading.Event()
+
+    def hold_gate():
+        with app.compile_gate.admit(app.PRIORITIES[app.INTERACTIVE]):
+            release.wait(5)
+
+    holder = threading.Thread(target=hold_gate)
+    prefetched = []
+    prefetch = threading.Thread(target=lambda: prefetched.append(
+        client.post('/api/v2/generate', json={**chart, 'priority': 'prefetch'})))
+    try:
+        with fake_lilypond() as compiled:
+            holder.start()
+            time.sleep(0.1)
+            prefetch.start()
+            time.sleep(0.2)  # The prefetch is now waiting for room
+
+            start = time.time()
+            response = client.post('/api/v2/generate', json=chart)
+            elapsed = time.time() - start
+            release.set()
+            prefetch.join(10)
+    finally:
+        release.set()
+        holder.join(10)
+        app.compile_gate.slots, app.compile_gate.queue_max = saved
+
+    assert response.status_code == 429, response.get_json()
+    assert elapsed < 1, f"Interactive request waited {elapsed:.2f}s on the prefetch"
+    assert prefetched[0].status_code == 200 and len(compiled) == 1
+    print(f"OK: interactive 429 in {elapsed * 1000:.0f}ms while the prefetch waited")
+
+
+def test_band_larger_than_compile_capacity_is_admitted_whole():
+    """A cold band needing more compiles than the gate holds gets every chart, or one 429 for all."""
+    clear_cache()
+    band = {'song': 'Autumn Leaves', 'concert_key': 'g',
+            'instruments': ['Trumpet', 'Alto Sax', 'Flute', 'Bass']}
+    saved = app.compile_gate.slots, app.compile_gate.queue_max
+    app.compile_gate.slots, app.compile_gate.queue_max = 1, 0
+    try:
+        with fake_lilypond(delay=0.2) as compiled:
+            with app.compile_gate.admit(app.PRIORITIES[app.INTERACTIVE]):
+                busy = client.post('/api/v2/generate/band', json=band).get_json()
+            response = client.post('/api/v2/generate/band', json=band).get_json()
+    finally:
+        app.compile_gate.slots, app.compile_gate.queue_max = saved
+
+    assert {chart['status'] for chart in busy['charts'].values()} == {429}, busy
+    assert response['variants'] > 1, "Band should need more compiles than the gate of 1 holds"
+    assert all(chart['status'] == 200 for chart in response['charts'].values()), response
+    assert len(compiled) == response['variants']
+    print(f"OK: {response['variants']} variants compiled through a gate of 1")
+
+
+def test_chart_key_is_content_addressed():
+    """Keys parse back into their variant and change when the Core file changes."""
+    resolved = app.db.resolve_song_for_generation('Solar')
+    key = app.chart_key('solar', resolved.core_files[0], resolved.source, 'ef', 'Bb', 'treble', -1)
+
+    parsed = app.parse_generated_key(key)
+    assert (parsed['slug'], parsed['concert_key'], parsed['transposition'], parsed['clef'],
+            parsed['octave_offset']) == ('solar', 'ef', 'Bb', 'treble', -1)
+    assert len(parsed['hash']) == 16
+
+    saved_dir = app.LILYPOND_DATA_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        # Point the app at a Core directory we can edit
+        app.LILYPOND_DATA_DIR = Path(tmp)
+        try:
+            core_path = app.core_dir_for(resolved.source) / resolved.core_files[0]
+            core_path.parent.mkdir(parents=True)
+            core_path.write_text('melody = { c }')
+            before = app.chart_key('solar', resolved.core_files[0], resolved.source, 'ef', 'Bb', 'treble', -1)
+            core_path.write_text('melody = { c d }')
+            after = app.chart_key('solar', resolved.core_files[0], resolved.source, 'ef', 'Bb', 'treble', -1)
+        finally:
+            app.LILYPOND_DATA_DIR = saved_dir
+
+    assert before != after
+    assert app.parse_generated_key(before)['slug'] == app.parse_generated_key(after)['slug'] == 'solar'
+    print(f"OK: {key}")
+
+
+def test_find_stale_chart_returns_earlier_build():
+    """An earlier build of the variant is found; the current key itself never is."""
+    clear_cache()
+    current = cache_chart('Solar', 'c')
+    assert app.find_stale_chart(app.S3_BUCKET, 'solar-c-C-treble-0', current) is None
+
+    old = old_build_key(current)
+    app.pdf_cache.put(old, b'%PDF-1.4 old build')
+    stale = app.find_stale_chart(app.S3_BUCKET, 'solar-c-C-treble-0', current)
+
+    assert stale['stale'] is True and stale['cached'] is True
+    assert f"/pdfs/{app.pdf_cache.filename_for(old)}" in stale['url']
+    print("OK: earlier build found")
+
+
+def test_stale_build_served_while_revalidating():
+    """With only an earlier build cached, it is served at once and recompiled in the background."""
+    clear_cache()
+    old = old_build_key(cache_chart('Solar', 'd'))
+    clear_cache()
+    app.pdf_cache.put(old, b'%PDF-1.4 old build')
+
+    with fake_lilypond(delay=0.1) as compiled:
+        first = client.post('/api/v2/generate', json=item('Solar', 'd')).get_json()
+        assert first['stale'] is True and first['cached'] is True
+        wait_for_revalidation()
+        assert len(compiled) == 1, "Expected one background recompile"
+
+        second = client.post('/api/v2/generate', json=item('Solar', 'd')).get_json()
+    assert 'stale' not in second and second['cached'] is True
+    print("OK: stale served, then fresh")
+
+
+def test_allow_stale_false_compiles_now():
+    """Clients that refuse stale builds wait for the current one."""
+    clear_cache()
+    old = old_build_key(cache_chart('Solar', 'e'))
+    clear_cache()
+    app.pdf_cache.put(old, b'%PDF-1.4 old build')
+
+    with fake_lilypond() as compiled:
+        result = client.post('/api/v2/generate', json=item('Solar', 'e', allow_stale=False)).get_json()
+    assert 'stale' not in result and result['cached'] is False
+    assert len(compiled) == 1 and not app.revalidating
+    print("OK: compiled synchronously")
+
+
+def test_cached_keys_honor_stale_while_revalidate():
+    """Earlier builds only count as cached keys when stale-while-revalidate is on."""
+    resolved = app.db.resolve_song_for_generation('Autumn Leaves')
+    current = app.chart_key('autumn-leaves', resolved.core_files[0], resolved.source, 'd', 'C', 'treble', 0)
+    old = old_build_key(
+        app.chart_key('autumn-leaves', resolved.core_files[0], resolved.source, 'c', 'C', 'treble', 0))
+    for key in (current, old):
+        app.asset_registry.register(key, app.S3_BUCKET, app.parse_generated_key(key))
+
+    saved = app.STALE_WHILE_REVALIDATE
+    try:
+        with fake_s3():
+            found = {}
+            for swr in (True, False):
+                app.STALE_WHILE_REVALIDATE = swr
+                all_keys = client.get('/api/v2/cached-keys?transposition=C').get_json()['cached_keys']
+                song_keys = client.get('/api/v2/songs/Autumn Leaves/cached?transposition=C').get_json()
+                found[swr] = (sorted(all_keys['autumn-leaves']), sorted(song_keys['cached_concert_keys']))
+    finally:
+        app.STALE_WHILE_REVALIDATE = saved
+        for key in (current, old):
+            app.asset_registry.remove(key, app.S3_BUCKET)
+
+    assert found[True] == (['c', 'd'], ['c', 'd'])
+    assert found[False] == (['d'], ['d'])
+    print(f"OK: {found}")
+
+
+def test_uploaded_chart_served_locally_while_s3_is_failing():
+    """A cached chart that is in S3 gets a presigned URL, or a local one once the breaker opens."""
+    clear_cache()
+    with fake_s3():
+        key = cache_chart('Solar', 'c')
+        app.pdf_cache.mark_uploaded(key)
+
+        response = client.post('/api/v2/generate', json=item('Solar', 'c'))
+        assert response.get_json()['url'].startswith('https://jazz-picker-pdfs.s3.amazonaws.com/')
+
+        for _ in range(app.s3_breaker.threshold):
+            app.s3_breaker.record_failure()
+        response = client.post('/api/v2/generate', json=item('Solar', 'c'))
+        url = response.get_json()['url']
+        assert '/pdfs/' in url and 's3.amazonaws.com' not in url, url
+        assert client.get(url).status_code == 200
+    print("OK: local fallback while S3 is down")
+
+
+def test_write_behind_url_is_absolute_and_names_its_machine():
+    """A fresh compile waiting for upload gets an absolute link that other machines replay."""
+    clear_cache()
+    saved = app.PUBLIC_BASE_URL, app.MACHINE_ID
+    app.PUBLIC_BASE_URL, app.MACHINE_ID = 'https://jazz-picker.example', 'machine-a'
+    try:
+        with fake_s3(), fake_lilypond():
+            data = client.post('/api/v2/generate', json=item('Solar', 'e')).get_json()
+        url = data['url']
+        assert data['cached'] is False
+        assert url.startswith('https://jazz-picker.example/pdfs/') and url.endswith('&instance=machine-a'), url
+
+        path = url[len('https://jazz-picker.example'):]
+        assert client.get(path).status_code == 200
+        clear_cache()  # As seen from machine-b: the file is only on machine-a
+        app.MACHINE_ID = 'machine-b'
+        response = client.get(path)
+        assert response.status_code == 409 and response.headers['fly-replay'] == 'instance=machine-a'
+    finally:
+        app.PUBLIC_BASE_URL, app.MACHINE_ID = saved
+    print(f"OK: {url.split('?')[0]}")
+
+
+def test_miss_compiles_locally_while_s3_is_unreachable():
+    """Connection errors make a lookup a miss: the chart compiles and is served from here."""
+    clear_cache()
+    with fake_s3(UnreachableS3) as s3, fake_lilypond() as compiled:
+        response = client.post('/api/v2/generate', json=item('Giant Steps', 'bf'))
+        assert response.status_code == 200, response.get_json()
+        assert '/pdfs/' in response.get_json()['url']
+        assert len(compiled) == 1 and s3.head_calls > 0
+        head_calls = s3.head_calls
+
+        for _ in range(app.s3_breaker.threshold):
+            app.s3_breaker.record_failure()
+        response = client.post('/api/v2/generate', json=item('Giant Steps', 'c'))
+        assert response.status_code == 200
+        assert s3.head_calls == head_calls, "No S3 lookups while the breaker is open"
+    print("OK: compiled locally with S3 down")
+
+
+def test_failed_registry_rebuild_is_reported():
+    """A rebuild that can't list S3 answers 502 instead of claiming an empty bucket."""
+    with fake_s3(UnlistableS3):
+        response = client.post('/api/v2/registry/rebuild')
+    assert response.status_code == 502, response.get_json()
+    assert 'AccessDenied' in response.get_json()['error']
+    print(f"OK: {response.get_json()['error']}")
+
+
+def test_old_generated_links_redirect_to_local_build():
+    """/generated/ links from before sandboxed compiles redirect to the cached build, or 404."""
+    clear_cache()
+    cache_chart('Solar', 'c')
+
+    response = client.get('/generated/solar-c-C-treble-0.pdf')
+    assert response.status_code == 302
+    assert response.location.startswith('http://localhost/pdfs/'), response.location
+    assert client.get(response.location).data == b'%PDF-1.4 cached chart'
+    assert client.get('/generated/solar-d-C-treble-0.pdf').status_code == 404
+    print(f"OK: redirected to {response.location.split('?')[0]}")
+
+
+def test_health_timings_keep_labels():
+    """Histograms that differ only by label get their own /health timing entry."""
+    app.metrics.observe('test_health_seconds', 0.002, route='/a')
+    app.metrics.observe('test_health_seconds', 0.2, route='/b')
+
+    timings = client.get('/health').get_json()['timings']
+    assert timings['test_health_seconds{route="/a"}']['count'] == 1
+    assert timings['test_health_seconds{route="/b"}']['count'] == 1
+    print(f"OK: {sorted(timings)}")
+
+
+def test_catalog_download_is_skipped_while_etag_matches():
+    """A catalog downloaded with an ETag is re-checked with If-None-Match and kept on 304."""
+    with s3_catalog() as (s3, db_path, publish):
+        publish(SONGS, 'etag-1')
+        assert app.download_catalog(app.local_catalog_etag(db_path)) == 'etag-1'
+        assert app.read_catalog_meta()['s3_etag'] == 'etag-1'
+        downloaded = db_path.stat().st_mtime_ns
+
+        assert app.download_catalog(app.local_catalog_etag(db_path)) is None
+        assert s3.catalog_requests == [(None, 200), ('"etag-1"', 304)], s3.catalog_requests
+        assert db_path.stat().st_mtime_ns == downloaded
+    print("OK: 304 keeps catalog.db")
+
+
+def test_missing_or_corrupt_sidecar_downloads_again():
+    """Without a trustworthy sidecar there is no ETag to send, so the catalog is fetched in full."""
+    with s3_catalog() as (s3, db_path, publish):
+        publish(SONGS, 'etag-1')
+        app.download_catalog()
+        meta_path = Path(app.CATALOG_META_FILE)
+
+        meta_path.unlink()
+        assert app.local_catalog_etag(db_path) is None
+
+        meta_path.write_text('{not json')
+        assert app.local_catalog_etag(db_path) is None
+
+        meta_path.write_text(json.dumps({'sha256': '0' * 64, 's3_etag': 'etag-1'}))
+        assert app.local_catalog_etag(db_path) is None, "Sidecar for other contents must not be trusted"
+
+        assert app.download_catalog(app.local_catalog_etag(db_path)) == 'etag-1'
+        assert app.local_catalog_etag(db_path) == 'etag-1', "Download should rewrite the sidecar"
+        assert [status for _, status in s3.catalog_requests] == [200, 200]
+    print("OK: sidecar rebuilt")
+
+
+def test_catalog_reloads_when_s3_etag_changes():
+    """A new catalog in S3 is downloaded and loaded by check_catalog_update."""
+    with s3_catalog() as (s3, db_path, publish):
+        publish(SONGS, 'etag-1')
+        app.init_catalog_db()
+        assert app.catalog_song_count == len(SONGS)
+        assert app.check_catalog_update() is False
+
+        publish(SONGS + ['Stella By Starlight'], 'etag-2')
+        assert app.check_catalog_update() is True
+        assert app.catalog_song_count == len(SONGS) + 1
+        assert app.read_catalog_meta()['s3_etag'] == 'etag-2'
+        assert s3.catalog_requests[-1] == ('"etag-1"', 200)
+    assert app.catalog_song_count == len(SONGS)
+    print("OK: reloaded on ETag change")
+
+
+if __name__ == "__main__":
+    tests = [
+        test_batch_reports_every_item_by_index,
+        test_batch_streams_ndjson,
+        test_every_generate_response_has_server_timing,
+        test_batch_rejects_bad_requests,
+        test_cached_band_does_not_wait_behind_prefetch_batch,
+        test_interactive_batch_does_not_wait_behind_prefetch,
+        test_interactive_request_is_not_coalesced_onto_prefetch,
+        test_band_larger_than_compile_capacity_is_admitted_whole,
+        test_chart_key_is_content_addressed,
+        test_find_stale_chart_returns_earlier_build,
+        test_stale_build_served_while_revalidating,
+        test_allow_stale_false_compiles_now,
+        test_cached_keys_honor_stale_while_revalidate,
+        test_uploaded_chart_served_locally_while_s3_is_failing,
+        test_write_behind_url_is_absolute_and_names_its_machine,
+        test_miss_compiles_locally_while_s3_is_unreachable,
+        test_failed_registry_rebuild_is_reported,
+        test_old_generated_links_redirect_to_local_build,
+        test_health_timings_keep_labels,
+        test_catalog_download_is_skipped_while_etag_matches,
+        test_missing_or_corrupt_sidecar_downloads_again,
+        test_catalog_reloads_when_s3_etag_changes,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
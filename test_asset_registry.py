@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Tests for the generated asset registry.
+
+Run with: python3 test_asset_registry.py
+Or with pytest: pytest test_asset_registry.py -v
+"""
+
+import datetime
+import os
+import tempfile
+from pathlib import Path
+
+from asset_registry import AssetRegistry
+
+KEY = 'generated/blue-bossa-c-Bb-treble-0.0123456789abcdef.pdf'
+PARSED = {'slug': 'blue-bossa', 'concert_key': 'c', 'transposition': 'Bb',
+          'clef': 'treble', 'octave_offset': 0, 'hash': '0123456789abcdef'}
+
+
+def parse_key(key):
+    return dict(PARSED) if key.startswith('generated/blue-bossa-') else None
+
+
+class FakePaginator:
+    def __init__(self, keys):
+        self.keys = keys
+
+    def paginate(self, Bucket, Prefix):
+        modified = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        yield {'Contents': [{'Key': k, 'Size': 42, 'LastModified': modified} for k in self.keys]}
+
+
+class FakeS3:
+    def __init__(self, keys):
+        self.keys = keys
+
+    def get_paginator(self, name):
+        return FakePaginator(self.keys)
+
+
+def test_register_and_get_counts_hits():
+    """Registered assets come back with their metadata and a hit count."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = AssetRegistry(Path(tmp) / 'assets.db')
+        crop = {'top': 10.0, 'bottom': 20.0, 'left': 5.0, 'right': 5.0}
+        registry.register(KEY, 'bucket', PARSED, 'abc123', crop, page_count=2, byte_size=1000)
+
+        registry.get(KEY, 'bucket')
+        asset = registry.get(KEY, 'bucket')
+
+        assert asset['crop'] == crop
+        assert asset['page_count'] == 2
+        assert asset['hit_count'] == 2
+        assert registry.get(KEY, 'other-bucket') is None
+        assert registry.variants('Bb', 'treble', 'bucket') == [('blue-bossa', 'c')]
+        print(f"OK: {asset['key']}")
+
+
+def test_hits_are_buffered_until_flush():
+    """Hits are counted in memory and written in one batch."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = AssetRegistry(Path(tmp) / 'assets.db', flush_interval=3600)
+        registry.register(KEY, 'bucket', PARSED)
+        for _ in range(3):
+            registry.get(KEY, 'bucket')
+
+        def stored_hits():
+            return registry._connect().execute("SELECT hit_count FROM assets").fetchone()[0]
+
+        assert stored_hits() == 0, "Hits should not be written on every lookup"
+        assert registry.get(KEY, 'bucket', touch=False)['hit_count'] == 3
+
+        registry.flush_hits()
+        assert stored_hits() == 3
+        assert AssetRegistry(Path(tmp) / 'assets.db').get(KEY, 'bucket', touch=False)['hit_count'] == 3
+        print("OK: 3 hits, 1 write")
+
+
+def test_rebuild_from_listing():
+    """A rebuild adds listed objects without metadata and drops missing ones."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = AssetRegistry(Path(tmp) / 'assets.db')
+        registry.register('generated/blue-bossa-gone.pdf', 'bucket', PARSED)
+
+        found = registry.rebuild_from_s3(FakeS3([KEY, 'generated/unrelated.pdf']), ['bucket'], parse_key)
+
+        asset = registry.get(KEY, 'bucket', touch=False)
+        assert found == 1
+        assert registry.count() == 1
+        assert asset['metadata_loaded'] is False and asset['byte_size'] == 42
+
+        registry.update_metadata(KEY, 'bucket', 'abc123', None)
+        assert registry.get(KEY, 'bucket')['metadata_loaded'] is True
+        print("OK: registry rebuilt from listing")
+
+
+def test_same_key_in_two_buckets():
+    """Standard and custom buckets can hold the same key without touching each other's rows."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = AssetRegistry(Path(tmp) / 'assets.db')
+        registry.register(KEY, 'standard', PARSED, byte_size=1)
+        registry.register(KEY, 'custom', PARSED, byte_size=2)
+        assert registry.count() == 2
+        assert registry.get(KEY, 'custom', touch=False)['byte_size'] == 2
+
+        registry.remove(KEY, 'custom')
+        assert registry.get(KEY, 'standard', touch=False)['byte_size'] == 1
+
+        registry.register(KEY, 'custom', PARSED, byte_size=2)
+        registry.rebuild_from_s3(FakeS3([KEY]), ['standard'], parse_key)
+        assert registry.get(KEY, 'custom', touch=False), "Rebuilding one bucket must keep the other's rows"
+        assert registry.get(KEY, 'standard', touch=False)['byte_size'] == 1, "Listed rows keep their metadata"
+        print("OK: rows keyed by (bucket, key)")
+
+
+def test_find_latest_skips_excluded_key():
+    """find_latest returns the newest other build of the same variant."""
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = AssetRegistry(Path(tmp) / 'assets.db')
+        prefix = 'generated/blue-bossa-c-Bb-treble-0.'
+        registry.register(prefix + 'a' * 16 + '.pdf', 'bucket', PARSED, created_at=100)
+        registry.register(prefix + 'b' * 16 + '.pdf', 'bucket', PARSED, created_at=200)
+        registry.register(prefix + 'c' * 16 + '.pdf', 'bucket', PARSED, created_at=300)
+
+        latest = registry.find_latest(prefix, 'bucket', exclude=prefix + 'c' * 16 + '.pdf')
+
+        assert latest['key'] == prefix + 'b' * 16 + '.pdf'
+        print(f"OK: {latest['key']}")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_register_and_get_counts_hits,
+        test_hits_are_buffered_until_flush,
+        test_rebuild_from_listing,
+        test_same_key_in_two_buckets,
+        test_find_latest_skips_excluded_key,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Tests for the generation job queue.
+
+Run with: python3 test_compile_queue.py
+Or with pytest: pytest test_compile_queue.py -v
+"""
+
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from compile_queue import JobQueue, DONE, FAILED
+
+
+@contextmanager
+def open_queues():
+    """Temp dir plus a factory for queues in it; every queue is stopped before cleanup."""
+    queues = []
+    with tempfile.TemporaryDirectory() as tmp:
+        def make(handler, **kwargs):
+            queue = JobQueue(Path(tmp) / 'jobs.db', handler, **kwargs)
+            queues.append(queue)
+            return queue
+        try:
+            yield make
+        finally:
+            for queue in queues:
+                queue.stop()
+
+
+def fake_handler(params):
+    """Stand-in for generate_chart: echoes the song, fails on unknown songs."""
+    if params['song'] == 'Missing':
+        return {'error': 'Song not found: Missing'}, 404
+    return {'url': f"/generated/{params['song']}.pdf", 'cached': False}, 200
+
+
+def test_job_completes_with_result():
+    """A queued job should finish with the handler's payload."""
+    with open_queues() as make_queue:
+        queue = make_queue(fake_handler)
+        job_id = queue.enqueue({'song': 'blue-bossa'})
+
+        job = queue.wait(job_id, timeout=5)
+
+        assert job['status'] == DONE, f"Expected done, got {job['status']}"
+        assert job['result']['url'] == '/generated/blue-bossa.pdf'
+        print(f"OK: job {job_id} finished with {job['result']}")
+
+
+def test_failed_job_keeps_status():
+    """Handler errors should surface as a failed job with the original status."""
+    with open_queues() as make_queue:
+        queue = make_queue(fake_handler)
+        job_id = queue.enqueue({'song': 'Missing'})
+
+        job = queue.wait(job_id, timeout=5)
+
+        assert job['status'] == FAILED
+        assert job['http_status'] == 404
+        print("OK: failed job reports 404")
+
+
+def test_jobs_visible_across_queue_instances():
+    """A second queue on the same file (another gunicorn worker) sees and drains jobs."""
+    with open_queues() as make_queue:
+        release = threading.Event()
+
+        def blocked_handler(params):
+            release.wait(5)
+            return fake_handler(params)
+
+        producer = make_queue(blocked_handler)
+        job_id = producer.enqueue({'song': 'autumn-leaves'})
+
+        consumer = make_queue(fake_handler)
+        assert consumer.get(job_id) is not None, "Job not visible from second queue"
+
+        release.set()
+        job = consumer.wait(job_id, timeout=5)
+        assert job['status'] == DONE
+        print("OK: job visible and completed across queue instances")
+
+
+def test_unknown_job_returns_none():
+    """Status lookups for unknown ids should return None."""
+    with open_queues() as make_queue:
+        queue = make_queue(fake_handler)
+        assert queue.get('does-not-exist') is None
+        print("OK: unknown job is None")
+
+
+def test_long_job_is_not_reclaimed():
+    """A job running longer than its lease keeps it renewed and runs exactly once."""
+    with open_queues() as make_queue:
+        runs = []
+
+        def slow_handler(params):
+            runs.append(params['song'])
+            time.sleep(1.5)
+            return fake_handler(params)
+
+        first = make_queue(slow_handler, lease_seconds=0.3)
+        job_id = first.enqueue({'song': 'giant-steps'})
+        # Another worker polling the same queue while the lease would have lapsed
+        second = make_queue(slow_handler, lease_seconds=0.3)
+        second.start()
+
+        job = first.wait(job_id, timeout=5)
+        assert job['status'] == DONE
+        assert runs == ['giant-steps'], f"Job ran {len(runs)} times"
+        print("OK: lease renewed while the handler ran")
+
+
+def test_finished_job_expires_after_retention():
+    """Finished jobs disappear once their retention (URL lifetime) has passed."""
+    with open_queues() as make_queue:
+        queue = make_queue(fake_handler, retention=0.5)
+        job_id = queue.enqueue({'song': 'blue-bossa'})
+        assert queue.wait(job_id, timeout=5)['status'] == DONE
+
+        time.sleep(0.6)
+        assert queue.get(job_id) is None
+        print("OK: expired job is no longer reported")
+
+
+def test_stop_joins_workers():
+    """stop() ends the worker threads, and start() no longer revives them."""
+    with open_queues() as make_queue:
+        queue = make_queue(fake_handler)
+        queue.start()
+        threads = list(queue._threads)
+
+        queue.stop()
+        assert not any(t.is_alive() for t in threads)
+        queue.start()
+        assert not queue._threads
+        print("OK: workers stopped")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_job_completes_with_result,
+        test_failed_job_keeps_status,
+        test_jobs_visible_across_queue_instances,
+        test_unknown_job_returns_none,
+        test_long_job_is_not_reclaimed,
+        test_finished_job_expires_after_retention,
+        test_stop_joins_workers,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
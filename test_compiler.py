@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Tests for the LilyPond compile helpers.
+
+Uses a fake `lilypond` on PATH that writes placeholder PDFs and logs like
+the real one, so no LilyPond install is needed.
+
+Run with: python3 test_compiler.py
+Or with pytest: pytest test_compiler.py -v
+"""
+
+import os
+import stat
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
+import compiler
+from compiler import (LilyPondBatcher, compile_sandbox, content_hash, run_lilypond, split_stderr,
+                      sweep_sandboxes)
+
+# Stand-in for lilypond: "-o" names the output (a folder with several inputs),
+# "-" reads the one wrapper from stdin. A wrapper containing "BROKEN" fails.
+FAKE_LILYPOND = r'''#!/usr/bin/env python3
+import os, sys
+args = sys.argv[1:]
+log = os.environ.get('FAKE_LILYPOND_LOG')
+if log:
+    with open(log, 'a') as f:
+        f.write(' '.join(args) + '\n')
+output = args[args.index('-o') + 1]
+inputs = [a for i, a in enumerate(args) if i > args.index('-o') + 1]
+for name in inputs:
+    source = sys.stdin.read() if name == '-' else open(name).read()
+    sys.stderr.write(f"Processing `{name}'\n")
+    if 'BROKEN' in source:
+        sys.stderr.write(f"{name}:3:1: error: unknown escaped string\n")
+        continue
+    if len(inputs) == 1:
+        pdf = output + '.pdf'
+    else:
+        pdf = os.path.join(output, os.path.basename(name)[:-3] + '.pdf')
+    with open(pdf, 'w') as f:
+        f.write('%PDF-1.4 ' + source.strip())
+    sys.stderr.write("Success: compilation successfully completed\n")
+'''
+
+
+@contextmanager
+def fake_lilypond():
+    """Put the fake lilypond first on PATH; yields the file its invocations are logged to."""
+    with tempfile.TemporaryDirectory() as bin_dir:
+        exe = Path(bin_dir) / 'lilypond'
+        exe.write_text(FAKE_LILYPOND)
+        exe.chmod(exe.stat().st_mode | stat.S_IEXEC)
+        log = Path(bin_dir) / 'calls.log'
+        saved = {name: os.environ.get(name) for name in ('PATH', 'FAKE_LILYPOND_LOG')}
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{saved['PATH']}"
+        os.environ['FAKE_LILYPOND_LOG'] = str(log)
+        try:
+            yield log
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+def invocations(log):
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def test_split_stderr_maps_errors_to_files():
+    """Each file's chunk of a combined log holds only its own errors."""
+    stderr = (
+        "GNU LilyPond 2.24.3\n"
+        "Processing `0.ly'\n"
+        "Success: compilation successfully completed\n"
+        "Processing `1.ly'\n"
+        "1.ly:3:1: error: unknown escaped string\n"
+    )
+    chunks = split_stderr(stderr, ['0.ly', '1.ly'])
+
+    assert 'error' not in chunks['0.ly']
+    assert '1.ly:3:1: error' in chunks['1.ly']
+    print("OK: errors split per file")
+
+
+def test_split_stderr_unrecognized_log():
+    """Without Processing lines, every file gets the whole log."""
+    chunks = split_stderr("fatal: out of memory", ['0.ly', '1.ly'])
+    assert chunks == {'0.ly': "fatal: out of memory", '1.ly': "fatal: out of memory"}
+    print("OK: unrecognized log shared")
+
+
+def test_run_lilypond_single_wrapper_on_stdin():
+    """A lone wrapper is piped on stdin and its PDF lands next to the named output."""
+    with fake_lilypond() as log, compile_sandbox() as sandbox:
+        result = run_lilypond(['chart.ly'], sandbox, timeout=30, stdin='\\version "2.24.0"')
+
+        assert result.returncode == 0, result.stderr
+        assert (sandbox / 'chart.pdf').exists()
+        assert not (sandbox / 'chart.ly').exists(), "Wrapper should not touch disk"
+        assert invocations(log) == ['-o chart -']
+        print("OK: stdin compile")
+
+
+def test_batcher_single_job():
+    """One waiting job compiles alone, via stdin, into the caller's sandbox."""
+    with fake_lilypond() as log, compile_sandbox() as sandbox:
+        batcher = LilyPondBatcher(window_ms=10, workers=1)
+        result = batcher.compile('chart one', sandbox)
+
+        assert result.ok and result.batch_size == 1
+        assert result.pdf_path == sandbox / 'chart.pdf'
+        assert len(invocations(log)) == 1
+        print("OK: single job compiled")
+
+
+def test_idle_batcher_skips_the_window():
+    """A job arriving with nothing else queued or compiling doesn't wait for the batch window."""
+    with fake_lilypond(), compile_sandbox() as sandbox:
+        batcher = LilyPondBatcher(window_ms=2000, workers=1)
+        start = time.monotonic()
+        result = batcher.compile('chart one', sandbox)
+        elapsed = time.monotonic() - start
+
+        assert result.ok
+        assert elapsed < 1.5, f"Idle compile waited {elapsed:.2f}s for the window"
+        print(f"OK: compiled in {elapsed * 1000:.0f}ms")
+
+
+def test_batcher_groups_concurrent_jobs():
+    """Jobs waiting together share one invocation; errors go to the right job."""
+    with fake_lilypond() as log, compile_sandbox() as scratch:
+        batcher = LilyPondBatcher(window_ms=300, workers=1)
+        sources = ['chart zero', 'BROKEN chart', 'chart two']
+        futures = []
+        for i, source in enumerate(sources):
+            sandbox = scratch / str(i)
+            sandbox.mkdir()
+            futures.append(Future())
+            batcher._jobs.put((0, next(batcher._seq), source, sandbox, futures[-1]))
+        batcher.start()
+
+        results = {}
+        for i, future in enumerate(futures):
+            result = future.result(10)
+            results[i] = (result, result.pdf_path.read_text() if result.ok else None)
+
+        assert len(invocations(log)) == 1, invocations(log)
+        assert all(result.batch_size == 3 for result, _ in results.values())
+        assert results[0][1] == '%PDF-1.4 chart zero'
+        assert results[2][1] == '%PDF-1.4 chart two'
+        broken, _ = results[1]
+        assert not broken.ok
+        assert 'error: unknown escaped string' in broken.stderr
+        assert 'error' not in results[0][0].stderr
+        print("OK: 3 jobs, 1 invocation, error mapped back")
+
+
+def test_collect_defers_lower_priority_jobs():
+    """A better job arriving mid-window starts a new batch; the old one is put back."""
+    batcher = LilyPondBatcher(window_ms=300, workers=1)
+    batcher._running = 1  # Another compile in flight, so the window is held
+
+    def job(priority, name):
+        return (priority, next(batcher._seq), name, Path('.'), Future())
+
+    batcher._jobs.put(job(2, 'prefetch-a'))
+    threading.Timer(0.05, lambda: batcher._jobs.put(job(0, 'interactive'))).start()
+    threading.Timer(0.1, lambda: batcher._jobs.put(job(2, 'prefetch-b'))).start()
+
+    batch = batcher._collect()
+
+    assert [j[2] for j in batch] == ['interactive']
+    requeued = []
+    while not batcher._jobs.empty():
+        requeued.append(batcher._jobs.get_nowait()[2])
+    assert sorted(requeued) == ['prefetch-a', 'prefetch-b'], requeued
+    print("OK: lower-priority jobs requeued")
+
+
+def test_batcher_timeout_reaches_caller():
+    """A timed-out invocation raises TimeoutExpired in every waiting caller."""
+    original = compiler.run_lilypond
+
+    def hang(*args, **kwargs):
+        raise compiler.subprocess.TimeoutExpired('lilypond', 60)
+
+    compiler.run_lilypond = hang
+    try:
+        with compile_sandbox() as sandbox:
+            batcher = LilyPondBatcher(window_ms=10, workers=1)
+            try:
+                batcher.compile('chart', sandbox)
+                assert False, "Expected TimeoutExpired"
+            except compiler.subprocess.TimeoutExpired:
+                pass
+    finally:
+        compiler.run_lilypond = original
+    print("OK: timeout propagated")
+
+
+def test_compile_sandbox_is_private_and_removed():
+    """Each compile gets its own directory under the scratch root, gone afterwards."""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp) / 'scratch'
+        with compile_sandbox(root) as first, compile_sandbox(root) as second:
+            assert first != second
+            assert first.parent == root and first.name.startswith(compiler.SCRATCH_PREFIX)
+            (first / 'chart.pdf').write_bytes(b'%PDF')
+        assert not first.exists() and not second.exists()
+        print(f"OK: {first.name}")
+
+
+def test_compile_sandbox_removed_on_error():
+    """A failing compile still removes its sandbox, and the error reaches the caller."""
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            with compile_sandbox(tmp) as sandbox:
+                (sandbox / 'wrapper.ly').write_text('BROKEN')
+                raise RuntimeError('lilypond died')
+        except RuntimeError:
+            pass
+        else:
+            assert False, "Expected the error to propagate"
+        assert not sandbox.exists()
+        print("OK: sandbox removed after error")
+
+
+def test_sweep_removes_only_orphaned_sandboxes():
+    """Old sandboxes are swept; recent ones and unrelated directories stay."""
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        orphan = root / f'{compiler.SCRATCH_PREFIX}orphan'
+        recent = root / f'{compiler.SCRATCH_PREFIX}recent'
+        unrelated = root / 'something-else'
+        for path in (orphan, recent, unrelated):
+            path.mkdir()
+            (path / 'chart.pdf').write_bytes(b'%PDF')
+        old = time.time() - 2 * compiler.SCRATCH_MAX_AGE
+        for path in (orphan, unrelated):
+            os.utime(path, (old, old))
+
+        assert sweep_sandboxes(root) == 1
+        assert not orphan.exists() and recent.exists() and unrelated.exists()
+        print("OK: 1 orphaned sandbox swept")
+
+
+def test_content_hash_follows_core_and_include_edits():
+    """Editing the Core file or any Include file changes the hash; nothing else does."""
+    with tempfile.TemporaryDirectory() as tmp:
+        core = Path(tmp) / 'Core' / 'Solar - Ly Core - C.ly'
+        include_dir = Path(tmp) / 'Include'
+        core.parent.mkdir()
+        include_dir.mkdir()
+        core.write_text('melody = { c d e }')
+        (include_dir / 'chords.ily').write_text('% chords')
+        variant = ('Solar - Ly Core - C.ly', 'standard', 'c', 'C', 'treble', 0)
+
+        original = content_hash(core, include_dir, variant)
+        assert len(original) == 16
+        assert content_hash(core, include_dir, variant) == original, "Hash should be stable"
+        assert content_hash(core, include_dir, variant[:-1] + (1,)) != original
+
+        core.write_text('melody = { c d e f }')
+        after_core = content_hash(core, include_dir, variant)
+        assert after_core != original
+
+        (include_dir / 'chords.ily').write_text('% chords, revised')
+        after_include = content_hash(core, include_dir, variant)
+        assert after_include != after_core
+
+        (include_dir / 'new.ily').write_text('% new')
+        assert content_hash(core, include_dir, variant) != after_include
+        print("OK: core and include edits change the hash")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_split_stderr_maps_errors_to_files,
+        test_split_stderr_unrecognized_log,
+        test_run_lilypond_single_wrapper_on_stdin,
+        test_batcher_single_job,
+        test_idle_batcher_skips_the_window,
+        test_batcher_groups_concurrent_jobs,
+        test_collect_defers_lower_priority_jobs,
+        test_batcher_timeout_reaches_caller,
+        test_compile_sandbox_is_private_and_removed,
+        test_compile_sandbox_removed_on_error,
+        test_sweep_removes_only_orphaned_sandboxes,
+        test_content_hash_follows_core_and_include_edits,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
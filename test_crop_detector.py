@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Tests for crop detection.
+
+Run with: python3 test_crop_detector.py
+Or with pytest: pytest test_crop_detector.py -v
+"""
+
+import os
+import tempfile
+from pathlib import Path
+
+import fitz
+
+import crop_detector
+
+
+def make_chart(path):
+    """A letter-size page with a title and a few staves, like a generated chart."""
+    doc = fitz.open()
+    page = doc.new_page(width=612, height=792)
+    page.insert_text((150, 80), "Blue Bossa", fontsize=24)
+    for staff in range(4):
+        y = 130 + staff * 60
+        for line in range(5):
+            page.draw_line((50, y + line * 6), (560, y + line * 6), width=0.5, lineJoin=1, lineCap=1)
+    doc.save(path)
+    doc.close()
+
+
+def test_numpy_matches_per_pixel_scan():
+    """The vectorized detector finds exactly the bounds of the per-pixel reference."""
+    if not crop_detector.NUMPY_AVAILABLE:
+        print("SKIP: numpy not installed")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = str(Path(tmp) / 'chart.pdf')
+        make_chart(pdf)
+
+        reference = crop_detector.detect_content_bounds(pdf)
+        bounds = crop_detector.detect_content_bounds_numpy(pdf)
+
+        assert reference is not None
+        assert bounds.to_dict() == reference.to_dict(), (bounds, reference)
+        print(f"OK: {bounds.to_dict()}")
+
+
+def test_blank_page_has_no_bounds():
+    """A page with no ink gives None rather than a zero-size crop."""
+    if not crop_detector.NUMPY_AVAILABLE:
+        print("SKIP: numpy not installed")
+        return
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = str(Path(tmp) / 'blank.pdf')
+        doc = fitz.open()
+        doc.new_page(width=612, height=792)
+        doc.save(pdf)
+        doc.close()
+
+        assert crop_detector.detect_content_bounds_numpy(pdf) is None
+        print("OK: blank page")
+
+
+def test_vector_bounds_close_to_raster():
+    """Bounds from the drawing log land within a couple of points of the rendered ink."""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = str(Path(tmp) / 'chart.pdf')
+        make_chart(pdf)
+
+        reference = crop_detector.detect_content_bounds(pdf).to_dict()
+        bounds = crop_detector.detect_content_bounds_vector(pdf).to_dict()
+
+        for edge in reference:
+            assert abs(bounds[edge] - reference[edge]) <= 2, (edge, bounds, reference)
+        print(f"OK: vector {bounds} vs raster {reference}")
+
+
+def test_vector_falls_back_on_background_fill():
+    """A full-page background makes the drawing log useless, so the page is rendered instead."""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = str(Path(tmp) / 'background.pdf')
+        doc = fitz.open()
+        page = doc.new_page(width=612, height=792)
+        page.draw_rect(page.rect, color=None, fill=(1, 1, 1))
+        page.insert_text((150, 80), "Blue Bossa", fontsize=24)
+        doc.save(pdf)
+        doc.close()
+
+        bounds = crop_detector.detect_content_bounds_vector(pdf)
+
+        assert bounds is not None and bounds.top > 30, bounds
+        print(f"OK: fell back to raster, {bounds.to_dict()}")
+
+
+def test_page_bounds_per_page():
+    """A half-empty second page gets its own, larger bottom trim."""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = str(Path(tmp) / 'two-page.pdf')
+        doc = fitz.open()
+        for staves in (10, 3):
+            page = doc.new_page(width=612, height=792)
+            for staff in range(staves):
+                y = 80 + staff * 60
+                page.draw_line((50, y), (560, y), width=0.5, lineJoin=1, lineCap=1)
+        doc.new_page(width=612, height=792)  # Blank trailing page
+        doc.save(pdf)
+        doc.close()
+
+        pages = crop_detector.detect_page_bounds(pdf)
+
+        assert len(pages) == 3
+        assert pages[2] is None
+        assert pages[1].bottom > pages[0].bottom + 300, pages
+        assert pages[0].to_list() == crop_detector.detect_content_bounds_vector(pdf).to_list()
+        print(f"OK: {[p.to_list() if p else None for p in pages]}")
+
+
+def test_page_layout_sizes():
+    """Page sizes come back per page, alongside the crop bounds."""
+    doc = fitz.open()
+    for width, height in ((612, 792), (595, 842)):
+        page = doc.new_page(width=width, height=height)
+        page.draw_line((50, 100), (500, 100), width=0.5, lineJoin=1, lineCap=1)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+
+    layout = crop_detector.detect_page_layout(pdf_bytes)
+
+    assert layout.page_count == 2
+    assert layout.sizes == [[612.0, 792.0], [595.0, 842.0]]
+    assert len(layout.crop_pages()) == 2 and all(layout.crop_pages())
+    assert crop_detector.detect_page_layout(b'not a pdf') is None
+    print(f"OK: {layout.sizes}")
+
+
+def test_bytes_pipeline_matches_file():
+    """Bounds and page count from an in-memory PDF match the file; optimizing never grows it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf = Path(tmp) / 'chart.pdf'
+        make_chart(str(pdf))
+        pdf_bytes = pdf.read_bytes()
+
+        from_bytes = crop_detector.detect_page_bounds(pdf_bytes)
+        from_file = crop_detector.detect_page_bounds(str(pdf))
+        assert [b.to_list() for b in from_bytes] == [b.to_list() for b in from_file]
+        assert crop_detector.get_page_count(pdf_bytes) == 1
+
+        optimized = crop_detector.optimize_pdf(pdf_bytes)
+        assert len(optimized) <= len(pdf_bytes)
+        assert crop_detector.detect_page_bounds(optimized)[0].to_list() == from_file[0].to_list()
+        print(f"OK: {len(pdf_bytes)} -> {len(optimized)} bytes")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_numpy_matches_per_pixel_scan,
+        test_blank_page_has_no_bounds,
+        test_vector_bounds_close_to_raster,
+        test_vector_falls_back_on_background_fill,
+        test_page_bounds_per_page,
+        test_page_layout_sizes,
+        test_bytes_pipeline_matches_file,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
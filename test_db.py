@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+Tests for the in-memory catalog snapshot.
+
+Run with: python3 test_db.py
+Or with pytest: pytest test_db.py -v
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import db
+
+PROVIDERS = {'standard': {'id': 'standard', 'name': 'Eric Royer', 'includeVersion': 'abc123'}}
+
+
+def make_catalog(path, titles):
+    """A catalog.db with the build_catalog schema and one core file per song."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE songs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT UNIQUE NOT NULL,
+            default_key TEXT DEFAULT 'c',
+            composer TEXT,
+            core_files TEXT,
+            low_note_midi INTEGER,
+            high_note_midi INTEGER,
+            source TEXT DEFAULT 'standard',
+            core_modified TEXT,
+            score_id TEXT,
+            part_name TEXT,
+            tempo_style TEXT,
+            tempo_source TEXT,
+            tempo_bpm INTEGER,
+            tempo_note_value INTEGER,
+            time_signature TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE TABLE metadata (key TEXT PRIMARY KEY, value TEXT);
+    """)
+    for title in titles:
+        conn.execute("INSERT INTO songs (title, default_key, core_files, low_note_midi, high_note_midi) "
+                     "VALUES (?, 'bf', ?, 58, 77)", (title, json.dumps([f"{title} - Ly Core - Bb.ly"])))
+    conn.execute("INSERT INTO metadata VALUES ('providers', ?)", (json.dumps(PROVIDERS),))
+    conn.commit()
+    conn.close()
+
+
+def test_lookups_served_from_snapshot():
+    """Read helpers answer from memory, even with the database file gone."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'catalog.db'
+        make_catalog(path, ['Blue Bossa', 'All The Things You Are', 'Autumn Leaves'])
+
+        assert db.init_db(path) == 3
+        path.unlink()
+
+        assert db.song_exists('Blue Bossa') and not db.song_exists('Giant Steps')
+        assert db.get_song_default_key('Blue Bossa') == ('bf', 'treble')
+        assert db.get_song_default_key('Giant Steps') == ('c', 'treble')
+        assert db.get_core_files('Blue Bossa') == ['Blue Bossa - Ly Core - Bb.ly']
+        assert db.get_song_note_range('Blue Bossa') == (58, 77)
+        assert db.get_song_source('Blue Bossa') == 'standard'
+        assert db.get_include_version('standard') == 'abc123'
+        assert [s['title'] for s in db.get_all_songs()] == ['All The Things You Are', 'Autumn Leaves', 'Blue Bossa']
+
+        songs, total = db.search_songs('au', limit=1)
+        assert total == 1 and songs[0]['title'] == 'Autumn Leaves'
+        songs, total = db.search_songs('', limit=2, offset=1)
+        assert total == 3 and [s['title'] for s in songs] == ['Autumn Leaves', 'Blue Bossa']
+        print("OK: lookups served without the database")
+
+
+def test_reload_swaps_snapshot():
+    """Calling init_db again replaces the snapshot; a held one stays unchanged."""
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path, new_path = Path(tmp) / 'old.db', Path(tmp) / 'new.db'
+        make_catalog(old_path, ['Blue Bossa'])
+        make_catalog(new_path, ['Blue Bossa', 'Solar'])
+
+        db.init_db(old_path)
+        held = db.get_snapshot()
+        assert db.init_db(new_path) == 2
+
+        assert db.song_exists('Solar')
+        assert 'Solar' not in held.by_title
+        assert db.get_snapshot() is not held
+        print("OK: snapshot swapped")
+
+
+def test_resolve_song_for_generation():
+    """One memoized lookup per snapshot with everything generate needs."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'catalog.db'
+        make_catalog(path, ['Blue Bossa'])
+        db.init_db(path)
+
+        song = db.resolve_song_for_generation('Blue Bossa')
+        assert song.core_files == ('Blue Bossa - Ly Core - Bb.ly',)
+        assert (song.source, song.default_key, song.include_version) == ('standard', 'bf', 'abc123')
+        assert (song.low_note_midi, song.high_note_midi) == (58, 77)
+        assert db.resolve_song_for_generation('Blue Bossa') is song
+        assert db.resolve_song_for_generation('Giant Steps') is None
+
+        db.init_db(path)
+        assert db.resolve_song_for_generation('Blue Bossa') is not song
+        print(f"OK: {song}")
+
+
+def test_validate_catalog():
+    """A good catalog reports its song count; junk and empty catalogs are rejected."""
+    with tempfile.TemporaryDirectory() as tmp:
+        good, empty, junk = Path(tmp) / 'good.db', Path(tmp) / 'empty.db', Path(tmp) / 'junk.db'
+        make_catalog(good, ['Blue Bossa', 'Solar'])
+        make_catalog(empty, [])
+        junk.write_bytes(b'not a database' * 100)
+
+        assert db.validate_catalog(good) == 2
+        for bad in (empty, junk):
+            try:
+                db.validate_catalog(bad)
+                assert False, f"{bad.name} should be rejected"
+            except ValueError as e:
+                print(f"OK: {e}")
+
+
+def test_connection_is_read_only_and_follows_init():
+    """get_connection() opens the loaded catalog read-only, and the new one after init_db()."""
+    with tempfile.TemporaryDirectory() as tmp:
+        old_path, new_path = Path(tmp) / 'old.db', Path(tmp) / 'new.db'
+        make_catalog(old_path, ['Blue Bossa'])
+        make_catalog(new_path, ['Blue Bossa', 'Solar'])
+
+        db.init_db(old_path)
+        with db.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0] == 1
+            assert conn.execute("PRAGMA mmap_size").fetchone()[0] == db.CATALOG_MMAP_BYTES
+
+        db.init_db(new_path)
+        with db.get_connection() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM songs").fetchone()[0] == 2
+            try:
+                conn.execute("DELETE FROM songs")
+                assert False, "write should fail"
+            except sqlite3.OperationalError:
+                pass
+        print("OK: read-only connection to the current catalog")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_lookups_served_from_snapshot,
+        test_reload_swaps_snapshot,
+        test_resolve_song_for_generation,
+        test_validate_catalog,
+        test_connection_is_read_only_and_follows_init,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Tests for metrics aggregation and Prometheus export.
+
+Run with: python3 test_metrics.py
+Or with pytest: pytest test_metrics.py -v
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import metrics
+
+
+def test_aggregate_sums_worker_snapshots():
+    """Counters and histograms from other processes' snapshot files are added to ours."""
+    with tempfile.TemporaryDirectory() as tmp:
+        metrics.inc('test_aggregate_total', 2, result='hit')
+        metrics.observe('test_aggregate_seconds', 0.003)
+
+        other = {
+            'counters': [['test_aggregate_total', [['result', 'hit']], 5]],
+            'histograms': [['test_aggregate_seconds', [], [0] * (len(metrics.BUCKETS) + 1), 1.5, 3]],
+        }
+        (Path(tmp) / 'other-worker.json').write_text(json.dumps(other))
+
+        counter_values, histogram_values = metrics.aggregate(tmp)
+
+        assert counter_values[('test_aggregate_total', (('result', 'hit'),))] == 7
+        counts, total, count = histogram_values[('test_aggregate_seconds', ())]
+        assert count == 4 and sum(counts) == 1
+        assert abs(total - 1.503) < 1e-9
+        print("OK: snapshots summed")
+
+
+def test_exited_workers_are_compacted():
+    """Snapshots of dead processes fold into one totals file without changing the sums."""
+    with tempfile.TemporaryDirectory() as tmp:
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        snapshot = {'counters': [['test_compact_total', [], 4]], 'histograms': []}
+        (Path(tmp) / f'{dead.pid}-1.json').write_text(json.dumps(snapshot))
+        (Path(tmp) / f'{dead.pid}-2.json').write_text(json.dumps(snapshot))
+
+        first, _ = metrics.aggregate(tmp)
+        files = sorted(p.name for p in Path(tmp).glob('*.json'))
+        second, _ = metrics.aggregate(tmp)
+
+        assert first[('test_compact_total', ())] == 8
+        assert second[('test_compact_total', ())] == 8
+        assert files == sorted([metrics.EXITED_TOTALS, f'{metrics._process_id}.json']), files
+        print(f"OK: {files}")
+
+
+def test_render_prometheus_format():
+    """Histograms render cumulative buckets, sum and count; gauges get a TYPE line."""
+    buckets = [1] + [0] * (len(metrics.BUCKETS) - 1) + [1]
+    text = metrics.render_prometheus(
+        {('requests_total', (('route', '/health'),)): 3},
+        {('run_seconds', ()): (buckets, 61.0, 2)},
+        {'queue_depth': 4},
+    )
+
+    assert 'jazzpicker_requests_total{route="/health"} 3' in text
+    assert 'jazzpicker_run_seconds_bucket{le="0.001"} 1' in text
+    assert 'jazzpicker_run_seconds_bucket{le="+Inf"} 2' in text
+    assert 'jazzpicker_run_seconds_count 2' in text
+    assert '# TYPE jazzpicker_queue_depth gauge\njazzpicker_queue_depth 4' in text
+    print(text)
+
+
+def test_stage_timer_collects_nested_stages():
+    """stage() blocks record into the timer active on this thread."""
+    timer = metrics.StageTimer()
+    with timer:
+        with metrics.stage('catalog'):
+            pass
+        with metrics.stage('catalog'):
+            pass
+    with metrics.stage('outside'):
+        pass
+
+    assert list(timer.stages) == ['catalog']
+    assert timer.server_timing().startswith('catalog;dur=')
+    print(f"OK: {timer.server_timing()}")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_aggregate_sums_worker_snapshots,
+        test_exited_workers_are_compacted,
+        test_render_prometheus_format,
+        test_stage_timer_collects_nested_stages,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Tests for the local PDF cache.
+
+Run with: python3 test_pdf_cache.py
+Or with pytest: pytest test_pdf_cache.py -v
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from pdf_cache import LocalPDFCache
+
+
+def test_put_and_get_round_trip():
+    """Stored PDFs should come back with their crop and upload state."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp, max_bytes=10_000)
+        crop = {'top': 10.0, 'bottom': 20.0, 'left': 5.0, 'right': 5.0}
+        cache.put('generated/blue-bossa-c-C-treble-0.pdf', b'%PDF-1.4 test', crop, 'abc123', uploaded=True,
+                  crop_pages=[[10.0, 20.0, 5.0, 5.0], None])
+
+        entry = cache.get('generated/blue-bossa-c-C-treble-0.pdf', 'abc123')
+
+        assert entry is not None, "Expected a cache hit"
+        assert entry['path'].read_bytes() == b'%PDF-1.4 test'
+        assert entry['crop'] == crop
+        assert entry['crop_pages'] == [[10.0, 20.0, 5.0, 5.0], None]
+        assert entry['uploaded'] is True
+        print(f"OK: round trip via {entry['filename']}")
+
+
+def test_lru_eviction_respects_byte_cap():
+    """Least recently used entries are evicted once the cap is exceeded."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp, max_bytes=250, touch_interval=0)
+        cache.put('a', b'x' * 100)
+        time.sleep(0.01)
+        cache.put('b', b'x' * 100)
+        time.sleep(0.01)
+        cache.get('a')  # 'a' is now more recent than 'b'
+        time.sleep(0.01)
+        cache.put('c', b'x' * 100)
+
+        assert cache.get('b') is None, "Expected 'b' to be evicted"
+        assert cache.get('a') is not None
+        assert cache.get('c') is not None
+        assert cache.stats()['bytes'] <= 250
+        print(f"OK: {cache.stats()}")
+
+
+def test_hits_within_touch_interval_do_not_write():
+    """Repeated hits only move last_access once it is older than the touch interval."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp, touch_interval=0.2)
+        cache.put('a', b'x')
+
+        def last_access():
+            return cache._connect().execute("SELECT last_access FROM entries WHERE key = 'a'").fetchone()[0]
+
+        stored = last_access()
+        cache.get('a')
+        assert last_access() == stored, "Hit inside the interval should not write"
+
+        time.sleep(0.25)
+        cache.get('a')
+        assert last_access() > stored
+        print("OK: last_access throttled")
+
+
+def test_stale_include_version_is_a_miss():
+    """Entries built with an older includeVersion are discarded."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp)
+        path = cache.put('k', b'old', include_version='v1')
+
+        assert cache.get('k', 'v2') is None
+        assert not path.exists(), "Stale file should be removed"
+        print("OK: stale entry discarded")
+
+
+def test_index_survives_restart():
+    """A new cache instance on the same directory sees existing entries."""
+    with tempfile.TemporaryDirectory() as tmp:
+        LocalPDFCache(tmp).put('k', b'persisted')
+
+        entry = LocalPDFCache(tmp).get('k')
+
+        assert entry is not None and entry['path'].read_bytes() == b'persisted'
+        print("OK: entry survived restart")
+
+
+def test_pending_uploads_are_claimed_once_and_evicted_last():
+    """A pending upload goes to one claimer, survives eviction, and clears once uploaded."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp, max_bytes=250)
+        cache.put('pending', b'x' * 100, pending_bucket='bucket')
+        time.sleep(0.01)
+        cache.put('b', b'x' * 100)
+        time.sleep(0.01)
+        cache.put('c', b'x' * 100)
+
+        assert cache.get('pending') is not None, "Pending upload should not be evicted first"
+        assert cache.get('b') is None
+
+        item = cache.claim_upload()
+        assert item['key'] == 'pending' and item['bucket'] == 'bucket'
+        assert cache.claim_upload() is None, "A claimed upload is leased, not handed out twice"
+
+        cache.mark_uploaded('pending')
+        assert cache.get('pending')['uploaded'] is True
+        assert cache.stats()['pending_uploads'] == 0
+        print("OK: pending upload claimed once")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_put_and_get_round_trip,
+        test_lru_eviction_respects_byte_cap,
+        test_hits_within_touch_interval_do_not_write,
+        test_stale_include_version_is_a_miss,
+        test_index_survives_restart,
+        test_pending_uploads_are_claimed_once_and_evicted_last,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Tests for the S3 circuit breaker.
+
+Run with: python3 test_s3_health.py
+Or with pytest: pytest test_s3_health.py -v
+"""
+
+import os
+import time
+from pathlib import Path
+
+from s3_health import CircuitBreaker
+
+
+def test_opens_after_consecutive_failures():
+    """The breaker opens at the threshold and a success closes it."""
+    breaker = CircuitBreaker(threshold=3, open_seconds=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    assert not breaker.is_open()
+
+    breaker.record_failure()
+    assert breaker.is_open()
+
+    breaker.record_success()
+    assert not breaker.is_open()
+    print("OK: opened at 3 failures, closed on success")
+
+
+def test_success_resets_the_count():
+    """Failures separated by a success don't add up."""
+    breaker = CircuitBreaker(threshold=2, open_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open()
+    print("OK: count reset")
+
+
+def test_closes_after_cooldown():
+    """An open breaker lets S3 be tried again once the cooldown passes."""
+    breaker = CircuitBreaker(threshold=1, open_seconds=0.1)
+    breaker.record_failure()
+    assert breaker.is_open()
+    time.sleep(0.15)
+    assert not breaker.is_open()
+    print("OK: cooled down")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_opens_after_consecutive_failures,
+        test_success_resets_the_count,
+        test_closes_after_cooldown,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
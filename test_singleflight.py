@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Tests for single-flight compile coalescing.
+
+Run with: python3 test_singleflight.py
+Or with pytest: pytest test_singleflight.py -v
+"""
+
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from singleflight import SingleFlight
+
+
+def run_concurrently(flight, key, fn, callers=5):
+    """Call flight.do(key, fn) from several threads at once; returns each caller's result or exception."""
+    outcomes = [None] * callers
+    start = threading.Barrier(callers)
+
+    def call(i):
+        start.wait()
+        try:
+            outcomes[i] = flight.do(key, fn)
+        except Exception as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(5)
+    return outcomes
+
+
+def test_concurrent_calls_run_once():
+    """Concurrent callers of one key share a single call and its result."""
+    with tempfile.TemporaryDirectory() as tmp:
+        flight = SingleFlight(tmp)
+        calls = []
+
+        def compile_once():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'url': '/pdfs/a.pdf'}, 200
+
+        outcomes = run_concurrently(flight, 'generated/a.pdf', compile_once)
+
+        assert len(calls) == 1, f"Expected one call, got {len(calls)}"
+        assert all(outcome == ({'url': '/pdfs/a.pdf'}, 200) for outcome in outcomes)
+        print("OK: 5 callers, 1 call")
+
+
+def test_exception_reaches_every_waiter():
+    """A failing call raises its exception in the leader and every follower."""
+    with tempfile.TemporaryDirectory() as tmp:
+        flight = SingleFlight(tmp)
+
+        def fail():
+            time.sleep(0.2)
+            raise RuntimeError('lilypond crashed')
+
+        outcomes = run_concurrently(flight, 'generated/a.pdf', fail)
+
+        assert all(isinstance(outcome, RuntimeError) for outcome in outcomes), outcomes
+        print("OK: every caller saw the error")
+
+
+def test_different_keys_run_separately():
+    """Calls for different keys are not coalesced."""
+    with tempfile.TemporaryDirectory() as tmp:
+        flight = SingleFlight(tmp)
+        assert flight.do('a', lambda: 'a') == 'a'
+        assert flight.do('b', lambda: 'b') == 'b'
+        print("OK: keys are independent")
+
+
+def test_lock_file_removed_on_release():
+    """Lock files exist only while a call holds them."""
+    with tempfile.TemporaryDirectory() as tmp:
+        flight = SingleFlight(tmp)
+        seen = []
+
+        flight.do('generated/a.pdf', lambda: seen.append(flight.lock_path('generated/a.pdf').exists()))
+
+        assert seen == [True], "Lock file should exist while held"
+        assert not list(Path(tmp).iterdir()), "Lock file left behind"
+        print("OK: lock file cleaned up")
+
+
+def test_separate_instances_serialize_on_lock_file():
+    """Two instances (as in two gunicorn workers) never run the same key at once."""
+    with tempfile.TemporaryDirectory() as tmp:
+        flights = [SingleFlight(tmp), SingleFlight(tmp), SingleFlight(tmp)]
+        active = []
+        overlaps = []
+        active_lock = threading.Lock()
+
+        def compile_once():
+            with active_lock:
+                active.append(1)
+                if len(active) > 1:
+                    overlaps.append(len(active))
+            time.sleep(0.1)
+            with active_lock:
+                active.pop()
+            return 'ok'
+
+        threads = [threading.Thread(target=flight.do, args=('generated/a.pdf', compile_once))
+                   for flight in flights for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(5)
+
+        assert not overlaps, f"Calls overlapped: {overlaps}"
+        assert not list(Path(tmp).iterdir()), "Lock file left behind"
+        print("OK: instances serialized")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_concurrent_calls_run_once,
+        test_exception_reaches_every_waiter,
+        test_different_keys_run_separately,
+        test_lock_file_removed_on_release,
+        test_separate_instances_serialize_on_lock_file,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Tests for write-behind S3 uploads.
+
+Run with: python3 test_uploader.py
+Or with pytest: pytest test_uploader.py -v
+"""
+
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from pdf_cache import LocalPDFCache
+from uploader import WriteBehindUploader
+
+
+class FlakyS3:
+    """Stands in for boto3's upload_file; fails the first `failures` calls."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.uploads = []
+
+    def upload_file(self, filename, bucket, key, ExtraArgs=None):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("connection reset")
+        self.uploads.append((Path(filename).read_bytes(), bucket, key, ExtraArgs))
+
+
+def test_upload_carries_metadata_and_runs_hook():
+    """A pending entry is uploaded with its crop and includeVersion, then marked uploaded."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp)
+        cache.put('generated/k.pdf', b'%PDF', {'top': 1.0}, 'v1', pending_bucket='charts')
+        s3 = FlakyS3()
+        uploaded = []
+        uploader = WriteBehindUploader(cache, s3, on_uploaded=uploaded.append)
+
+        assert uploader.upload_one() is True
+        assert uploader.upload_one() is False
+
+        body, bucket, key, extra = s3.uploads[0]
+        assert (body, bucket, key) == (b'%PDF', 'charts', 'generated/k.pdf')
+        assert extra['Metadata'] == {'crop': '{"top": 1.0}', 'includeVersion': 'v1'}
+        assert cache.get('generated/k.pdf')['uploaded'] is True
+        assert uploaded[0]['key'] == 'generated/k.pdf'
+        print("OK: uploaded with metadata")
+
+
+def test_failed_upload_is_retried_later():
+    """A failed upload is rescheduled with backoff instead of being dropped."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalPDFCache(tmp)
+        cache.put('k', b'%PDF', pending_bucket='charts')
+        uploader = WriteBehindUploader(cache, FlakyS3(failures=1))
+
+        assert uploader.upload_one() is True
+        assert cache.claim_upload() is None, "Retry should wait for its backoff"
+        assert cache.stats()['pending_uploads'] == 1
+
+        cache.upload_failed('k', retry_at=time.time())  # Skip ahead to the retry
+        assert uploader.upload_one() is True
+        assert cache.get('k')['uploaded'] is True
+        print("OK: retried after failure")
+
+
+if __name__ == "__main__":
+    # Run tests directly
+    os.chdir(Path(__file__).parent)
+
+    tests = [
+        test_upload_carries_metadata_and_runs_hook,
+        test_failed_upload_is_retried_later,
+    ]
+
+    passed = 0
+    failed = 0
+
+    for test in tests:
+        print(f"\n--- {test.__name__} ---")
+        try:
+            test()
+            passed += 1
+        except Exception as e:
+            print(f"FAILED: {e}")
+            failed += 1
+
+    print(f"\n{'='*40}")
+    print(f"Results: {passed} passed, {failed} failed")
+
+    if failed > 0:
+        exit(1)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-request catalog overhead: query per call vs in-memory
+snapshot.
+
+A generate request asks the catalog six questions (default key, existence,
+source, core files, includeVersion, note range). This times those six
+calls the old way - a fresh sqlite3 connection and query each - against
+the db module's snapshot, for every song in the catalog.
+
+Usage:
+    python tools/bench_catalog.py                  # ./catalog.db
+    python tools/bench_catalog.py path/to/catalog.db --repeat 5
+"""
+
+import argparse
+import json
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+# Add parent dir for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import db
+
+
+def query_one(db_path, sql, params=()):
+    """One round-trip the way db.py used to do it: connect, query, close."""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return conn.execute(sql, params).fetchone()
+    finally:
+        conn.close()
+
+
+def generate_queries(query, db_path, title):
+    """The catalog queries of one generate request."""
+    query(db_path, "SELECT default_key FROM songs WHERE title = ?", (title,))
+    query(db_path, "SELECT 1 FROM songs WHERE title = ? LIMIT 1", (title,))
+    query(db_path, "SELECT source FROM songs WHERE title = ?", (title,))
+    row = query(db_path, "SELECT core_files FROM songs WHERE title = ?", (title,))
+    json.loads(row['core_files'] or '[]')
+    row = query(db_path, "SELECT value FROM metadata WHERE key = 'providers'")
+    json.loads(row['value'] if row else '{}')
+    query(db_path, "SELECT low_note_midi, high_note_midi FROM songs WHERE title = ?", (title,))
+
+
+def per_query_request(db_path, title):
+    """The catalog calls of one generate request, one connection each."""
+    generate_queries(query_one, db_path, title)
+
+
+def snapshot_request(db_path, title):
+    """The same calls served from the in-memory snapshot."""
+    db.get_song_default_key(title)
+    db.song_exists(title)
+    source = db.get_song_source(title)
+    db.get_core_files(title)
+    db.get_include_version(source)
+    db.get_song_note_range(title)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-request catalog overhead")
+    parser.add_argument("db_path", nargs="?", default=str(db.LOCAL_DB_PATH), help="Catalog database")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes over every song")
+    args = parser.parse_args()
+
+    if not Path(args.db_path).exists():
+        print(f"Catalog not found: {args.db_path}")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    count = db.init_db(args.db_path)
+    load_ms = (time.perf_counter() - start) * 1000
+    titles = [song.title for song in db.get_snapshot().songs]
+    print(f"Loaded {count} songs into the snapshot in {load_ms:.1f} ms")
+    print(f"Timing {len(titles)} songs x {args.repeat} passes")
+
+    print(f"\n{'catalog access':<22}{'us per request':>16}")
+    requests = (
+        ("query per call", per_query_request),
+        ("snapshot", snapshot_request),
+    )
+    for name, request in requests:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for title in titles:
+                request(args.db_path, title)
+        elapsed = (time.perf_counter() - start) / (args.repeat * len(titles))
+        print(f"{name:<22}{elapsed * 1e6:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
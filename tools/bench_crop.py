@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark crop detection: per-pixel loop vs sampling scan vs NumPy vs vector.
+
+Runs each detector in crop_detector over generated charts and prints the
+mean time per chart and how far each one's bounds are from the per-pixel
+reference (detect_content_bounds at 72 DPI).
+
+Usage:
+    python tools/bench_crop.py                       # PDFs in the local cache
+    python tools/bench_crop.py chart1.pdf chart2.pdf
+    python tools/bench_crop.py --repeat 5
+"""
+
+import argparse
+import math
+import sys
+import time
+from pathlib import Path
+
+# Add parent dir for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import crop_detector
+from pdf_cache import CACHE_DIR
+
+ROOT = Path(__file__).parent.parent
+
+
+def max_difference(bounds, reference) -> float:
+    """Largest per-edge difference in points between two CropBounds (NaN if only one found bounds)."""
+    if bounds is None and reference is None:
+        return 0.0
+    if bounds is None or reference is None:
+        return float('nan')
+    a, b = bounds.to_dict(), reference.to_dict()
+    return max(abs(a[edge] - b[edge]) for edge in a)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark crop detection implementations")
+    parser.add_argument("pdfs", nargs="*", help="Generated chart PDFs (default: the local PDF cache)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per chart and detector")
+    parser.add_argument("--limit", type=int, default=20, help="Charts to use from the cache")
+    args = parser.parse_args()
+
+    pdfs = [Path(p) for p in args.pdfs]
+    if not pdfs:
+        cache_dir = CACHE_DIR if CACHE_DIR.is_absolute() else ROOT / CACHE_DIR
+        pdfs = sorted(cache_dir.glob("*.pdf"))[:args.limit]
+    if not pdfs:
+        print("No PDFs found - generate some charts first or pass paths")
+        sys.exit(1)
+
+    detectors = [
+        ("per-pixel (72 dpi)", crop_detector.detect_content_bounds),
+        ("sampled (36 dpi)", crop_detector.detect_content_bounds_fast),
+    ]
+    if crop_detector.NUMPY_AVAILABLE:
+        detectors.append(("numpy (72 dpi)", crop_detector.detect_content_bounds_numpy))
+        detectors.append(("numpy (144 dpi)", lambda p: crop_detector.detect_content_bounds_numpy(p, dpi=144)))
+    else:
+        print("NumPy not installed - skipping the vectorized detector")
+    detectors.append(("vector geometry", crop_detector.detect_content_bounds_vector))
+
+    references = {pdf: crop_detector.detect_content_bounds(str(pdf)) for pdf in pdfs}
+    print(f"Benchmarking {len(pdfs)} charts x {args.repeat} runs")
+
+    print(f"\n{'detector':<22}{'ms per chart':>14}{'max diff (pt)':>16}{'mismatches':>12}")
+    for name, detect in detectors:
+        worst = 0.0
+        mismatches = set()  # Charts where only one of detector/reference found bounds
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for pdf in pdfs:
+                bounds = detect(str(pdf))
+                difference = max_difference(bounds, references[pdf])
+                if math.isnan(difference):
+                    mismatches.add(pdf)
+                else:
+                    worst = max(worst, difference)
+        elapsed = (time.perf_counter() - start) / (args.repeat * len(pdfs))
+        print(f"{name:<22}{elapsed * 1000:>14.2f}{worst:>16.1f}{len(mismatches):>12}")
+        for pdf in sorted(mismatches):
+            print(f"    bounds disagree on whether {pdf.name} has content")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-chart LilyPond cost: one process per chart vs one batched run.
+
+Builds wrappers for N songs from catalog.db, compiles them the way
+/api/v2/generate used to (a fresh lilypond process each) and then all at
+once in a single invocation (what LilyPondBatcher does), and prints the
+per-chart wall time of both.
+
+Usage:
+    python tools/bench_lilypond_batch.py                # 8 songs
+    python tools/bench_lilypond_batch.py --count 4
+    python tools/bench_lilypond_batch.py --songs "502 Blues" "Autumn Leaves"
+"""
+
+import argparse
+import sqlite3
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+
+# Add parent dir for imports
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from compiler import generate_wrapper_content, run_lilypond
+
+ROOT = Path(__file__).parent.parent
+LILYPOND_DATA_DIR = ROOT / "lilypond-data"
+BENCH_DIR_NAME = "Generated-bench"
+
+
+def pick_songs(db_path: Path, count: int, titles: list[str] | None) -> list[dict]:
+    """Load core file info for the requested (or first N standard) songs."""
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    if titles:
+        placeholders = ",".join("?" * len(titles))
+        rows = conn.execute(
+            f"SELECT title, default_key, core_files, source FROM songs WHERE title IN ({placeholders})",
+            titles
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT title, default_key, core_files, source FROM songs WHERE source = 'standard' ORDER BY title LIMIT ?",
+            (count,)
+        ).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+
+def write_wrappers(songs: list[dict], out_dir: Path) -> list[Path]:
+    """Write one wrapper per song and return paths relative to lilypond-data."""
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True)
+
+    paths = []
+    for i, song in enumerate(songs):
+        core_file = json.loads(song["core_files"])[0]
+        content = generate_wrapper_content(core_file, song["default_key"] or "c", "treble", "", 0, song["source"])
+        wrapper = out_dir / f"bench-{i}.ly"
+        wrapper.write_text(content)
+        paths.append(Path(BENCH_DIR_NAME) / wrapper.name)
+    return paths
+
+
+def count_pdfs(out_dir: Path) -> int:
+    return len(list(out_dir.glob("*.pdf")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark batched vs per-request LilyPond compiles")
+    parser.add_argument("--count", type=int, default=8, help="Number of songs to compile")
+    parser.add_argument("--songs", nargs="+", help="Specific song titles to compile")
+    parser.add_argument("--db", type=str, default=str(ROOT / "catalog.db"), help="Catalog database path")
+    args = parser.parse_args()
+
+    if not LILYPOND_DATA_DIR.exists():
+        print(f"Error: lilypond-data not found at {LILYPOND_DATA_DIR}")
+        sys.exit(1)
+
+    songs = pick_songs(Path(args.db), args.count, args.songs)
+    if not songs:
+        print("No songs found")
+        sys.exit(1)
+
+    out_dir = LILYPOND_DATA_DIR / BENCH_DIR_NAME
+    print(f"Benchmarking {len(songs)} charts")
+
+    try:
+        # One process per chart (previous /api/v2/generate behaviour)
+        wrappers = write_wrappers(songs, out_dir)
+        start = time.time()
+        for wrapper in wrappers:
+            run_lilypond([wrapper], LILYPOND_DATA_DIR, timeout=120)
+        sequential = time.time() - start
+        sequential_ok = count_pdfs(out_dir)
+
+        # All charts in a single invocation (LilyPondBatcher)
+        wrappers = write_wrappers(songs, out_dir)
+        start = time.time()
+        run_lilypond(wrappers, LILYPOND_DATA_DIR, timeout=120 * len(wrappers))
+        batched = time.time() - start
+        batched_ok = count_pdfs(out_dir)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+    n = len(songs)
+    print(f"\n{'mode':<24}{'total (s)':>12}{'per chart (s)':>16}{'pdfs':>8}")
+    print(f"{'process per chart':<24}{sequential:>12.2f}{sequential / n:>16.2f}{sequential_ok:>8}")
+    print(f"{'single batched run':<24}{batched:>12.2f}{batched / n:>16.2f}{batched_ok:>8}")
+    if batched > 0:
+        print(f"\nSpeedup: {sequential / batched:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""
+Write-behind S3 uploads for freshly compiled charts.
+
+On a cache miss the user already waits for LilyPond and crop detection;
+uploading to S3 before answering adds another round-trip across the
+country. Instead, compile_chart stores the PDF in the local cache marked
+as pending upload and answers with a short-lived local URL. Uploader
+threads in every gunicorn worker claim pending entries from the cache
+index and push them to S3, retrying with backoff. Once an upload is
+confirmed the entry is marked uploaded, and later requests get presigned
+S3 URLs as before.
+"""
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', '1'))  # Uploader threads per process
+UPLOAD_MAX_ATTEMPTS = int(os.getenv('UPLOAD_MAX_ATTEMPTS', '8'))
+UPLOAD_MAX_BACKOFF = 300    # Seconds between retries, at most
+UPLOAD_DRAIN_SECONDS = 10   # How long shutdown waits for pending uploads
+POLL_INTERVAL = 2.0         # Seconds between checks for uploads queued by other processes
+
+
+def chart_metadata(crop, include_version, crop_pages=None, page_sizes=None):
+    """
+    S3 object metadata for a generated chart (string values; S3 lowercases
+    the keys when reading them back).
+    """
+    compact = {'separators': (',', ':')}
+    metadata = {}
+    if crop:
+        metadata['crop'] = json.dumps(crop)
+    if crop_pages:
+        metadata['cropPages'] = json.dumps(crop_pages, **compact)
+    if page_sizes:
+        metadata['pageCount'] = str(len(page_sizes))
+        metadata['pageSizes'] = json.dumps(page_sizes, **compact)
+    if include_version:
+        metadata['includeVersion'] = include_version
+    return metadata
+
+
+class WriteBehindUploader:
+    """
+    Background threads that drain a LocalPDFCache's pending uploads.
+
+    on_uploaded(item), if given, is called after each successful upload
+    with the dict returned by LocalPDFCache.claim_upload().
+    """
+
+    def __init__(self, cache, s3_client, on_uploaded=None, workers=UPLOAD_WORKERS):
+        self.cache = cache
+        self.s3_client = s3_client
+        self.on_uploaded = on_uploaded
+        self.workers = max(1, workers)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._drain_registered = False
+        self._wakeup = threading.Condition()
+
+    def start(self):
+        """Start uploader threads for this process (idempotent)."""
+        with self._start_lock:
+            # gunicorn forks workers, so threads started in a parent are gone
+            self._threads = [t for t in self._threads if t.is_alive()]
+            if not self._drain_registered:
+                atexit.register(self.drain, UPLOAD_DRAIN_SECONDS)
+                self._drain_registered = True
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._worker_loop, name='s3-uploader', daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def notify(self):
+        """Wake this process's uploaders (call after queueing an upload)."""
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def upload_one(self):
+        """Claim and upload one pending entry. Returns False if nothing was due."""
+        item = self.cache.claim_upload()
+        if not item:
+            return False
+
+        key = item['key']
+        if not item['path'].exists():
+            # Evicted before it could be uploaded; the next request recompiles it
+            self.cache.upload_failed(key)
+            metrics.inc('s3_uploads_total', result='lost')
+            return True
+
+        extra_args = {'ContentType': 'application/pdf'}
+        s3_metadata = chart_metadata(item['crop'], item['include_version'], item['crop_pages'], item['page_sizes'])
+        if s3_metadata:
+            extra_args['Metadata'] = s3_metadata
+
+        try:
+            self.s3_client.upload_file(str(item['path']), item['bucket'], key, ExtraArgs=extra_args)
+        except Exception as e:
+            attempts = item['attempts'] + 1
+            if attempts >= UPLOAD_MAX_ATTEMPTS:
+                self.cache.upload_failed(key)
+                metrics.inc('s3_uploads_total', result='gave_up')
+                print(f"⚠️  Giving up on S3 upload of {key} after {attempts} attempts: {e}")
+            else:
+                self.cache.upload_failed(key, time.time() + min(UPLOAD_MAX_BACKOFF, 2 ** attempts))
+                metrics.inc('s3_uploads_total', result='retry')
+                print(f"⚠️  S3 upload of {key} failed (attempt {attempts}), will retry: {e}")
+            return True
+
+        self.cache.mark_uploaded(key)
+        metrics.inc('s3_uploads_total', result='ok')
+        metrics.observe('s3_upload_lag_seconds', time.time() - item['created_at'])
+        if self.on_uploaded:
+            try:
+                self.on_uploaded(item)
+            except Exception as e:
+                print(f"⚠️  Post-upload hook failed for {key}: {e}")
+        return True
+
+    def drain(self, timeout):
+        """Upload whatever is due, for at most timeout seconds (used at shutdown)."""
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline and self.upload_one():
+                pass
+        except sqlite3.Error as e:
+            print(f"⚠️  Could not drain S3 uploads: {e}")
+
+    def _worker_loop(self):
+        while True:
+            try:
+                did_work = self.upload_one()
+            except sqlite3.Error as e:
+                print(f"⚠️  Upload queue claim failed: {e}")
+                did_work = False
+
+            if not did_work:
+                # Uploads may also be queued by other processes, so poll as well as wait
+                with self._wakeup:
+                    self._wakeup.wait(POLL_INTERVAL)